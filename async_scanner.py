@@ -0,0 +1,184 @@
+import asyncio
+import concurrent.futures
+import threading
+from typing import AsyncIterable, AsyncIterator, Iterable, NamedTuple, Optional
+
+from engines import create_engine
+from engines.base_engine import RegexEngine
+from file_reader import FileReader
+from file_scanner import FileScanner
+from match_sink import ChunkRing
+
+
+class Match(NamedTuple):
+    """A match yielded by AsyncFileScanner"""
+    pattern_id: int
+    # None if the engine does not report the start (see RegexEngine.reports_start)
+    start: Optional[int]
+    end: int
+    # matched bytes, None if the start is unknown or they were dropped from the ring
+    text: Optional[bytes]
+
+
+class _Bridge:
+    """
+    Connects one scan running in an executor thread with the event loop.
+
+    The thread pulls chunks from the async producer one at a time and puts
+    the matches of each chunk into a bounded asyncio.Queue. When the queue
+    is full the thread waits, so it stops pulling chunks and the producer
+    is not read any further (backpressure).
+    """
+
+    def __init__(self, loop: asyncio.AbstractEventLoop, queue_size: int):
+        self.loop = loop
+        self.queue = asyncio.Queue(queue_size)
+        self.stop = threading.Event()
+        self._pending = None
+
+    def pull(self, source: AsyncIterator[bytes]) -> Iterable[bytes]:
+        """Chunks of an async iterator, read from the thread"""
+        while not self.stop.is_set():
+            self._pending = asyncio.run_coroutine_threadsafe(source.__anext__(), self.loop)
+            try:
+                chunk = self._pending.result()
+            except (StopAsyncIteration, concurrent.futures.CancelledError):
+                return
+            yield chunk
+
+    def send(self, item) -> None:
+        """Puts an item into the queue from the thread, waiting while it is full"""
+        asyncio.run_coroutine_threadsafe(self.queue.put(item), self.loop).result()
+
+    def cancel(self) -> None:
+        """Asks the thread to stop, also when it waits for the producer"""
+        self.stop.set()
+        if self._pending is not None:
+            self._pending.cancel()
+
+
+class AsyncFileScanner:
+    """
+    Scanning API for asyncio applications.
+
+    Data comes from async byte iterators (sockets, aiofiles, subprocess
+    pipes) and matches are yielded by async generators, nothing is printed.
+    Engine calls run in an executor, so the event loop is never blocked:
+    each active scan uses one executor thread that feeds an engine stream.
+    Chunks are read from the producer only when the consumer keeps up with
+    the matches, so a slow consumer slows down the producer.
+    """
+    # batches of matches (one per scanned chunk) buffered per scan
+    QUEUE_SIZE = 16
+
+    def __init__(self, engine: RegexEngine = None, executor: concurrent.futures.Executor = None,
+                 queue_size: int = None):
+        """
+        Args:
+            engine: RegexEngine instance (default: HyperscanEngine with a
+                scratch per thread, so several scans can run at once).
+                Concurrent scans need an engine that can scan from several
+                threads.
+            executor: Executor running the scans (default: the loop's
+                default executor). It needs one thread per active scan.
+            queue_size: Number of match batches buffered before the scan
+                waits for the consumer (default: QUEUE_SIZE)
+        """
+        self.engine = engine or create_engine("hyperscan", thread_scratch=True)
+        self.executor = executor
+        self.queue_size = queue_size or AsyncFileScanner.QUEUE_SIZE
+
+    def compile_patterns(self, patterns) -> None:
+        """Compiles patterns given as strings (blocking, call before scanning)"""
+        FileScanner(self.engine).compile_patterns(patterns)
+
+    def load_patterns(self, config: str) -> None:
+        """Loads a compiled database or a text file with regexes (blocking, call before scanning)"""
+        FileScanner(self.engine).load_patterns(config)
+
+    async def scan(self, chunks: AsyncIterable[bytes]) -> AsyncIterator[Match]:
+        """
+        Scans a stream given as an async iterable of byte chunks.
+
+        Yields:
+            Match for every match, in the order reported by the engine.
+            Errors of the producer or the engine are raised here.
+        """
+        bridge = _Bridge(asyncio.get_running_loop(), self.queue_size)
+        async for match in self._matches(bridge, bridge.pull(chunks.__aiter__())):
+            yield match
+
+    async def scan_reader(self, reader: asyncio.StreamReader, chunk_size: int = None) -> AsyncIterator[Match]:
+        """Scans everything read from an asyncio StreamReader (socket, subprocess pipe) until EOF"""
+        chunk_size = chunk_size or FileReader.CHUNK_SIZE
+
+        async def chunks():
+            while True:
+                chunk = await reader.read(chunk_size)
+                if not chunk:
+                    return
+                yield chunk
+
+        async for match in self.scan(chunks()):
+            yield match
+
+    async def scan_file(self, filename: str, chunk_size: int = None) -> AsyncIterator[Match]:
+        """Scans a file, reading it in the executor thread"""
+        bridge = _Bridge(asyncio.get_running_loop(), self.queue_size)
+        async for match in self._matches(bridge, FileReader.chunks(filename, chunk_size=chunk_size)):
+            yield match
+
+    async def _matches(self, bridge: _Bridge, chunks: Iterable[bytes]) -> AsyncIterator[Match]:
+        """Runs the scan in the executor and yields its matches"""
+        future = bridge.loop.run_in_executor(self.executor, self._scan, bridge, chunks)
+        finished = False
+        try:
+            while True:
+                batch = await bridge.queue.get()
+                if batch is None or isinstance(batch, BaseException):
+                    finished = True
+                    if batch is None:
+                        break
+                    raise batch
+                for match in batch:
+                    yield match
+        finally:
+            if not finished:
+                # consumer stopped early: let the thread finish, it sends None or an error last
+                bridge.cancel()
+                while True:
+                    batch = await bridge.queue.get()
+                    if batch is None or isinstance(batch, BaseException):
+                        break
+            await future
+
+    def _scan(self, bridge: _Bridge, chunks: Iterable[bytes]) -> None:
+        """Executor side: feeds the engine stream and sends one batch of matches per chunk"""
+        ring = ChunkRing(FileScanner.RING_SIZE)
+        with_start = self.engine.reports_start
+        batch = []
+
+        def callback(pattern_id, start, end, flags, context):
+            if with_start and start <= end:
+                batch.append(Match(pattern_id, start, end, ring.get(start, end)))
+            else:
+                batch.append(Match(pattern_id, None, end, None))
+
+        def feed():
+            nonlocal batch
+            for chunk in chunks:
+                if bridge.stop.is_set():
+                    return
+                yield chunk
+                # the chunk is scanned now
+                if batch and not bridge.stop.is_set():
+                    bridge.send(batch)
+                    batch = []
+
+        try:
+            self.engine.scan_stream(ring.track(feed()), callback)
+            if batch and not bridge.stop.is_set():
+                bridge.send(batch)
+            bridge.send(None)
+        except Exception as e:
+            bridge.send(e)
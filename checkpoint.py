@@ -0,0 +1,131 @@
+import base64
+import hashlib
+import json
+import os
+import tempfile
+from typing import Dict, Optional
+
+
+class CheckpointStore:
+    """
+    Scan positions of growing files, kept in a JSON file between runs.
+
+    For every file (by absolute path) it records the device and inode, the
+    size and offset reached by the last scan, a hash of the first bytes and
+    the compressed Hyperscan stream state (base64) together with the id of
+    the database it belongs to. FileScanner.scan_file_incremental resumes
+    from there; see Checkpoint.matches for when a file is scanned again
+    from the start.
+    """
+    VERSION = 1
+    # bytes at the start of a file hashed to detect a replaced file
+    HEAD_SIZE = 1024
+
+    def __init__(self, path: str):
+        """
+        Args:
+            path: JSON file with the checkpoints, created by save if missing
+        """
+        self.path = path
+        self.entries: Dict[str, dict] = {}
+        self.load()
+
+    def load(self) -> None:
+        """Reads the checkpoints; a missing or unreadable file gives an empty store"""
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError) as e:
+            print(f"Cannot read checkpoints: '{self.path}': {e}, scanning from the start")
+            return
+
+        if not isinstance(data, dict) or data.get("version") != CheckpointStore.VERSION:
+            print(f"Unsupported checkpoint file: '{self.path}', scanning from the start")
+            return
+        self.entries = data.get("files", {})
+
+    def save(self) -> None:
+        """Atomically writes the checkpoints"""
+        directory = os.path.dirname(os.path.abspath(self.path))
+        fd, tmp = tempfile.mkstemp(dir=directory, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "w", encoding="utf-8") as f:
+                json.dump({"version": CheckpointStore.VERSION, "files": self.entries}, f, indent=1)
+            os.replace(tmp, self.path)
+        except BaseException:
+            try:
+                os.remove(tmp)
+            except OSError:
+                pass
+            raise
+
+    def get(self, filename: str) -> Optional["Checkpoint"]:
+        entry = self.entries.get(os.path.abspath(filename))
+        return Checkpoint(entry) if entry else None
+
+    def put(self, filename: str, checkpoint: "Checkpoint") -> None:
+        self.entries[os.path.abspath(filename)] = checkpoint.entry
+
+
+def head_hash(f, length: int) -> str:
+    """Hash of the first `length` bytes of an open binary file"""
+    f.seek(0)
+    return hashlib.sha1(f.read(length)).hexdigest()
+
+
+class Checkpoint:
+    """Position of one file in a CheckpointStore"""
+
+    def __init__(self, entry: dict):
+        self.entry = entry
+
+    @classmethod
+    def create(cls, stat: os.stat_result, f, offset: int, database: str, state: bytes) -> "Checkpoint":
+        """
+        Args:
+            stat: os.fstat of the scanned file
+            f: the file open in binary mode
+            offset: number of bytes scanned
+            database: id of the stream database (HyperscanEngine.database_id)
+            state: compressed stream state after `offset` bytes
+        """
+        head_len = min(offset, CheckpointStore.HEAD_SIZE)
+        return cls({
+            "dev": stat.st_dev,
+            "inode": stat.st_ino,
+            "size": stat.st_size,
+            "offset": offset,
+            "head_len": head_len,
+            "head": head_hash(f, head_len),
+            "db": database,
+            "state": base64.b64encode(state).decode("ascii"),
+        })
+
+    @property
+    def offset(self) -> int:
+        return self.entry["offset"]
+
+    @property
+    def state(self) -> bytes:
+        return base64.b64decode(self.entry["state"])
+
+    def matches(self, stat: os.stat_result, f, database: str) -> bool:
+        """
+        True if the scan can continue from this checkpoint.
+
+        False, so the file is scanned from the start, if it was rotated
+        (another device or inode), truncated (smaller than the offset),
+        replaced in place (its first bytes changed, e.g. copytruncate) or
+        if the patterns changed (another database).
+        """
+        entry = self.entry
+        try:
+            if (entry["dev"], entry["inode"]) != (stat.st_dev, stat.st_ino):
+                return False
+            if stat.st_size < entry["offset"] or entry["db"] != database:
+                return False
+            return head_hash(f, entry["head_len"]) == entry["head"]
+        except (KeyError, TypeError):
+            return False
@@ -1 +1,54 @@
 # Pakiet z silnikami regex
+"""
+Registry of regex engines.
+
+Engines are looked up by name and their modules are imported only when
+an engine is selected, so e.g. `--engine python` never loads hyperscan.
+Other packages can add engines through entry points in ENTRY_POINT_GROUP
+(`name = "module:Class"`), or at runtime with register_engine.
+"""
+import importlib
+from typing import Dict, List
+
+# name -> "module:Class"
+ENGINES = {
+    "hyperscan": "engines.hs_engine:HyperscanEngine",
+    "layered": "engines.hs_layered:LayeredHyperscanEngine",
+    "python": "engines.python_engine:PythonEngine",
+}
+ENTRY_POINT_GROUP = "nokia_project.engines"
+
+
+def _entry_points() -> Dict[str, str]:
+    """Engines declared by installed packages (only read when a name is not built in)"""
+    from importlib.metadata import entry_points
+    return {ep.name: ep.value for ep in entry_points(group=ENTRY_POINT_GROUP)}
+
+
+def register_engine(name: str, target: str) -> None:
+    """Adds an engine given as "module:Class" """
+    ENGINES[name] = target
+
+
+def engine_names() -> List[str]:
+    """Names of all available engines"""
+    return sorted({**_entry_points(), **ENGINES})
+
+
+def get_engine_class(name: str):
+    """
+    Returns the RegexEngine class registered as `name`, importing its module.
+
+    Raises:
+        ValueError: if no engine has this name
+    """
+    target = ENGINES.get(name) or _entry_points().get(name)
+    if target is None:
+        raise ValueError(f"Unknown regex engine: '{name}' (available: {', '.join(engine_names())})")
+    module_name, _, class_name = target.partition(":")
+    return getattr(importlib.import_module(module_name), class_name)
+
+
+def create_engine(name: str, **kwargs):
+    """Creates the engine registered as `name` with the given constructor arguments"""
+    return get_engine_class(name)(**kwargs)
@@ -1,21 +1,43 @@
 from abc import ABC, abstractmethod
-from typing import List, Callable, Any, Iterable
+from typing import List, Callable, Any, Iterable, Optional
+from .pattern_info import max_match_width
 
 
 class RegexEngine(ABC):
     """Abstract base class for regex engines"""
+    # False if the engine reports only end offsets (start is always 0)
+    reports_start = True
     
     @abstractmethod
     def compile_patterns(self, patterns: List[bytes], ids: List[int] = None) -> None:
-        """Compiles regex patterns"""
+        """
+        Compiles regex patterns.
+
+        Engines that support per-pattern flags take a third argument
+        `flags`: a tuple of flag names (file_regex.pattern_file.FLAGS) per
+        pattern. It is only passed when a pattern file sets flags.
+        """
         pass
     
     @abstractmethod
     def scan(self, data: bytes, callback: Callable) -> None:
-        """Scans data and triggers a callback when a match is found"""
+        """
+        Scans data and triggers a callback when a match is found.
+
+        A callback returning True stops the scan (in all scan methods): no
+        more matches are reported and scan_stream reads no more chunks.
+        """
         pass
     
     @abstractmethod
     def scan_stream(self, data_chunks: Iterable[bytes], callback: Callable, context: Any = None) -> None:
         """Scans data in streaming mode - accepts iterable chunks of data"""
         pass
+
+    def scan_buffer(self, buffer, callback: Callable, context: Any = None) -> None:
+        """Scans one block given as any buffer object (e.g. a memoryview of a mapped file)"""
+        self.scan_stream([buffer], callback, context=context)
+
+    def max_match_width(self) -> Optional[int]:
+        """Longest possible match of the compiled patterns in bytes, None if unbounded or unknown"""
+        return max_match_width(getattr(self, "patterns", None))
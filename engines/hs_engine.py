@@ -1,49 +1,638 @@
-﻿import hyperscan
+﻿import hashlib
+import json
+import os
+import platform
+import threading
+from contextlib import suppress
+import hyperscan
 from .base_engine import RegexEngine
 from typing import List, Callable, Any
 
 
+def _compile_shard(task):
+    """
+    Worker of HyperscanEngine.compile_shards: compiles one shard and
+    returns its serialized databases, one per mode.
+    """
+    patterns, ids, flags, som, cache_dir, modes = task
+    engine = HyperscanEngine(cache_dir=cache_dir, use_cache=cache_dir is not None, som=som)
+    engine.compile_patterns(patterns, ids, flags, modes=modes)
+    return [hyperscan.dumpb(engine._database(name)) for name in modes]
+
+
 class HyperscanEngine(RegexEngine):
-    COMPILER_MODE_FLAGS = hyperscan.HS_MODE_STREAM | hyperscan.HS_MODE_SOM_HORIZON_LARGE
-    COMPILE_FLAGS = hyperscan.HS_FLAG_SOM_LEFTMOST
+    CACHE_DIR = os.environ.get("HS_CACHE_DIR", os.path.join(os.path.expanduser("~"), ".cache", "hs_db"))
+    CACHE_MAX_ENTRIES = 32
+    # Stream.close(scratch=...) of the binding rejects Scratch objects, so
+    # streams scanned with their own scratch are closed with the database one
+    _CLOSE_LOCK = threading.Lock()
+    # build artifact with several databases: magic, header length, JSON header, blobs
+    DB_MAGIC = b"HSDBPACK"
+    DB_VERSION = 1
+    # artifact of a sharded database: a list of databases per shard
+    DB_SHARDED_VERSION = 2
+    DB_MODES = ("stream", "block", "vectored")
+    # scan_buffer copies buffers up to this size to scan them with the block
+    # database, bigger ones go to the vectored database without a copy
+    COPY_MAX_SIZE = 16 << 20
+    # start-of-match tracking: pattern flag and stream horizon per level
+    SOM_LEVELS = {
+        "none": (0, 0),
+        "small": (hyperscan.HS_FLAG_SOM_LEFTMOST, hyperscan.HS_MODE_SOM_HORIZON_SMALL),
+        "large": (hyperscan.HS_FLAG_SOM_LEFTMOST, hyperscan.HS_MODE_SOM_HORIZON_LARGE),
+    }
+    # per-pattern flags of structured pattern files (file_regex.pattern_file.FLAGS)
+    FLAG_BITS = {
+        "caseless": hyperscan.HS_FLAG_CASELESS,
+        "dotall": hyperscan.HS_FLAG_DOTALL,
+        "multiline": hyperscan.HS_FLAG_MULTILINE,
+        "singlematch": hyperscan.HS_FLAG_SINGLEMATCH,
+        "prefilter": hyperscan.HS_FLAG_PREFILTER,
+        "allowempty": hyperscan.HS_FLAG_ALLOWEMPTY,
+        "utf8": hyperscan.HS_FLAG_UTF8,
+        "ucp": hyperscan.HS_FLAG_UCP,
+    }
+    # flags Hyperscan does not combine with start-of-match tracking: the
+    # start of such patterns is reported as unknown
+    NO_SOM_FLAGS = frozenset(("singlematch", "prefilter"))
+    # start offset of a match whose start is not known (~0ULL, as past the SOM horizon)
+    START_UNKNOWN = (1 << 64) - 1
 
-    def __init__(self):
+    def __init__(self, cache_dir: str = None, use_cache: bool = True, som: str = "large",
+                 thread_scratch: bool = False):
+        """
+        Args:
+            cache_dir: Directory for serialized databases (default: CACHE_DIR)
+            use_cache: If False, always compile and never touch the cache
+            som: Start-of-match tracking: "large" (exact start offsets),
+                "small" (start offsets only within 2^16 bytes of the match
+                end in streams, cheaper) or "none" (end offsets only,
+                fastest to compile and smallest)
+            thread_scratch: Give every thread its own scratch space for
+                each database (cloned on first use), so scan, scan_buffer
+                and scan_stream can be called from several threads at once
+        """
+        if som not in HyperscanEngine.SOM_LEVELS:
+            raise ValueError(f"Unknown SOM level: {som}")
+        self.som = som
         self.db = None
+        self.block_db = None
+        self.vectored_db = None
         self.patterns = []
-    
-    def compile_patterns(self, patterns, ids=None):
+        self.ids = []
+        self.flags = []
+        # ids of patterns compiled without start-of-match tracking (NO_SOM_FLAGS)
+        self._start_unknown = frozenset()
+        self.cache_dir = (cache_dir or HyperscanEngine.CACHE_DIR) if use_cache else None
+        self._max_width = None
+        self.thread_scratch = thread_scratch
+        self._local = threading.local()
+        # sharded database (compile_shards or a sharded artifact): one
+        # engine per shard, all scanned over the same data
+        self.shards = []
+
+    def __getstate__(self):
+        # thread-local scratch spaces stay in this process and databases
+        # cannot be pickled: a copy (e.g. sent to a Pool worker) keeps the
+        # options and loads its patterns itself
+        state = self.__dict__.copy()
+        del state["_local"]
+        state.update(db=None, block_db=None, vectored_db=None, shards=[], patterns=[], ids=[], flags=[],
+                     _start_unknown=frozenset(), _max_width=None)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._local = threading.local()
+
+    def compile_patterns(self, patterns, ids=None, flags=None, modes=("stream",)):
+        """
+        Args:
+            flags: per-pattern flag names (keys of FLAG_BITS), None for none
+            modes: databases compiled now, so invalid patterns fail here;
+                the other modes are compiled on first use. A scan that only
+                needs the block database (small files) passes ("block",)
+                and never compiles the stream one.
+        """
         self.patterns = patterns
         if ids is None:
             ids = list(range(len(patterns)))
-        flags = [HyperscanEngine.COMPILE_FLAGS] * len(patterns)
-        self.db = hyperscan.Database(mode=HyperscanEngine.COMPILER_MODE_FLAGS)
-        self.db.compile(expressions=patterns, ids=ids, flags=flags, elements=len(patterns))
-    
-    def scan(self, data, callback):
-        if self.db is None:
-            raise RuntimeError('Patterns Database is not compiled')
-        self.db.scan(data, match_event_handler=callback)
-    
-    def scan_stream(self, data_chunks, callback, context=None):
-        if self.db is None:
+        self.ids = ids
+        self.flags, self._start_unknown = self._flag_bits(ids, flags)
+        self.db = None
+        self.block_db = None
+        self.vectored_db = None
+        self.shards = []
+        for name in modes:
+            self._database(name)
+
+    def _flag_bits(self, ids, flags):
+        """Hyperscan flags of every pattern and the ids whose start is not tracked"""
+        som_flag = HyperscanEngine.SOM_LEVELS[self.som][0]
+        if flags is None:
+            return [som_flag] * len(ids), frozenset()
+        bits = []
+        start_unknown = set()
+        for pattern_id, names in zip(ids, flags):
+            value = 0
+            for name in names:
+                if name not in HyperscanEngine.FLAG_BITS:
+                    raise ValueError(f"Unknown pattern flag: {name}")
+                value |= HyperscanEngine.FLAG_BITS[name]
+            if HyperscanEngine.NO_SOM_FLAGS.isdisjoint(names):
+                value |= som_flag
+            elif som_flag:
+                start_unknown.add(pattern_id)
+            bits.append(value)
+        return bits, frozenset(start_unknown)
+
+    def _report(self, callback):
+        """
+        The callback given to Hyperscan: matches of patterns compiled
+        without start-of-match tracking get START_UNKNOWN as start
+        (Hyperscan reports 0), like a start past the SOM horizon.
+        """
+        start_unknown = self._start_unknown
+        if not start_unknown:
+            return callback
+
+        def report(pattern_id, start, end, flags, context):
+            if pattern_id in start_unknown:
+                start = HyperscanEngine.START_UNKNOWN
+            return callback(pattern_id, start, end, flags, context)
+
+        return report
+
+    def compile_shards(self, patterns, ids=None, shards=2, processes=None, modes=("stream",), bucket_size=None,
+                       flags=None):
+        """
+        Compiles a big pattern set as several smaller databases in parallel.
+
+        The patterns are split into `shards` groups of similar estimated
+        compile cost (pattern_info.balance_shards) and every group is
+        compiled (through the cache) by a worker process. Each process
+        compiles a fraction of the set, so the peak memory per process is
+        lower too; `processes` bounds how many run at once (default: one
+        per shard, at most the CPU count).
+
+        Scanning runs every shard over the same data and ids stay those of
+        the whole set. A sharded engine has no single stream database, so
+        stream_pool is not available.
+
+        Args:
+            modes: database kinds compiled in the workers (see save_db);
+                others are compiled on first use in this process
+            bucket_size: If set, the shards are the id ranges of this size
+                instead (`shards` is ignored). With stable ids (PatternStore)
+                an edit changes only the buckets of the edited ids, the
+                others are loaded from the cache.
+            flags: per-pattern flag names, see compile_patterns
+        """
+        if ids is None:
+            ids = list(range(len(patterns)))
+        from multiprocessing import Pool
+        from .pattern_info import balance_shards
+
+        if bucket_size:
+            buckets = {}
+            for index, pattern_id in enumerate(ids):
+                buckets.setdefault(pattern_id // bucket_size, []).append(index)
+            groups = [buckets[key] for key in sorted(buckets)]
+        else:
+            groups = balance_shards(patterns, shards)
+        tasks = [([patterns[i] for i in group], [ids[i] for i in group],
+                  None if flags is None else [flags[i] for i in group], self.som, self.cache_dir, list(modes))
+                 for group in groups]
+        processes = processes or min(len(tasks), os.cpu_count() or 1)
+        if len(tasks) < 2 or processes < 2:
+            results = [_compile_shard(task) for task in tasks]
+        else:
+            with Pool(processes) as pool:
+                results = pool.map(_compile_shard, tasks, chunksize=1)
+
+        compiled = []
+        for (shard_patterns, shard_ids, shard_flags, *_), blobs in zip(tasks, results):
+            shard = self._shard_engine(dict(zip(modes, blobs)), self.som)
+            shard.patterns = shard_patterns
+            shard.ids = shard_ids
+            shard.flags, shard._start_unknown = shard._flag_bits(shard_ids, shard_flags)
+            compiled.append(shard)
+
+        self.patterns = patterns
+        self.ids = ids
+        self.flags, self._start_unknown = self._flag_bits(ids, flags)
+        self.db = None
+        self.block_db = None
+        self.vectored_db = None
+        self.shards = compiled
+
+    def _shard_engine(self, databases, som):
+        """Engine of one shard from its serialized databases (mode name -> bytes)"""
+        if "stream" not in databases:
+            raise ValueError("No stream database in a shard")
+        shard = HyperscanEngine(cache_dir=self.cache_dir, use_cache=self.cache_dir is not None, som=som,
+                                thread_scratch=self.thread_scratch)
+        for name, blob in databases.items():
+            db = hyperscan.loadb(blob, shard._mode_flags(name))
+            db.scratch = hyperscan.Scratch(db)
+            setattr(shard, {"stream": "db", "block": "block_db", "vectored": "vectored_db"}[name], db)
+        return shard
+
+    def _check_compiled(self):
+        if self.db is None and not self.shards and not self.patterns:
             raise RuntimeError('Patterns Database is not compiled')
 
-        with self.db.stream(match_event_handler=callback, context=context) as stream:
+    @property
+    def reports_start(self) -> bool:
+        return self.som != "none"
+
+    def _mode_flags(self, name: str, som: str = None) -> int:
+        """Hyperscan mode flags of a database kind ("stream", "block" or "vectored")"""
+        if name == "stream":
+            return hyperscan.HS_MODE_STREAM | HyperscanEngine.SOM_LEVELS[som or self.som][1]
+        if name == "block":
+            return hyperscan.HS_MODE_BLOCK
+        if name == "vectored":
+            return hyperscan.HS_MODE_VECTORED
+        raise ValueError(f"Unknown database mode: {name}")
+
+    def _database(self, name: str):
+        """
+        Returns the database of a kind, compiling it on first use.
+
+        Only the modes given to compile_patterns are compiled up front. The
+        others come from the build artifact or are compiled (through the
+        cache) when needed; without patterns (a legacy database file) they
+        stay None.
+        """
+        attr = {"stream": "db", "block": "block_db", "vectored": "vectored_db"}[name]
+        db = getattr(self, attr)
+        if db is None and self.patterns and not self.shards:
+            db = self._build_db(self._mode_flags(name))
+            setattr(self, attr, db)
+        return db
+
+    def _scratch(self, db):
+        """Scratch of the calling thread for `db`, None (the database one) without thread_scratch"""
+        if not self.thread_scratch:
+            return None
+        scratches = getattr(self._local, "scratches", None)
+        if scratches is None:
+            scratches = self._local.scratches = {}
+        scratch = scratches.get(db)
+        if scratch is None:
+            scratch = scratches[db] = db.scratch.clone()
+        return scratch
+
+    def release_scratches(self):
+        """Drops the scratch spaces thread_scratch cloned for every thread, scans clone new ones when needed"""
+        self._local = threading.local()
+
+    def _build_db(self, mode):
+        """Compiles the current patterns for `mode`, going through the cache"""
+        key = self.cache_key(self.patterns, self.ids, self.flags, mode)
+        db = self._cache_load(key, mode)
+        if db is None:
+            db = hyperscan.Database(mode=mode)
+            db.compile(expressions=self.patterns, ids=self.ids, flags=self.flags, elements=len(self.patterns))
+            self._cache_store(key, db)
+        return db
+
+    @staticmethod
+    def cache_key(patterns, ids, flags, mode) -> str:
+        """
+        Returns a hash identifying a compiled database.
+
+        Covers the pattern bytes, ids, flags, database mode and the Hyperscan
+        version/platform, so any change produces a different key.
+        """
+        h = hashlib.sha256()
+        h.update(f"{hyperscan.__version__}|{platform.machine()}|{mode}|{len(patterns)}".encode())
+        for pattern, pattern_id, flag in zip(patterns, ids, flags):
+            h.update(len(pattern).to_bytes(4, "little"))
+            h.update(pattern)
+            h.update(f"|{pattern_id}|{flag}|".encode())
+        return h.hexdigest()
+
+    def _cache_path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, f"{key}.db")
+
+    def _cache_load(self, key: str, mode: int):
+        """Returns the cached database for `key` or None, evicting broken entries"""
+        if self.cache_dir is None:
+            return None
+
+        path = self._cache_path(key)
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+        except OSError:
+            return None
+
+        try:
+            db = hyperscan.loadb(data, mode)
+            db.scratch = hyperscan.Scratch(db)
+        except hyperscan.error:
+            # corrupt file or built by another Hyperscan version/platform
+            self._cache_evict(path)
+            return None
+
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        return db
+
+    def _cache_store(self, key: str, db) -> None:
+        """Atomically writes `db` into the cache and drops the oldest entries"""
+        if self.cache_dir is None:
+            return
+
+        import tempfile
+
+        try:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            fd, tmp = tempfile.mkstemp(dir=self.cache_dir, suffix=".tmp")
+            with os.fdopen(fd, "wb") as f:
+                f.write(hyperscan.dumpb(db))
+            os.replace(tmp, self._cache_path(key))
+        except OSError:
+            return
+
+        self._cache_prune()
+
+    def _cache_prune(self) -> None:
+        """Keeps only the CACHE_MAX_ENTRIES most recently used databases"""
+        try:
+            entries = [e for e in os.scandir(self.cache_dir) if e.name.endswith(".db")]
+        except OSError:
+            return
+
+        entries.sort(key=lambda e: e.stat().st_mtime, reverse=True)
+        for entry in entries[HyperscanEngine.CACHE_MAX_ENTRIES:]:
+            self._cache_evict(entry.path)
+
+    @staticmethod
+    def _cache_evict(path: str) -> None:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+    def scan(self, data, callback, context=None):
+        """Scans one block of bytes with the block-mode database"""
+        self._check_compiled()
+        # a callback returning True stops the scan (Hyperscan raises ScanTerminated)
+        with suppress(hyperscan.ScanTerminated):
+            self._scan(data, callback, context)
+
+    def _scan(self, data, callback, context):
+        if self.shards:
+            for shard in self.shards:
+                shard._scan(data, callback, context)
+            return
+
+        block_db = self._database("block")
+        if block_db is None:
+            self._scan_stream([data], callback, context, None)
+            return
+        block_db.scan(data if type(data) is bytes else bytes(data), match_event_handler=self._report(callback),
+                      context=context,
+                      scratch=self._scratch(block_db))
+
+    def scan_stream(self, data_chunks, callback, context=None, scratch=None):
+        """
+        A callback returning True stops the scan, the remaining chunks are
+        not read.
+
+        Args:
+            scratch: Scratch space to use instead of the database one,
+                required when several threads scan with the same database
+                (see new_scratch and thread_scratch)
+        """
+        self._check_compiled()
+        with suppress(hyperscan.ScanTerminated):
+            self._scan_stream(data_chunks, callback, context, scratch)
+
+    def _scan_stream(self, data_chunks, callback, context, scratch):
+        if self.shards:
+            self._scan_shards(data_chunks, callback, context, scratch)
+            return
+
+        db = self._database("stream")
+        if scratch is None:
+            scratch = self._scratch(db)
+        callback = self._report(callback)
+
+        # Stream.scan only accepts bytes, buffers (memoryview, mmap) are copied
+        if scratch is None:
+            with db.stream(match_event_handler=callback, context=context) as stream:
+                for chunk in data_chunks:
+                    stream.scan(chunk if type(chunk) is bytes else bytes(chunk))
+            return
+
+        stream = db.stream(match_event_handler=callback, context=context).__enter__()
+        try:
             for chunk in data_chunks:
-                stream.scan(chunk)
+                stream.scan(chunk if type(chunk) is bytes else bytes(chunk), scratch=scratch)
+        finally:
+            with HyperscanEngine._CLOSE_LOCK:
+                stream.close()
 
-    def save_db(self, filename="hs.db"):
-        if self.db is None:
-            raise RuntimeError("Patterns Database is not compiled")
+    def _scan_shards(self, data_chunks, callback, context, scratches):
+        """
+        Scans a stream with every shard: one Hyperscan stream per shard, each
+        chunk is scanned by all of them before the next one is read. Matches
+        of a chunk come shard by shard, each shard in offset order. A
+        callback stopping one shard stops all of them.
+        """
+        if scratches is None:
+            scratches = [shard._scratch(shard.db) for shard in self.shards]
+        elif len(scratches) != len(self.shards):
+            raise ValueError(f"One scratch per shard is needed: {len(scratches)} for {len(self.shards)} shards")
+        streams = []
+        try:
+            for shard in self.shards:
+                streams.append(shard.db.stream(match_event_handler=shard._report(callback),
+                                               context=context).__enter__())
+            for chunk in data_chunks:
+                if type(chunk) is not bytes:
+                    chunk = bytes(chunk)
+                for stream, scratch in zip(streams, scratches):
+                    stream.scan(chunk, scratch=scratch)
+        finally:
+            with HyperscanEngine._CLOSE_LOCK:
+                for stream in streams:
+                    stream.close()
+
+    def scan_buffer(self, buffer, callback, context=None):
+        """
+        Scans one block given as any buffer object.
+
+        Block and stream scanning of the binding only accept bytes, the
+        vectored mode takes buffers. Bytes go to the block database. Other
+        buffers (memoryview, mmap) go to a single-buffer vectored scan (same
+        results as a block scan) without a copy if the vectored database is
+        already loaded or the buffer is bigger than COPY_MAX_SIZE; smaller
+        ones are copied and scanned with the block database, so small files
+        do not compile a vectored database next to the block one. Without a
+        block database the data is scanned as a stream as the last resort.
+        """
+        self._check_compiled()
+        with suppress(hyperscan.ScanTerminated):
+            self._scan_buffer(buffer, callback, context)
+
+    def _scan_buffer(self, buffer, callback, context):
+        if self.shards:
+            for shard in self.shards:
+                shard._scan_buffer(buffer, callback, context)
+            return
+
+        if type(buffer) is not bytes and (self.vectored_db is not None
+                                          or len(buffer) > HyperscanEngine.COPY_MAX_SIZE):
+            vectored_db = self._database("vectored")
+            if vectored_db is not None:
+                vectored_db.scan([buffer], match_event_handler=self._report(callback), context=context,
+                                 scratch=self._scratch(vectored_db))
+                return
+        self._scan(buffer, callback, context)
+
+    def new_scratch(self):
+        """Returns a scratch space for scanning from another thread (one per shard if sharded)"""
+        self._check_compiled()
+        if self.shards:
+            return [shard.db.scratch.clone() for shard in self.shards]
+        return self._database("stream").scratch.clone()
+
+    def database_id(self) -> str:
+        """Hash of the serialized stream database(s), identifies which database a stream state belongs to"""
+        self._check_compiled()
+        h = hashlib.sha256()
+        for db in [shard.db for shard in self.shards] or [self._database("stream")]:
+            h.update(hyperscan.dumpb(db))
+        return h.hexdigest()
+
+    def stream_pool(self, callback, **kwargs):
+        """
+        Returns a StreamPool (engines.hs_streams) on the stream database:
+        many streams that are opened, fed, suspended (compressed) and closed
+        independently. kwargs are passed to StreamPool.
+        """
+        self._check_compiled()
+        if self.shards:
+            raise RuntimeError("Stream pools need a single database, not a sharded one")
+        from .hs_streams import StreamPool
+        return StreamPool(hyperscan.dumpb(self._database("stream")), self._report(callback), **kwargs)
+
+    def max_match_width(self):
+        if not self.patterns:
+            return self._max_width
+        return super().max_match_width()
 
-        serialized = hyperscan.dumpb(self.db)
+    def save_db(self, filename="hs.db", modes=("stream", "block")):
+        """
+        Saves the databases of the given modes into one build artifact.
+
+        Databases that are not compiled yet are compiled (through the cache).
+        The file starts with DB_MAGIC and the header length, followed by a
+        JSON header (modes, blob sizes, max match width) and the serialized
+        databases. A sharded engine writes a DB_SHARDED_VERSION header with
+        the databases of every shard ("shards": a list of "databases"
+        lists), shard after shard.
+        """
+        self._check_compiled()
+
+        blobs = []
+
+        def databases(engine):
+            entries = []
+            for name in modes:
+                db = engine._database(name)
+                if db is None:
+                    raise RuntimeError(f"No {name} database to save")
+                blob = hyperscan.dumpb(db)
+                entries.append({"mode": name, "size": len(blob)})
+                blobs.append(blob)
+            return entries
+
+        header = {"max_width": self.max_match_width(), "som": self.som}
+        start_unknown = set(self._start_unknown).union(*[shard._start_unknown for shard in self.shards])
+        if start_unknown:
+            header["start_unknown"] = sorted(start_unknown)
+        if self.shards:
+            header.update(version=HyperscanEngine.DB_SHARDED_VERSION,
+                          shards=[databases(shard) for shard in self.shards])
+        else:
+            header.update(version=HyperscanEngine.DB_VERSION, databases=databases(self))
+        header = json.dumps(header).encode("utf-8")
 
         with open(filename, "wb") as f:
-            f.write(serialized)
+            f.write(HyperscanEngine.DB_MAGIC)
+            f.write(len(header).to_bytes(4, "little"))
+            f.write(header)
+            for blob in blobs:
+                f.write(blob)
 
     def load_db(self, filename):
+        """Loads a build artifact, or a single serialized stream database"""
         with open(filename, "rb") as f:
             data = f.read()
 
-        self.db = hyperscan.loadb(data, hyperscan.HS_MODE_STREAM)
-        self.db.scratch = hyperscan.Scratch(self.db)
+        databases = {}
+        shards = []
+        max_width = None
+        som = "large"
+        start_unknown = frozenset()
+        if not data.startswith(HyperscanEngine.DB_MAGIC):
+            databases["stream"] = data
+        else:
+            pos = len(HyperscanEngine.DB_MAGIC)
+            size = int.from_bytes(data[pos:pos + 4], "little")
+            header = json.loads(data[pos + 4:pos + 4 + size])
+            version = header.get("version")
+            if version not in (HyperscanEngine.DB_VERSION, HyperscanEngine.DB_SHARDED_VERSION):
+                raise ValueError(f"Unsupported database file version: {version}")
+            pos += 4 + size
+            lists = header["shards"] if version == HyperscanEngine.DB_SHARDED_VERSION else [header["databases"]]
+            for entries in lists:
+                blobs = {}
+                for entry in entries:
+                    blobs[entry["mode"]] = data[pos:pos + entry["size"]]
+                    pos += entry["size"]
+                shards.append(blobs)
+            if version == HyperscanEngine.DB_VERSION:
+                databases = shards.pop()
+            max_width = header.get("max_width")
+            som = header.get("som", som)
+            start_unknown = frozenset(header.get("start_unknown", ()))
+
+        if som not in HyperscanEngine.SOM_LEVELS:
+            raise ValueError(f"Unknown SOM level in {filename}: {som}")
+        self._start_unknown = start_unknown
+        if shards:
+            self.shards = [self._shard_engine(blobs, som) for blobs in shards]
+            for shard in self.shards:
+                shard._start_unknown = start_unknown
+            self.som = som
+            self._max_width = max_width
+            self.db = None
+            self.block_db = None
+            self.vectored_db = None
+            self.patterns = []
+            return
+
+        if "stream" not in databases:
+            raise ValueError(f"No stream database in {filename}")
+        loaded = {}
+        for name, blob in databases.items():
+            db = hyperscan.loadb(blob, self._mode_flags(name, som))
+            db.scratch = hyperscan.Scratch(db)
+            loaded[name] = db
+
+        self.som = som
+        self._max_width = max_width
+        self.db = loaded["stream"]
+        self.block_db = loaded.get("block")
+        self.vectored_db = loaded.get("vectored")
+        self.shards = []
+        self.patterns = []
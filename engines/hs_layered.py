@@ -0,0 +1,397 @@
+import threading
+import weakref
+from typing import Callable, Iterable, List, NamedTuple, Optional
+
+from .base_engine import RegexEngine
+from .hs_engine import HyperscanEngine
+from .pattern_info import max_match_width
+
+
+class _State(NamedTuple):
+    """One consistent version of the layers, replaced as a whole on every change"""
+    # sharded HyperscanEngine scanning all layers (base first)
+    view: HyperscanEngine
+    # internal id -> external id, None for a removed pattern
+    external: List[Optional[int]]
+    # external == internal for every id, no translation needed
+    identity: bool
+
+
+class LayerScratch:
+    """
+    Scratch spaces of one thread for scan_stream, one per layer (see
+    LayeredHyperscanEngine.new_scratch).
+
+    Every scan binds it to the layers it runs on. After an add or a merge
+    the layers kept reuse their scratch and new layers get a clone, so no
+    layer is skipped; scratches of dropped layers go away with the layer.
+    """
+
+    def __init__(self):
+        # view bound last (weak, an old view is not kept alive)
+        self._view = None
+        # layer -> its scratch
+        self._scratches = weakref.WeakKeyDictionary()
+
+    def bind(self, view: HyperscanEngine) -> list:
+        """Scratch spaces for the layers of `view`, one per shard in shard order"""
+        if self._view is None or self._view() is not view:
+            scratches = weakref.WeakKeyDictionary()
+            for layer in view.shards:
+                scratch = self._scratches.get(layer)
+                scratches[layer] = scratch if scratch is not None else layer.db.scratch.clone()
+            self._scratches = scratches
+            self._view = weakref.ref(view)
+        return [self._scratches[layer] for layer in view.shards]
+
+
+def _flag_tuples(flags, count: int) -> list:
+    """Per-pattern flags as hashable tuples, () for none"""
+    if flags is None:
+        return [()] * count
+    return [tuple(names) for names in flags]
+
+
+class LayeredHyperscanEngine(RegexEngine):
+    """
+    Hyperscan database in layers, for pattern sets that change a few
+    patterns at a time.
+
+    A big base layer is compiled once. Added patterns are compiled into
+    small delta layers, removed ones are hidden by a tombstone (their
+    matches are dropped). All layers are scanned over the same data like
+    the shards of a sharded HyperscanEngine. When the deltas and tombstones
+    reach `merge_threshold` patterns, the live patterns are compiled into a
+    new base in a background thread (Hyperscan compiles without holding
+    the GIL) and swapped in when ready; scans keep using the old layers
+    meanwhile.
+
+    Layers are compiled with internal ids that never change; the ids
+    reported to callbacks are the external ids given by the caller, so a
+    pattern keeps its layer when its external id changes (e.g. the line
+    number in a FileRegex file after a line above it was deleted).
+    """
+    # patterns in deltas plus tombstones that start a merge
+    MERGE_THRESHOLD = 1000
+
+    def __init__(self, cache_dir: str = None, use_cache: bool = True, som: str = "large",
+                 thread_scratch: bool = False, merge_threshold: int = None, background_merge: bool = True):
+        """
+        Args:
+            cache_dir, use_cache, som, thread_scratch: see HyperscanEngine,
+                used for every layer
+            merge_threshold: see MERGE_THRESHOLD
+            background_merge: If False, merges run in the thread that made
+                the change
+        """
+        self._options = {"cache_dir": cache_dir, "use_cache": use_cache, "som": som,
+                         "thread_scratch": thread_scratch}
+        self.som = HyperscanEngine(**self._options).som
+        self.merge_threshold = merge_threshold or LayeredHyperscanEngine.MERGE_THRESHOLD
+        self.background_merge = background_merge
+        self._lock = threading.Lock()
+        self._merge_thread = None
+        self._state = None
+        # layers and the (pattern, flags, internal id) compiled into each
+        self._layers: List[HyperscanEngine] = []
+        self._layer_patterns: List[list] = []
+        self._next_id = 0
+        # tombstones of patterns no longer in any layer (dropped by a merge)
+        self._folded = 0
+        # changes with compile_patterns and load_db, a merge of older layers is discarded
+        self._generation = 0
+        # patterns of a loaded database are unknown, it cannot change
+        self._fixed = False
+
+    def __getstate__(self):
+        # layers are compiled again by the copy (e.g. a Pool worker)
+        state = self.__dict__.copy()
+        state.update(_lock=None, _merge_thread=None, _state=None, _layers=[], _layer_patterns=[], _next_id=0,
+                     _folded=0)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    @property
+    def reports_start(self) -> bool:
+        return self.som != "none"
+
+    @property
+    def changeable(self) -> bool:
+        """True if patterns can be added or removed (compiled from patterns, not loaded)"""
+        return self._state is not None and not self._fixed
+
+    @property
+    def patterns(self) -> List[bytes]:
+        """Live patterns, in no particular order"""
+        state = self._state
+        if state is None:
+            return []
+        return [pattern for layer in self._layer_patterns for pattern, _, internal in layer
+                if state.external[internal] is not None]
+
+    def compile_patterns(self, patterns: List[bytes], ids: List[int] = None, flags=None) -> None:
+        """
+        Compiles the patterns as a new base, dropping all other layers.
+
+        Args:
+            flags: per-pattern flag names (see HyperscanEngine.compile_patterns),
+                also accepted by add_patterns and sync_patterns
+        """
+        if ids is None:
+            ids = list(range(len(patterns)))
+        flags = _flag_tuples(flags, len(patterns))
+        with self._lock:
+            self._wait_merge()
+            internal = list(range(len(patterns)))
+            entries = list(zip(patterns, flags, internal))
+            base = self._compile(entries)
+            self._release(self._layers)
+            self._layers = [base]
+            self._layer_patterns = [entries]
+            self._next_id = len(patterns)
+            self._folded = 0
+            self._generation += 1
+            self._fixed = False
+            self._publish(list(ids))
+
+    def load_db(self, filename: str) -> None:
+        """
+        Loads a build artifact as the base. Its patterns are not stored in
+        the file, so the layers cannot be changed afterwards.
+        """
+        base = HyperscanEngine(**self._options)
+        base.load_db(filename)
+        with self._lock:
+            self._wait_merge()
+            self.som = base.som
+            self._release(self._layers)
+            self._layers = [base]
+            self._layer_patterns = [[]]
+            self._next_id = 0
+            self._folded = 0
+            self._generation += 1
+            self._fixed = True
+            self._state = _State(self._view(), [], True)
+
+    def add_patterns(self, patterns: List[bytes], ids: List[int], flags=None) -> None:
+        """Compiles patterns into a new delta layer; `ids` are their external ids"""
+        flags = _flag_tuples(flags, len(patterns))
+        with self._lock:
+            self._check_changeable()
+            self._add(patterns, flags, ids, list(self._state.external))
+        self._maybe_merge()
+
+    def remove_patterns(self, ids: Iterable[int]) -> None:
+        """Hides the patterns with these external ids (tombstones)"""
+        removed = set(ids)
+        with self._lock:
+            self._check_changeable()
+            external = [None if eid in removed else eid for eid in self._state.external]
+            self._publish(external)
+        self._maybe_merge()
+
+    def sync_patterns(self, patterns: List[bytes], ids: List[int] = None, flags=None) -> None:
+        """
+        Brings the layers up to date with a full pattern list (e.g.
+        FileRegex.elements() after some lines were added or deleted).
+
+        Patterns already compiled keep their layer and only get their new
+        external id, patterns no longer in the list get a tombstone and the
+        new ones are compiled into one delta layer. A pattern whose flags
+        changed counts as a new one.
+        """
+        if ids is None:
+            ids = list(range(len(patterns)))
+        if self._state is None:
+            self.compile_patterns(patterns, ids, flags)
+            return
+        flags = _flag_tuples(flags, len(patterns))
+        with self._lock:
+            self._check_changeable()
+            state = self._state
+            live = {}
+            for layer in self._layer_patterns:
+                for pattern, names, internal in layer:
+                    if state.external[internal] is not None:
+                        live.setdefault((pattern, names), []).append(internal)
+
+            external = [None] * len(state.external)
+            added, added_flags, added_ids = [], [], []
+            for pattern, names, eid in zip(patterns, flags, ids):
+                internals = live.get((pattern, names))
+                if internals:
+                    external[internals.pop()] = eid
+                else:
+                    added.append(pattern)
+                    added_flags.append(names)
+                    added_ids.append(eid)
+            if added:
+                self._add(added, added_flags, added_ids, external)
+            else:
+                self._publish(external)
+        self._maybe_merge()
+
+    def pending(self) -> int:
+        """Patterns in delta layers plus tombstones, what the next merge would fold in"""
+        state = self._state
+        if state is None:
+            return 0
+        deltas = sum(len(layer) for layer in self._layer_patterns[1:])
+        return deltas + state.external.count(None) - self._folded
+
+    def merge(self, wait: bool = True) -> None:
+        """
+        Compiles the live patterns of all current layers into a new base.
+
+        Runs in a background thread; with `wait` it returns when the new
+        base is in use. Layers added meanwhile stay on top of it.
+        """
+        with self._lock:
+            if self._merge_thread is None or not self._merge_thread.is_alive():
+                self._merge_thread = threading.Thread(target=self._merge, daemon=True)
+                self._merge_thread.start()
+            thread = self._merge_thread
+        if wait:
+            thread.join()
+
+    def _merge(self) -> None:
+        with self._lock:
+            state = self._state
+            if state is None or self._fixed:
+                return
+            generation = self._generation
+            merged = len(self._layers)
+            folded = state.external.count(None)
+            live = [entry for layer in self._layer_patterns for entry in layer
+                    if state.external[entry[2]] is not None]
+        # compiled without the lock, scans and changes go on meanwhile
+        base = self._compile(live)
+        with self._lock:
+            if generation != self._generation:
+                return
+            self._release(self._layers[:merged])
+            self._layers[:merged] = [base]
+            self._layer_patterns[:merged] = [live]
+            self._folded = folded
+            self._publish(self._state.external)
+
+    def _maybe_merge(self) -> None:
+        if self.pending() < self.merge_threshold:
+            return
+        self.merge(wait=not self.background_merge)
+
+    def _wait_merge(self) -> None:
+        """Waits for a running merge (called with the lock held)"""
+        thread = self._merge_thread
+        if thread is not None and thread.is_alive():
+            self._lock.release()
+            try:
+                thread.join()
+            finally:
+                self._lock.acquire()
+
+    def _check_changeable(self) -> None:
+        if self._state is None:
+            raise RuntimeError('Patterns Database is not compiled')
+        if self._fixed:
+            raise RuntimeError("The patterns of a loaded database cannot be changed")
+
+    def _add(self, patterns: List[bytes], flags: list, ids: List[int], external: list) -> None:
+        """Compiles a delta layer and publishes `external` extended by its ids (lock held)"""
+        if len(patterns) != len(ids):
+            raise ValueError("One id per pattern is needed")
+        internal = list(range(self._next_id, self._next_id + len(patterns)))
+        entries = list(zip(patterns, flags, internal))
+        layer = self._compile(entries)
+        self._next_id += len(patterns)
+        self._layers.append(layer)
+        self._layer_patterns.append(entries)
+        self._publish(external + list(ids))
+
+    def _compile(self, entries: list) -> HyperscanEngine:
+        """Layer of (pattern, flags, internal id) entries"""
+        layer = HyperscanEngine(**self._options)
+        if entries:
+            patterns, flags, internal = (list(column) for column in zip(*entries))
+            layer.compile_patterns(patterns, internal, flags if any(flags) else None)
+        return layer
+
+    @staticmethod
+    def _release(layers: List[HyperscanEngine]) -> None:
+        """
+        Frees the per-thread scratches (thread_scratch) of layers being
+        replaced (lock held). Scans still running on them clone new ones.
+        """
+        for layer in layers:
+            layer.release_scratches()
+
+    def _view(self) -> HyperscanEngine:
+        """Sharded engine over the compiled layers (empty ones cannot be scanned)"""
+        view = HyperscanEngine(**self._options)
+        view.som = self.som
+        view.shards = [layer for layer in self._layers if layer.db is not None or layer.shards]
+        return view
+
+    def _publish(self, external: list) -> None:
+        """Makes the current layers and ids visible to new scans (lock held)"""
+        identity = all(eid == internal for internal, eid in enumerate(external))
+        self._state = _State(self._view(), external, identity)
+
+    def _scan_state(self, callback: Callable):
+        """Engine and callback of one scan: ids translated, removed patterns dropped"""
+        state = self._state
+        if state is None:
+            raise RuntimeError('Patterns Database is not compiled')
+        if state.identity:
+            return state.view, callback
+        external = state.external
+
+        def translate(pattern_id, start, end, flags, context):
+            eid = external[pattern_id]
+            if eid is not None:
+                return callback(eid, start, end, flags, context)
+
+        return state.view, translate
+
+    def scan(self, data, callback, context=None):
+        view, callback = self._scan_state(callback)
+        if view.shards:
+            view.scan(data, callback, context=context)
+
+    def scan_stream(self, data_chunks, callback, context=None, scratch=None):
+        """
+        Args:
+            scratch: LayerScratch from new_scratch, brought up to date with
+                the layers of this scan
+        """
+        view, callback = self._scan_state(callback)
+        if not view.shards:
+            for _ in data_chunks:
+                pass
+            return
+        if isinstance(scratch, LayerScratch):
+            scratch = scratch.bind(view)
+        view.scan_stream(data_chunks, callback, context=context, scratch=scratch)
+
+    def scan_buffer(self, buffer, callback, context=None):
+        view, callback = self._scan_state(callback)
+        if view.shards:
+            view.scan_buffer(buffer, callback, context=context)
+
+    def new_scratch(self) -> LayerScratch:
+        """
+        Scratch spaces for scan_stream from another thread, one per layer.
+        Still valid after the layers change (see LayerScratch).
+        """
+        view, _ = self._scan_state(None)
+        scratch = LayerScratch()
+        scratch.bind(view)
+        return scratch
+
+    def max_match_width(self) -> Optional[int]:
+        if self._fixed:
+            return self._layers[0].max_match_width()
+        return max_match_width(self.patterns)
@@ -0,0 +1,345 @@
+import ctypes
+from collections import OrderedDict
+from typing import Any, Callable
+
+import hyperscan
+
+# The Python binding opens and scans streams but does not expose stream
+# compression or reset, so the C functions exported by its extension module
+# are called through ctypes. ctypes releases the GIL during the calls.
+_c_size_p = ctypes.POINTER(ctypes.c_size_t)
+_MATCH_HANDLER = ctypes.CFUNCTYPE(ctypes.c_int, ctypes.c_uint, ctypes.c_ulonglong, ctypes.c_ulonglong,
+                                  ctypes.c_uint, ctypes.c_void_p)
+_SIGNATURES = {
+    "hs_deserialize_database": (ctypes.c_char_p, ctypes.c_size_t, ctypes.POINTER(ctypes.c_void_p)),
+    "hs_free_database": (ctypes.c_void_p,),
+    "hs_alloc_scratch": (ctypes.c_void_p, ctypes.POINTER(ctypes.c_void_p)),
+    "hs_free_scratch": (ctypes.c_void_p,),
+    "hs_stream_size": (ctypes.c_void_p, _c_size_p),
+    "hs_open_stream": (ctypes.c_void_p, ctypes.c_uint, ctypes.POINTER(ctypes.c_void_p)),
+    "hs_scan_stream": (ctypes.c_void_p, ctypes.c_char_p, ctypes.c_uint, ctypes.c_uint, ctypes.c_void_p,
+                       _MATCH_HANDLER, ctypes.c_void_p),
+    "hs_close_stream": (ctypes.c_void_p, ctypes.c_void_p, _MATCH_HANDLER, ctypes.c_void_p),
+    "hs_reset_stream": (ctypes.c_void_p, ctypes.c_uint, ctypes.c_void_p, _MATCH_HANDLER, ctypes.c_void_p),
+    "hs_compress_stream": (ctypes.c_void_p, ctypes.c_char_p, ctypes.c_size_t, _c_size_p),
+    "hs_expand_stream": (ctypes.c_void_p, ctypes.POINTER(ctypes.c_void_p), ctypes.c_char_p, ctypes.c_size_t),
+    "hs_reset_and_expand_stream": (ctypes.c_void_p, ctypes.c_char_p, ctypes.c_size_t, ctypes.c_void_p,
+                                   _MATCH_HANDLER, ctypes.c_void_p),
+}
+# null match handler, used together with a null scratch (no matches reported)
+_NO_HANDLER = ctypes.cast(None, _MATCH_HANDLER)
+_lib = None
+# largest length of one hs_scan_stream call (unsigned int)
+_MAX_SCAN = 1 << 30
+
+
+def _hs():
+    """The Hyperscan C library of the binding, with argument types set"""
+    global _lib
+    if _lib is None:
+        lib = ctypes.CDLL(hyperscan._ext.__file__)
+        for name, argtypes in _SIGNATURES.items():
+            func = getattr(lib, name)
+            func.argtypes = argtypes
+            func.restype = ctypes.c_int
+        _lib = lib
+    return _lib
+
+
+def _check(err: int, what: str) -> None:
+    if err != hyperscan.HS_SUCCESS:
+        raise RuntimeError(f"{what} failed with Hyperscan error {err}")
+
+
+class StreamHandle:
+    """
+    One stream of a StreamPool.
+
+    A handle is live (has a Hyperscan stream) or suspended (only its
+    compressed state is kept). Suspended handles are resumed automatically
+    when they are fed again.
+    """
+    __slots__ = ("pool", "context", "_stream", "_state", "_closed")
+
+    def __init__(self, pool: "StreamPool", context: Any):
+        self.pool = pool
+        self.context = context
+        self._stream = None
+        self._state = None
+        self._closed = False
+
+    @property
+    def live(self) -> bool:
+        return self._stream is not None
+
+    @property
+    def closed(self) -> bool:
+        return self._closed
+
+    def feed(self, data) -> None:
+        """Scans the next part of the stream, matches go to the pool callback"""
+        self.pool.feed(self, data)
+
+    def state(self) -> bytes:
+        """Compressed stream state (the handle stays as it is), see StreamPool.open(state=...)"""
+        return self.pool.state(self)
+
+    def suspend(self) -> bytes:
+        """Compresses the stream and releases its Hyperscan stream; returns the state"""
+        return self.pool.suspend(self)
+
+    def reset(self) -> None:
+        """Reports matches at the end of data and starts the stream again at offset 0"""
+        self.pool.reset(self)
+
+    def close(self, report_end: bool = True) -> None:
+        """Ends the stream, reporting matches at the end of data unless report_end is False"""
+        self.pool.close(self, report_end=report_end)
+
+
+class StreamPool:
+    """
+    Many independent streams on one stream database.
+
+    HyperscanEngine.scan_stream consumes one stream from start to end. A
+    pool instead lets callers open thousands of streams (e.g. one per
+    connection), feed them in any order and close them independently.
+
+    - At most `max_live` streams hold a Hyperscan stream. When more are
+      fed, the least recently used one is suspended: its state is
+      compressed (hs_compress_stream, usually much smaller than the stream
+      size) and expanded again when it is fed next. This bounds the memory
+      of many idle streams.
+    - Released Hyperscan streams are reset and kept on a free list (up to
+      `max_free`) and reused by open and resume, instead of allocating a
+      new stream every time.
+
+    A pool has one scratch space, so it must be used from one thread at a
+    time (use one pool per thread).
+    """
+    MAX_LIVE = 1024
+    MAX_FREE = 256
+
+    def __init__(self, database: bytes, callback: Callable, max_live: int = None, max_free: int = None):
+        """
+        Args:
+            database: serialized stream database (hyperscan.dumpb), see
+                HyperscanEngine.stream_pool
+            callback: match handler called as
+                callback(pattern_id, start, end, flags, context) with the
+                context of the stream (StreamHandle.context); returning
+                True stops the stream, later feeds report no matches until
+                it is reset
+            max_live: streams kept live before the least recently used one
+                is suspended (default: MAX_LIVE, 0 suspends nothing)
+            max_free: released streams kept for reuse (default: MAX_FREE)
+        """
+        self.callback = callback
+        self.max_live = StreamPool.MAX_LIVE if max_live is None else max_live
+        self.max_free = StreamPool.MAX_FREE if max_free is None else max_free
+        self._lib = _hs()
+        self._db = ctypes.c_void_p()
+        self._scratch = ctypes.c_void_p()
+        self._live = OrderedDict()
+        self._free = []
+        self._current = None
+        self._error = None
+        # keeps the C callback alive as long as the pool
+        self._handler = _MATCH_HANDLER(self._on_match)
+
+        _check(self._lib.hs_deserialize_database(database, len(database), ctypes.byref(self._db)),
+               "hs_deserialize_database")
+        try:
+            _check(self._lib.hs_alloc_scratch(self._db, ctypes.byref(self._scratch)), "hs_alloc_scratch")
+            size = ctypes.c_size_t()
+            _check(self._lib.hs_stream_size(self._db, ctypes.byref(size)), "hs_stream_size")
+        except RuntimeError:
+            self._release_db()
+            raise
+        self.stream_size = size.value
+
+    @property
+    def live_count(self) -> int:
+        return len(self._live)
+
+    def _on_match(self, pattern_id, start, end, flags, context):
+        try:
+            # a callback returning True stops the scan, like in HyperscanEngine
+            return 1 if self.callback(pattern_id, start, end, flags, self._current.context) else 0
+        except BaseException as e:
+            self._error = e
+            return 1  # stops the scan
+
+    def _call(self, handle: StreamHandle, func, *args) -> bool:
+        """Calls a Hyperscan function that may report matches of `handle`; True if the callback stopped it"""
+        self._current = handle
+        try:
+            err = func(*args)
+        finally:
+            self._current = None
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise error
+        if err == hyperscan.HS_SCAN_TERMINATED:
+            return True
+        _check(err, func.__name__)
+        return False
+
+    def open(self, context: Any = None, state: bytes = None) -> StreamHandle:
+        """
+        Opens a stream.
+
+        Args:
+            context: passed to the callback with every match of this stream
+            state: compressed state (StreamHandle.state / suspend) to
+                continue from, created with the same database
+        """
+        handle = StreamHandle(self, context)
+        if state is None:
+            handle._stream = self._take_stream()
+            self._touch(handle)
+        else:
+            handle._state = bytes(state)
+        return handle
+
+    def feed(self, handle: StreamHandle, data) -> None:
+        """Scans the next part of a stream"""
+        self._resume(handle)
+        if type(data) is not bytes:
+            data = bytes(data)
+        for pos in range(0, len(data), _MAX_SCAN):
+            part = data[pos:pos + _MAX_SCAN] if len(data) > _MAX_SCAN else data
+            if self._call(handle, self._lib.hs_scan_stream, handle._stream, part, len(part), 0,
+                          self._scratch, self._handler, None):
+                break
+
+    def state(self, handle: StreamHandle) -> bytes:
+        """Compressed state of a stream, it can be opened again with open(state=...)"""
+        self._check_open(handle)
+        if handle._stream is None:
+            return handle._state
+        return self._compress(handle._stream)
+
+    def suspend(self, handle: StreamHandle) -> bytes:
+        """Compresses a live stream and gives its Hyperscan stream back to the pool"""
+        self._check_open(handle)
+        if handle._stream is not None:
+            handle._state = self._compress(handle._stream)
+            self._release(handle, report_end=False)
+        return handle._state
+
+    def reset(self, handle: StreamHandle) -> None:
+        """Reports the end-of-data matches of a stream and starts it again at offset 0"""
+        self._resume(handle)
+        self._call(handle, self._lib.hs_reset_stream, handle._stream, 0, self._scratch, self._handler, None)
+
+    def close(self, handle: StreamHandle, report_end: bool = True) -> None:
+        """Ends a stream; its Hyperscan stream is reset and reused"""
+        if handle._closed:
+            return
+        if report_end:
+            self._resume(handle)
+        if handle._stream is not None:
+            self._release(handle, report_end=report_end)
+        handle._state = None
+        handle._closed = True
+
+    def suspend_all(self) -> None:
+        """Suspends every live stream"""
+        for handle in list(self._live):
+            self.suspend(handle)
+
+    def destroy(self) -> None:
+        """Frees all streams, the scratch and the database; open handles become unusable"""
+        for handle in list(self._live):
+            self._lib.hs_close_stream(handle._stream, None, _NO_HANDLER, None)
+            handle._stream = None
+            handle._closed = True
+        self._live.clear()
+        for stream in self._free:
+            self._lib.hs_close_stream(stream, None, _NO_HANDLER, None)
+        self._free = []
+        if self._scratch:
+            self._lib.hs_free_scratch(self._scratch)
+            self._scratch = ctypes.c_void_p()
+        self._release_db()
+
+    def __del__(self):
+        try:
+            self.destroy()
+        except Exception:
+            pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.destroy()
+
+    def _release_db(self) -> None:
+        if self._db:
+            self._lib.hs_free_database(self._db)
+            self._db = ctypes.c_void_p()
+
+    def _check_open(self, handle: StreamHandle) -> None:
+        if handle._closed:
+            raise ValueError("Stream is closed")
+
+    def _touch(self, handle: StreamHandle) -> None:
+        """Marks a live stream as most recently used, suspending the oldest over max_live"""
+        self._live[handle] = None
+        self._live.move_to_end(handle)
+        while self.max_live and len(self._live) > self.max_live:
+            oldest = next(iter(self._live))
+            self.suspend(oldest)
+
+    def _resume(self, handle: StreamHandle) -> None:
+        """Makes a stream live, expanding its compressed state if it is suspended"""
+        self._check_open(handle)
+        if handle._stream is None:
+            state = handle._state
+            if self._free:
+                stream = self._free.pop()
+                err = self._lib.hs_reset_and_expand_stream(stream, state, len(state), None, _NO_HANDLER, None)
+                if err != hyperscan.HS_SUCCESS:
+                    self._lib.hs_close_stream(stream, None, _NO_HANDLER, None)
+                _check(err, "hs_reset_and_expand_stream")
+            else:
+                stream = ctypes.c_void_p()
+                _check(self._lib.hs_expand_stream(self._db, ctypes.byref(stream), state, len(state)),
+                       "hs_expand_stream")
+            handle._stream = stream
+            handle._state = None
+        self._touch(handle)
+
+    def _take_stream(self):
+        """A reset stream from the free list, or a new one"""
+        if self._free:
+            return self._free.pop()
+        stream = ctypes.c_void_p()
+        _check(self._lib.hs_open_stream(self._db, 0, ctypes.byref(stream)), "hs_open_stream")
+        return stream
+
+    def _release(self, handle: StreamHandle, report_end: bool) -> None:
+        """Takes the Hyperscan stream from a handle, resetting it for reuse"""
+        stream = handle._stream
+        handle._stream = None
+        self._live.pop(handle, None)
+        scratch, handler = (self._scratch, self._handler) if report_end else (None, _NO_HANDLER)
+        if len(self._free) < self.max_free:
+            self._free.append(stream)
+            self._call(handle, self._lib.hs_reset_stream, stream, 0, scratch, handler, None)
+        else:
+            self._call(handle, self._lib.hs_close_stream, stream, scratch, handler, None)
+
+    def _compress(self, stream) -> bytes:
+        size = max(self.stream_size, 64)
+        used = ctypes.c_size_t()
+        while True:
+            buf = ctypes.create_string_buffer(size)
+            err = self._lib.hs_compress_stream(stream, buf, size, ctypes.byref(used))
+            if err == hyperscan.HS_INSUFFICIENT_SPACE:
+                size = used.value
+                continue
+            _check(err, "hs_compress_stream")
+            return buf.raw[:used.value]
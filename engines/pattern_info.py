@@ -0,0 +1,242 @@
+import heapq
+import re
+from typing import List, Optional
+
+try:
+    from re import _parser as sre_parse
+    from re._constants import (ANY, AT, AT_BOUNDARY, BRANCH, IN, LITERAL, MAX_REPEAT, MAXREPEAT,
+                               MIN_REPEAT, SUBPATTERN)
+except ImportError:  # Python < 3.11
+    import sre_parse
+    from sre_constants import (ANY, AT, AT_BOUNDARY, BRANCH, IN, LITERAL, MAX_REPEAT, MAXREPEAT,
+                               MIN_REPEAT, SUBPATTERN)
+
+
+def pattern_width(pattern: bytes) -> Optional[int]:
+    """
+    Returns the maximum length in bytes of a match of `pattern`.
+
+    Uses the parser of the `re` module, so it understands the common subset
+    of Python and PCRE syntax. Returns None if the width is unbounded
+    (e.g. `a+`) or the pattern cannot be parsed.
+    """
+    try:
+        _, hi = sre_parse.parse(pattern).getwidth()
+    except Exception:
+        return None
+    if hi >= MAXREPEAT:
+        return None
+    return hi
+
+
+def max_match_width(patterns: List[bytes]) -> Optional[int]:
+    """Maximum match width of a pattern set, None if any pattern is unbounded"""
+    if not patterns:
+        return None
+
+    width = 0
+    for pattern in patterns:
+        w = pattern_width(pattern)
+        if w is None:
+            return None
+        width = max(width, w)
+    return width
+
+
+# bounded repeats count at most this many copies in pattern_cost
+_REPEAT_CAP = 4096
+
+
+def _cost(items) -> int:
+    """Estimated compile cost of a parsed sequence, see pattern_cost"""
+    cost = 0
+    for op, arg in items:
+        if op is LITERAL:
+            cost += 1
+        elif op is IN or op is ANY:
+            cost += 2
+        elif op is MAX_REPEAT or op is MIN_REPEAT:
+            lo, hi, sub = arg
+            # a bounded repeat is unrolled into `hi` copies, an unbounded one is a loop
+            copies = lo + 1 if hi >= MAXREPEAT else hi
+            cost += 2 + _cost(sub) * min(max(copies, 1), _REPEAT_CAP)
+        elif op is BRANCH:
+            cost += 1 + sum(_cost(branch) for branch in arg[1])
+        elif op is SUBPATTERN:
+            cost += _cost(arg[3])
+        else:
+            cost += 1
+    return cost
+
+
+def pattern_cost(pattern: bytes) -> int:
+    """
+    Rough estimate of how expensive a pattern is to compile (Hyperscan).
+
+    Counts the states of the parsed pattern: literals and character classes
+    plus every copy of a bounded repeat, so `PAT.{1000}END` costs far more
+    than `PAT.*END`. Patterns `re` cannot parse cost their length.
+    """
+    parsed = _parse(pattern)
+    if parsed is None:
+        return len(pattern)
+    return max(_cost(parsed), 1)
+
+
+def balance_shards(patterns: List[bytes], shards: int) -> List[List[int]]:
+    """
+    Splits patterns into `shards` groups of similar total pattern_cost.
+
+    Greedy: the most expensive patterns are placed first, each one into the
+    group with the lowest cost so far. Returns the pattern indexes of every
+    non-empty group, each in the original order.
+    """
+    groups = [[] for _ in range(max(min(shards, len(patterns)), 1))]
+    heap = [(0, shard) for shard in range(len(groups))]
+    costs = [pattern_cost(pattern) for pattern in patterns]
+    for index in sorted(range(len(patterns)), key=costs.__getitem__, reverse=True):
+        total, shard = heapq.heappop(heap)
+        groups[shard].append(index)
+        heapq.heappush(heap, (total + costs[index], shard))
+    return [sorted(group) for group in groups if group]
+
+
+def _parse(pattern):
+    """Parsed pattern, or None if `re` cannot parse it"""
+    try:
+        return sre_parse.parse(pattern)
+    except Exception:
+        return None
+
+
+def _literal(pattern, codes: List[int]):
+    """Turns character codes back into a str or bytes literal, same type as `pattern`"""
+    if isinstance(pattern, bytes):
+        return bytes(codes)
+    return "".join(map(chr, codes))
+
+
+def _flatten(items) -> list:
+    """Top-level items of a parsed pattern with plain groups `(...)` inlined"""
+    flat = []
+    for op, arg in items:
+        if op is SUBPATTERN and not arg[1] and not arg[2]:
+            flat.extend(_flatten(arg[3]))
+        else:
+            flat.append((op, arg))
+    return flat
+
+
+def _required(items, state, empty, max_len):
+    """Best (literals, min_offset, max_offset) of a parsed sequence, see required_literals"""
+    best = None
+    codes = []
+    lo = hi = 0
+    run_lo = run_hi = 0
+
+    def consider(literals, cand_lo, cand_hi):
+        nonlocal best
+        if cand_hi >= MAXREPEAT:
+            return
+        rank = (min(map(len, literals)), -len(literals), cand_lo - cand_hi, -cand_lo)
+        if best is None or rank > best[0]:
+            best = (rank, (literals, cand_lo, cand_hi))
+
+    for op, arg in _flatten(items) + [(None, None)]:
+        if op is LITERAL:
+            if not codes:
+                run_lo, run_hi = lo, hi
+            codes.append(arg)
+            lo += 1
+            hi += 1
+            continue
+
+        if codes:
+            consider([_literal(empty, codes[:max_len])], run_lo, run_hi)
+            codes = []
+        if op is None:
+            break
+        if op is BRANCH:
+            branches = [_required(branch, state, empty, max_len) for branch in arg[1]]
+            if all(branches):
+                consider([literal for branch in branches for literal in branch[0]],
+                         lo + min(branch[1] for branch in branches),
+                         hi + max(branch[2] for branch in branches))
+
+        item_lo, item_hi = sre_parse.SubPattern(state, [(op, arg)]).getwidth()
+        lo += item_lo
+        hi = min(hi + item_hi, MAXREPEAT)
+
+    return best[1] if best else None
+
+
+def required_literals(pattern, max_len: int = None):
+    """
+    Returns (literals, min_offset, max_offset): every match of `pattern`
+    contains one of `literals`, at a distance between the offsets from the
+    start of the match. The longest such literal is chosen; an alternation
+    gives one literal per branch. Returns None if there is no literal with a
+    bounded offset (e.g. `a|b`, `.*foo`) or the pattern is case-insensitive.
+
+    For `PAT\\d{3}.{100}END` this is (["PAT"], 0, 0), for `\\d{2,4}-ab`
+    (["-ab"], 2, 4) and for `(type1|kind1)\\d+` (["type1", "kind1"], 0, 0).
+    Literals are cut to `max_len` characters.
+    """
+    parsed = _parse(pattern)
+    if parsed is None or parsed.state.flags & re.IGNORECASE:
+        return None
+    return _required(parsed, parsed.state, pattern[:0], max_len)
+
+
+def boundary_word(pattern):
+    """
+    Returns `word` for a pattern of the form `\\bword\\b` where word consists
+    of word characters only, None otherwise.
+
+    Such a pattern matches exactly the runs of word characters equal to
+    `word`, so it can be found with a dictionary lookup per token.
+    """
+    parsed = _parse(pattern)
+    if parsed is None or parsed.state.flags & (re.IGNORECASE | re.ASCII | re.LOCALE):
+        return None
+
+    items = list(parsed)
+    if len(items) < 3 or items[0] != (AT, AT_BOUNDARY) or items[-1] != (AT, AT_BOUNDARY):
+        return None
+    if any(op is not LITERAL for op, _ in items[1:-1]):
+        return None
+
+    word = _literal(pattern, [arg for _, arg in items[1:-1]])
+    word_re = rb"\w+" if isinstance(word, bytes) else r"\w+"
+    return word if re.fullmatch(word_re, word) else None
+
+
+def trie_regex(literals):
+    """
+    Returns one regex source matching any of `literals` (all str or all bytes).
+
+    The alternation is factored by common prefixes, so `re` tries at most
+    one branch per distinct next character instead of every literal.
+    """
+    empty = literals[0][:0]
+
+    def text(s: str):
+        return s.encode("ascii") if isinstance(empty, bytes) else s
+
+    trie = {}
+    for literal in literals:
+        node = trie
+        for i in range(len(literal)):
+            node = node.setdefault(literal[i:i + 1], {})
+        node[None] = {}
+
+    def build(node):
+        branches = [re.escape(char) + build(node[char]) for char in sorted(k for k in node if k is not None)]
+        if not branches:
+            return empty
+        if len(branches) == 1 and None not in node:
+            return branches[0]
+        group = text("(?:") + text("|").join(branches) + text(")")
+        return group + text("?") if None in node else group
+
+    return build(trie)
@@ -1,123 +1,453 @@
+import heapq
 import re
+import weakref
+from collections import deque
 from .base_engine import RegexEngine
+from .pattern_info import boundary_word, required_literals, trie_regex
 from typing import List, Callable, Any, Iterable
 
 
+def _shard_worker(conn, shm, patterns: List[bytes], ids: List[int], overlap: int) -> None:
+    """
+    Worker process of a sharded PythonEngine: compiles one shard of the
+    patterns and scans every chunk broadcast through the shared memory.
+
+    Messages from the parent: ("chunk", offset, length), ("end",) closing
+    the current stream, ("stop",). After each chunk is scanned, and once
+    more at the end of the stream, the worker sends the matches found in the
+    meantime as a list of (start, end, pattern_id) sorted by offset.
+    """
+    engine = PythonEngine()
+    engine.compile_patterns(patterns, ids)
+    # same overlap in every shard, so all of them report the same offset range per chunk
+    engine.overlap = overlap
+    conn.send(len(engine.compiled_patterns))
+
+    matches = []
+
+    def callback(pattern_id, start, end, flags, context):
+        matches.append((start, end, pattern_id))
+
+    def send_matches():
+        matches.sort()
+        conn.send(matches[:])
+        matches.clear()
+
+    last = [None]
+
+    def chunks():
+        while True:
+            last[0] = conn.recv()
+            if last[0][0] != "chunk":
+                return
+            _, offset, length = last[0]
+            yield bytes(shm.buf[offset:offset + length])
+            send_matches()
+
+    while conn.recv()[0] == "start":
+        if engine.compiled_patterns:
+            engine.scan_stream(chunks(), callback)
+        else:
+            for _ in chunks():
+                pass
+        if last[0][0] == "stop":
+            break
+        send_matches()
+    shm.close()
+
+
+def _stop_shards(workers, shm) -> None:
+    """Stops the worker processes and frees the shared memory"""
+    for process, conn in workers:
+        try:
+            conn.send(("stop",))
+        except OSError:
+            pass
+    for process, conn in workers:
+        process.join(timeout=5)
+        if process.is_alive():
+            process.terminate()
+        conn.close()
+    shm.close()
+    shm.unlink()
+
+
 class PythonEngine(RegexEngine):
-    
-    def __init__(self):
+    """
+    Pure-Python fallback engine built on the `re` module.
+
+    Instead of one pass over the text per pattern, patterns are sorted into
+    groups that are scanned together:
+
+    - `\\bword\\b` patterns: the text is split into word tokens once and
+      every token is looked up in a dictionary,
+    - patterns containing a required literal (`PAT000123` in
+      `PAT000123.{100}END`, `-ab` in `\\d{2,4}-ab`, one of `type1`/`kind1`
+      in `(type1|kind1)\\d+`): one combined alternation of all literals
+      (factored like a trie) finds their occurrences, then the patterns
+      owning a literal are matched only at the few start positions its
+      offset allows,
+    - all others are searched one by one.
+
+    Patterns and data are bytes (no decoding), so offsets are byte offsets
+    like in HyperscanEngine and `\\w`, `\\b` are ASCII-only.
+    """
+    WORD_RE = re.compile(rb"\b\w+")
+    # shorter literals hit too often to be worth the lookup
+    LITERAL_MIN = 2
+    LITERAL_MAX = 8
+    # most start positions tried per literal hit
+    LITERAL_WINDOW = 64
+    # stream overlap used when the match width of the patterns is unbounded
+    MAX_OVERLAP = 64 * 1024
+    # bytes kept around the overlap for \b, ^, $ and lookarounds
+    CONTEXT = 64
+    # sharded mode: shared memory slots for chunks in flight, bytes per slot
+    SHARD_SLOTS = 2
+    SHARD_SLOT_SIZE = 4 * 1024 * 1024
+    # per-pattern flags as inline `re` flags; prefilter (exact matches are
+    # valid prefilter matches), allowempty, utf8 and ucp need nothing
+    INLINE_FLAGS = {"caseless": b"i", "dotall": b"s", "multiline": b"m"}
+
+    def __init__(self, shards: int = 0):
+        """
+        Args:
+            shards: If 2 or more, the patterns are split into this many
+                shards, each compiled and scanned by its own worker process
+                (see compile_patterns). Matches are then reported in offset
+                order.
+        """
+        self.shards = shards
+        self._workers = []
+        self._shm = None
+        self._finalizer = None
         self.compiled_patterns = []
         self.patterns = []
-    
-    def compile_patterns(self, patterns: List[bytes], ids: List[int] = None) -> None:
-        self.patterns = patterns
+        self.words = {}
+        self.literals = {}
+        self.literal_lengths = []
+        self.literal_re = None
+        self.literal_reach = 0
+        self.others = []
+        self.overlap = 0
+        # ids reported only once per scan (singlematch flag)
+        self.single = frozenset()
+
+    def __getstate__(self):
+        # worker processes stay with the engine that started them, a copy
+        # (e.g. sent to a Pool worker) scans without shards
+        state = self.__dict__.copy()
+        state.update(shards=0, _workers=[], _shm=None, _finalizer=None)
+        return state
+
+    def compile_patterns(self, patterns: List[bytes], ids: List[int] = None, flags=None) -> None:
+        """
+        Args:
+            flags: per-pattern flag names, see INLINE_FLAGS; singlematch
+                patterns are reported once per scan
+        """
+        self.close()
         self.compiled_patterns = []
-        
+        self.words = {}
+        self.literals = {}
+        self.others = []
+
         if ids is None:
             ids = list(range(len(patterns)))
-        
+        self.single = frozenset()
+        if flags is not None:
+            patterns = [self._with_flags(pattern, names) for pattern, names in zip(patterns, flags)]
+            self.single = frozenset(pattern_id for pattern_id, names in zip(ids, flags) if "singlematch" in names)
+        self.patterns = patterns
+
+        if self.shards > 1:
+            self._start_shards(patterns, ids)
+            return
+
         for pattern_id, pattern_bytes in zip(ids, patterns):
             try:
-                pattern_str = pattern_bytes.decode('utf-8')
-                compiled = re.compile(pattern_str)
-                self.compiled_patterns.append({
+                compiled = re.compile(pattern_bytes)
+                pattern_info = {
                     'id': pattern_id,
                     'pattern': compiled,
                     'original': pattern_bytes
-                })
+                }
+                self.compiled_patterns.append(pattern_info)
             except re.error as e:
                 print(f"Warning: Invalid regex pattern '{pattern_bytes}': {e}")
-    
-    def scan(self, data: bytes, callback: Callable) -> None:
-        
-        if not self.compiled_patterns:
-            raise RuntimeError('Patterns Database is not compiled')
-        
+                continue
+
+            word = boundary_word(pattern_bytes)
+            if word is not None:
+                self.words.setdefault(word, []).append(pattern_id)
+                continue
+            factor = required_literals(pattern_bytes, PythonEngine.LITERAL_MAX)
+            if (factor is not None and min(map(len, factor[0])) >= PythonEngine.LITERAL_MIN
+                    and factor[2] - factor[1] < PythonEngine.LITERAL_WINDOW):
+                literals, min_offset, max_offset = factor
+                index = len(self.compiled_patterns) - 1
+                for literal in set(literals):
+                    self.literals.setdefault(literal, []).append((index, pattern_info, min_offset, max_offset))
+            else:
+                self.others.append(pattern_info)
+
+        self.literal_lengths = sorted({len(literal) for literal in self.literals})
+        self.literal_reach = max((entry[3] for entries in self.literals.values() for entry in entries), default=0)
+        self.literal_re = None
+        if self.literals:
+            self.literal_re = re.compile(b"(?=" + trie_regex(list(self.literals)) + b")")
+
+        width = self.max_match_width()
+        self.overlap = PythonEngine.MAX_OVERLAP if width is None else width
+
+    @staticmethod
+    def _with_flags(pattern: bytes, names) -> bytes:
+        """Pattern with its flags as an inline group, e.g. `(?i)abc` for caseless"""
+        inline = b"".join(PythonEngine.INLINE_FLAGS[name] for name in names if name in PythonEngine.INLINE_FLAGS)
+        return b"(?" + inline + b")" + pattern if inline else pattern
+
+    def _single_match(self, callback: Callable) -> Callable:
+        """Callback of one scan that drops repeated matches of singlematch patterns"""
+        if not self.single:
+            return callback
+        single = self.single
+        seen = set()
+
+        def report(pattern_id, start, end, flags, context):
+            if pattern_id in single:
+                if pattern_id in seen:
+                    return None
+                seen.add(pattern_id)
+            return callback(pattern_id, start, end, flags, context)
+
+        return report
+
+    def _start_shards(self, patterns: List[bytes], ids: List[int]) -> None:
+        """
+        Starts one worker process per shard. Patterns are dealt round-robin,
+        so every shard gets a similar mix of cheap (words, literals) and
+        expensive patterns. All shards use the overlap of the whole set.
+        """
+        # imported here, so the single-process engine starts faster
+        import multiprocessing
+        from multiprocessing import shared_memory
+
+        width = self.max_match_width()
+        self.overlap = PythonEngine.MAX_OVERLAP if width is None else width
+        self._shm = shared_memory.SharedMemory(create=True,
+                                               size=PythonEngine.SHARD_SLOTS * PythonEngine.SHARD_SLOT_SIZE)
+        self._finalizer = weakref.finalize(self, _stop_shards, self._workers, self._shm)
+
+        for shard in range(min(self.shards, max(len(patterns), 1))):
+            parent_conn, child_conn = multiprocessing.Pipe()
+            process = multiprocessing.Process(
+                target=_shard_worker,
+                args=(child_conn, self._shm, patterns[shard::self.shards], ids[shard::self.shards], self.overlap),
+                daemon=True,
+            )
+            process.start()
+            child_conn.close()
+            self._workers.append((process, parent_conn))
+
+        compiled = sum(self._receive(conn) for _, conn in self._workers)
+        if not compiled:
+            self.close()
+            return
+        # scan and scan_stream only check that something was compiled
+        self.compiled_patterns = [None] * compiled
+
+    @staticmethod
+    def _receive(conn):
         try:
-            text = data.decode('utf-8', errors='ignore')
-        except Exception:
-            text = str(data)
-    
-        for pattern_info in self.compiled_patterns:
+            return conn.recv()
+        except EOFError:
+            raise RuntimeError("PythonEngine shard worker exited")
+
+    def close(self) -> None:
+        """Stops the shard worker processes, if any"""
+        if self._finalizer is not None:
+            self._finalizer()
+        self._finalizer = None
+        self._workers = []
+        self._shm = None
+
+    def _scan_shards(self, data_chunks: Iterable[bytes], callback: Callable, context: Any) -> None:
+        """
+        Broadcasts the chunks to all shards and reports their matches merged
+        in offset order.
+
+        Chunks are copied into SHARD_SLOTS shared memory slots (bigger ones
+        are split), so the next chunk is written while the shards scan the
+        previous one. The matches of a chunk are reported once every shard
+        has finished it. After a callback returned True no more chunks are
+        sent and the matches still in flight are dropped.
+        """
+        conns = [conn for _, conn in self._workers]
+        size = PythonEngine.SHARD_SLOT_SIZE
+        in_flight = deque()
+        stopped = False
+
+        def report_oldest():
+            nonlocal stopped
+            in_flight.popleft()
+            for start, end, pattern_id in heapq.merge(*[self._receive(conn) for conn in conns]):
+                if not stopped and callback(pattern_id, start, end, 0, context):
+                    stopped = True
+
+        try:
+            for conn in conns:
+                conn.send(("start",))
+
+            slot = 0
+            for chunk in data_chunks:
+                if stopped:
+                    break
+                view = memoryview(chunk).cast("B")
+                for pos in range(0, len(view), size):
+                    if stopped:
+                        break
+                    piece = view[pos:pos + size]
+                    if len(in_flight) == PythonEngine.SHARD_SLOTS:
+                        report_oldest()
+                    offset = slot * size
+                    self._shm.buf[offset:offset + len(piece)] = piece
+                    for conn in conns:
+                        conn.send(("chunk", offset, len(piece)))
+                    in_flight.append(slot)
+                    slot = (slot + 1) % PythonEngine.SHARD_SLOTS
+
+            for conn in conns:
+                conn.send(("end",))
+            # one more message per shard: the matches found at the end of the stream
+            in_flight.append(None)
+            while in_flight:
+                report_oldest()
+        except BaseException:
+            # the shards are in the middle of a stream and cannot be reused
+            self.close()
+            self.compiled_patterns = []
+            raise
+
+    def _matches(self, data: bytes, lo: int = 0, hi: int = None) -> Iterable[tuple]:
+        """
+        Yields (pattern_id, start, end) for every pattern and every start
+        position in [lo, hi) where it matches, with the same end as
+        `pattern.match(data, start)`. Bytes before `lo` are only context.
+        """
+        if hi is None:
+            hi = len(data)
+
+        if self.words:
+            for token in PythonEngine.WORD_RE.finditer(data, lo):
+                if token.start() >= hi:
+                    break
+                for pattern_id in self.words.get(token.group(), ()):
+                    yield pattern_id, token.start(), token.end()
+
+        if self.literal_re is not None:
+            # first start position not tried yet, per pattern; literal hits
+            # come in order, so windows of one pattern never go back
+            tried = {}
+            for hit in self.literal_re.finditer(data, lo):
+                pos = hit.start()
+                if pos >= hi + self.literal_reach:
+                    break
+                for length in self.literal_lengths:
+                    if pos + length > len(data):
+                        break
+                    for index, pattern_info, min_offset, max_offset in self.literals.get(data[pos:pos + length], ()):
+                        first = max(pos - max_offset, tried.get(index, lo))
+                        last = min(pos - min_offset, hi - 1)
+                        for start in range(first, last + 1):
+                            match = pattern_info['pattern'].match(data, start)
+                            if match:
+                                yield pattern_info['id'], start, match.end()
+                        tried[index] = max(last + 1, first)
+
+        for pattern_info in self.others:
             # Find all overlapping matches by starting search from each position
-            pos = 0
-            while pos < len(text):
-                match = pattern_info['pattern'].search(text, pos)
-                if match:
-                    callback(
-                        pattern_info['id'],  
-                        match.start(),        
-                        match.end(),         
-                        0,            # flags        
-                        None                  
-                    )
-                    # Move forward by 1 to find overlapping matches
-                    pos = match.start() + 1
-                else:
+            pos = lo
+            while pos < hi:
+                match = pattern_info['pattern'].search(data, pos)
+                if not match or match.start() >= hi:
                     break
+                yield pattern_info['id'], match.start(), match.end()
+                # Move forward by 1 to find overlapping matches
+                pos = match.start() + 1
+
+    def scan(self, data: bytes, callback: Callable) -> None:
+
+        if not self.compiled_patterns:
+            raise RuntimeError('Patterns Database is not compiled')
+
+        callback = self._single_match(callback)
+        if self._workers:
+            self._scan_shards([data], callback, None)
+            return
+
+        if type(data) is not bytes:
+            data = bytes(data)
+
+        for pattern_id, start, end in self._matches(data):
+            if callback(
+                pattern_id,
+                start,
+                end,
+                0,            # flags
+                None
+            ):
+                return
+
     def scan_stream(self, data_chunks: Iterable[bytes], callback: Callable, context: Any = None) -> None:
         """
         Scan data in streaming mode, processing each chunk individually.
-        Uses an overlap buffer to catch matches that span chunk boundaries.
+
+        Each chunk is appended to the unscanned tail of the previous ones and
+        matches are reported for the start positions up to `overlap` +
+        CONTEXT bytes before the end of the buffer, where `overlap` is the
+        maximum match width of the patterns. A match starting there ends
+        inside the buffer, so it is found exactly as in the whole data. Only
+        the bytes after that point (plus CONTEXT bytes before it) are carried
+        to the next chunk, so every start position is searched once. Small
+        chunks are collected until the new part is at least as long as the
+        carried one.
+
+        With unbounded patterns (`a+`, `.*`) matches longer than MAX_OVERLAP
+        may be cut at a chunk boundary. A callback returning True stops the
+        scan, the remaining chunks are not read.
         """
         if not self.compiled_patterns:
             raise RuntimeError('Patterns Database is not compiled')
-        
-        # Buffer to store overlap from previous chunk
-        overlap_buffer = b''
-        total_offset = 0
-        #fix
-        overlap_size = 50240  # Size of overlap to retain between chunks
-        # Track reported matches to avoid duplicates
-        
+
+        callback = self._single_match(callback)
+        if self._workers:
+            self._scan_shards(data_chunks, callback, context)
+            return
+
+        tail = PythonEngine.CONTEXT
+        keep = self.overlap + tail
+        buffer = b''
+        base = 0    # offset of buffer[0] in the stream
+        lo = 0      # first start position in buffer not scanned yet
+
         for chunk in data_chunks:
-            # Combine overlap from previous chunk with current chunk
-            combined = overlap_buffer + chunk
-            
-            try:
-                text = combined.decode('utf-8', errors='ignore')
-            except Exception:
-                text = str(combined)
-            
-            # Determine the offset adjustment for this chunk
-            chunk_start_offset = total_offset - len(overlap_buffer)
-            
-            # Scan the combined text
-            for pattern_info in self.compiled_patterns:
-                # Find all overlapping matches by starting search from each position
-                pos = 0
-                while pos < len(text):
-                    match = pattern_info['pattern'].search(text, pos)
-                    if match:
-                        # Adjust match positions to global offsets
-                        match_start = chunk_start_offset + match.start()
-                        match_end = chunk_start_offset + match.end()
-                         # Create unique key for this match
-                       
-                        # Only report matches that are in the "new" part of the chunk
-                        # (not in the overlap region, to avoid duplicates)
-                        
-                            
-                        if match.start() >= len(overlap_buffer) or total_offset == 0:
-                                callback(
-                                    pattern_info['id'],
-                                    match_start,
-                                    match_end,
-                                    0,  # flags
-                                    context
-                            )
-                            
-                        # Move forward by 1 to find overlapping matches
-                        pos = match.start() + 1
-                    else:
-                        break
-            
-            # Update offset and prepare overlap for next iteration
-            total_offset += len(chunk)
-            
-            # Keep the last part of the chunk as overlap for next iteration
-            if len(combined) > overlap_size:
-                overlap_buffer = combined[-overlap_size:]
-            else:
-                overlap_buffer = combined
-            
\ No newline at end of file
+            buffer = buffer + chunk
+            hi = len(buffer) - keep
+            # searches may read up to `keep` bytes past hi, so small chunks
+            # are collected until that is no more than the new part
+            if hi - lo < keep:
+                continue
+
+            for pattern_id, start, end in self._matches(buffer, lo, hi):
+                if callback(pattern_id, base + start, base + end, 0, context):
+                    return
+
+            # keep CONTEXT bytes before the next start position
+            cut = max(hi - tail, 0)
+            buffer = buffer[cut:]
+            base += cut
+            lo = hi - cut
+
+        for pattern_id, start, end in self._matches(buffer, lo):
+            if callback(pattern_id, base + start, base + end, 0, context):
+                return
@@ -1,10 +1,60 @@
+import mmap
 import os
-from typing import Iterable
+import time
+from contextlib import contextmanager
+from typing import BinaryIO, Iterable, Iterator, Union
+
+
+class ChunkTuner:
+    """
+    Adjusts the chunk size of a reader from the measured throughput.
+
+    Every WINDOW chunks the throughput of the whole pipeline (reading plus
+    whatever the consumer does between chunks) is measured. The chunk size
+    is doubled while that makes it at least 10% faster, and goes back one
+    step (and stays there) once it makes it slower.
+    """
+    WINDOW = 8
+
+    def __init__(self, chunk_size: int, max_size: int):
+        self.chunk_size = chunk_size
+        self.max_size = max_size
+        self.tuning = True
+        self._best = 0.0
+        self._bytes = 0
+        self._count = 0
+        self._started = time.perf_counter()
+
+    def update(self, nbytes: int) -> int:
+        """Records a consumed chunk and returns the chunk size for the next read"""
+        if not self.tuning:
+            return self.chunk_size
+
+        self._bytes += nbytes
+        self._count += 1
+        if self._count < ChunkTuner.WINDOW:
+            return self.chunk_size
+
+        now = time.perf_counter()
+        rate = self._bytes / max(now - self._started, 1e-9)
+        self._bytes = 0
+        self._count = 0
+        self._started = now
+
+        if rate > self._best * 1.1 and self.chunk_size < self.max_size:
+            self._best = rate
+            self.chunk_size = min(self.chunk_size * 2, self.max_size)
+        else:
+            if rate < self._best * 0.9:
+                self.chunk_size //= 2
+            self.tuning = False
+        return self.chunk_size
 
 
 class FileReader:
     """Class for validating file paths and reading files in binary chunks"""
-    CHUNK_SIZE = 4096
+    CHUNK_SIZE = 256 * 1024
+    MAX_CHUNK_SIZE = 4 * 1024 * 1024
 
     @staticmethod
     def validate(file_path: str):
@@ -14,6 +64,19 @@ class FileReader:
         if not os.path.isfile(file_path):
             raise ValueError(f"{file_path} is not a file")
 
+    @staticmethod
+    def chunk_size_for(file_size: int) -> int:
+        """
+        Chunk size suited to a file of `file_size` bytes.
+
+        Small files are read with one call, bigger ones in about 16 chunks
+        rounded up to a power of two, between CHUNK_SIZE and MAX_CHUNK_SIZE.
+        """
+        if file_size <= FileReader.CHUNK_SIZE:
+            return max(file_size, 1)
+        size = 1 << (file_size // 16 - 1).bit_length()
+        return max(FileReader.CHUNK_SIZE, min(size, FileReader.MAX_CHUNK_SIZE))
+
     @staticmethod
     def chunks(file_path: str, chunk_size: int = None, full_file: bool = False) -> Iterable[bytes]:
         """
@@ -51,3 +114,140 @@ class FileReader:
                     if not chunk:
                         break
                     yield chunk
+
+    @staticmethod
+    def range_chunks(file_path: str, start: int, stop: int, chunk_size: int = None) -> Iterable[bytes]:
+        """
+        Yield bytes [start, stop) of a file in binary chunks.
+
+        Args:
+            file_path (str):
+                Path to the file that should be read.
+            start (int):
+                Offset of the first byte to read.
+            stop (int):
+                Offset just past the last byte to read (clamped to the file size).
+            chunk_size (int, optional):
+                Size of each chunk in bytes (default: `FileReader.CHUNK_SIZE`).
+        """
+
+        FileReader.validate(file_path)
+
+        if chunk_size is None:
+            chunk_size = FileReader.CHUNK_SIZE
+
+        with open(file_path, "rb") as f:
+            f.seek(start)
+            remaining = stop - start
+            while remaining > 0:
+                chunk = f.read(min(chunk_size, remaining))
+                if not chunk:
+                    break
+                remaining -= len(chunk)
+                yield chunk
+
+    @staticmethod
+    @contextmanager
+    def mapped(file_path: str) -> Iterator[memoryview]:
+        """
+        Memory-map a whole file read-only.
+
+        Yields a memoryview over the mapping, so the file costs no heap and
+        no copy; the pages are loaded by the OS on access. Empty files (which
+        cannot be mapped) give an empty view.
+
+        Args:
+            file_path (str):
+                Path to the file that should be mapped.
+        """
+
+        FileReader.validate(file_path)
+
+        with open(file_path, "rb") as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                yield memoryview(b"")
+                return
+
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                yield memoryview(mm)
+            finally:
+                try:
+                    mm.close()
+                except BufferError:
+                    # a consumer still holds a slice, the mapping is closed by GC
+                    pass
+
+    @staticmethod
+    def mmap_chunks(file_path: str, chunk_size: int = None) -> Iterable[memoryview]:
+        """
+        Yield file content as memoryview slices of a read-only mapping.
+
+        Same contract as `chunks`, but no chunk is copied. The slices stay
+        valid while they are referenced.
+
+        Args:
+            file_path (str):
+                Path to the file that should be read.
+            chunk_size (int, optional):
+                Size of each chunk in bytes (default: `FileReader.CHUNK_SIZE`).
+        """
+
+        if chunk_size is None:
+            chunk_size = FileReader.CHUNK_SIZE
+
+        with FileReader.mapped(file_path) as view:
+            for start in range(0, len(view), chunk_size):
+                yield view[start:start + chunk_size]
+
+    @staticmethod
+    def buffered_chunks(source: Union[str, BinaryIO], chunk_size: int = None, pool_size: int = 4,
+                        adaptive: bool = False) -> Iterable[memoryview]:
+        """
+        Yield content read with readinto into a small pool of reused buffers.
+
+        Works with anything that has readinto (files, pipes, sockets via
+        makefile("rb"), sys.stdin.buffer), also where mmap is not possible.
+        No buffer is allocated per read: each chunk is a memoryview of one of
+        `pool_size` preallocated bytearrays, so it is overwritten after
+        `pool_size` more chunks. Consumers that keep data longer must copy it.
+
+        Args:
+            source (str | BinaryIO):
+                Path of a regular file, or an open binary stream (left open).
+            chunk_size (int, optional):
+                Size of each chunk in bytes. By default `chunk_size_for` the
+                file size, or `FileReader.CHUNK_SIZE` for streams.
+            pool_size (int, optional):
+                Number of buffers in the pool (default: 4).
+            adaptive (bool, optional):
+                If True, tune the chunk size from the measured throughput
+                (see ChunkTuner).
+        """
+
+        if isinstance(source, (str, os.PathLike)):
+            FileReader.validate(source)
+            if chunk_size is None:
+                chunk_size = FileReader.chunk_size_for(os.path.getsize(source))
+            with open(source, "rb", buffering=0) as f:
+                yield from FileReader.buffered_chunks(f, chunk_size, pool_size, adaptive)
+            return
+
+        if chunk_size is None:
+            chunk_size = FileReader.CHUNK_SIZE
+        tuner = ChunkTuner(chunk_size, FileReader.MAX_CHUNK_SIZE) if adaptive else None
+
+        pool = [bytearray(chunk_size) for _ in range(pool_size)]
+        index = 0
+        while True:
+            buf = pool[index]
+            if len(buf) < chunk_size:
+                buf = pool[index] = bytearray(chunk_size)
+            with memoryview(buf) as view:
+                n = source.readinto(view[:chunk_size])
+            if not n:
+                break
+            yield memoryview(buf)[:n]
+            index = (index + 1) % pool_size
+            if tuner is not None:
+                chunk_size = tuner.update(n)
@@ -1,38 +1,87 @@
+from file_regex.pattern_store import PatternStore
+
+
+def strip_comment(text):
+    """
+    Returns the pattern of a line, without a comment after a comma.
+
+    Only a comma outside of `{m,n}`, `[...]` and `(...)` that is not
+    escaped starts the comment, so `PAT.{1000,1000}END` is kept whole and
+    `abc, note` gives `abc`. A literal comma in a pattern is written `\\,`.
+    """
+    depth = 0
+    i = 0
+    while i < len(text):
+        char = text[i]
+        if char == "\\":
+            i += 1
+        elif char == "[":
+            # skip the class; `]` right after `[` or `[^` is a literal
+            i += 2 if text[i + 1:i + 2] == "^" else 1
+            if text[i:i + 1] == "]":
+                i += 1
+            while i < len(text) and text[i] != "]":
+                i += 2 if text[i] == "\\" else 1
+        elif char in "({":
+            depth += 1
+        elif char in ")}":
+            depth = max(depth - 1, 0)
+        elif char == "," and depth == 0:
+            return text[:i].strip()
+        i += 1
+    return text
+
+
 class FileRegex():
     def __init__(self, filename):
         self.plik = filename
         open(self.plik, "a", encoding="utf-8").close()
+        self._store = None
+
+    @property
+    def store(self) -> PatternStore:
+        """PatternStore of the file (index and stable ids), read on first use"""
+        if self._store is None:
+            self._store = PatternStore(self.plik)
+        return self._store
+
     def add_element(self,text):
-        if not self.exist(text):
-            with open(self.plik, "a", encoding="utf-8") as f:
-                f.write(text.strip() + "\n")
+        self.store.add([text])
 
     def delete_element(self,text):
-        with open(self.plik, "r", encoding="utf-8") as f:
-            lines = f.readlines()
-
-        with open(self.plik, "w", encoding="utf-8") as f:
-            for line in lines:
-                if line.strip() != text.strip():
-                    f.write(line)
+        self.store.delete([text])
         return
+
+    def add_elements(self, texts):
+        """Adds many patterns with one append to the file"""
+        return self.store.add(texts)
+
+    def delete_elements(self, texts):
+        """Deletes many patterns with one atomic rewrite of the file"""
+        return self.store.delete(texts)
+
     def choose_elements(self):
         pass
     def exist(self,text):
-        with open(self.plik, "r",encoding="utf-8") as f:
-            for line in f:
-                if line.strip()==text:
-                    return True
-        return False
+        self.store.refresh()
+        return text in self.store
     def elements(self):
         patterns=[] #then correct it in choose_elements
-        with open(self.plik, "r",encoding="utf-8") as f:
-            for line in f:
-                text = line.strip()
-                if text:
-                    before_comma = text.split(",", 1)[0].strip()
-                    # print(before_comma)
-                    patterns.append(before_comma)
+        if self._store is not None or PatternStore.has_ids(self.plik):
+            # same lines as ids()
+            self.store.refresh()
+            lines = self.store.patterns()
+        else:
+            with open(self.plik, "r",encoding="utf-8") as f:
+                lines = f.readlines()
+        for line in lines:
+            text = line.strip()
+            if text:
+                patterns.append(strip_comment(text))
         return patterns
 
- 
\ No newline at end of file
+    def ids(self):
+        """Stable ids of elements() if the file has a PatternStore sidecar, otherwise None (line numbers)"""
+        if self._store is None and not PatternStore.has_ids(self.plik):
+            return None
+        return self.store.ids()
@@ -0,0 +1,129 @@
+"""
+Structured pattern files: JSON lines with one pattern per line.
+
+    {"format": "nokia-patterns", "version": 1}
+    {"id": 7, "expression": "PAT000000.{1000,1000}END000000", "flags": ["singlematch"], "tags": ["bounded"]}
+    {"expression": "error: .*timeout", "flags": ["caseless"]}
+
+The header line is optional; if present its version must be VERSION.
+"expression" is required. "id" defaults to the position of the pattern
+in the file and must be unique. "flags" are names from FLAGS, "tags" are
+free strings kept for tooling. Unknown keys are ignored.
+"""
+import json
+from typing import Iterator, List, NamedTuple, Optional, Tuple
+
+from file_regex.file_regex import FileRegex
+
+FORMAT = "nokia-patterns"
+VERSION = 1
+
+# per-pattern flags; engines map them to their own (see HyperscanEngine.FLAG_BITS)
+FLAGS = ("caseless", "dotall", "multiline", "singlematch", "prefilter", "allowempty", "utf8", "ucp")
+
+
+class PatternSpec(NamedTuple):
+    """One pattern of a structured pattern file"""
+    id: int
+    expression: str
+    flags: Tuple[str, ...] = ()
+    tags: Tuple[str, ...] = ()
+
+
+def is_pattern_jsonl(filename: str) -> bool:
+    """True if the file is a structured pattern file (its first non-empty line is a JSON object)"""
+    try:
+        with open(filename, "r", encoding="utf-8") as f:
+            for line in f:
+                line = line.strip()
+                if line:
+                    break
+            else:
+                return False
+    except (OSError, UnicodeDecodeError):
+        return False
+    if not line.startswith("{"):
+        return False
+    try:
+        first = json.loads(line)
+    except ValueError:
+        return False
+    # any object, so a line without "expression" is reported by read_patterns instead of
+    # being compiled as a regex
+    return isinstance(first, dict)
+
+
+def read_patterns(filename: str) -> Iterator[PatternSpec]:
+    """
+    Parses a structured pattern file line by line.
+
+    Raises:
+        ValueError: for an invalid line (with its line number), an unknown
+            flag, an unsupported version or a duplicate id
+    """
+    seen = set()
+    position = 0
+    with open(filename, "r", encoding="utf-8") as f:
+        for number, line in enumerate(f, 1):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                entry = json.loads(line)
+            except ValueError as e:
+                raise ValueError(f"{filename}:{number}: invalid JSON: {e}") from None
+            if not isinstance(entry, dict):
+                raise ValueError(f"{filename}:{number}: expected a JSON object")
+
+            if "format" in entry:
+                if entry["format"] != FORMAT or entry.get("version") != VERSION:
+                    raise ValueError(f"{filename}:{number}: unsupported pattern file "
+                                     f"{entry['format']!r} version {entry.get('version')!r}")
+                continue
+
+            spec = _spec(entry, position, f"{filename}:{number}")
+            if spec.id in seen:
+                raise ValueError(f"{filename}:{number}: duplicate id {spec.id}")
+            seen.add(spec.id)
+            position += 1
+            yield spec
+
+
+def _spec(entry: dict, position: int, where: str) -> PatternSpec:
+    expression = entry.get("expression")
+    if not isinstance(expression, str) or not expression:
+        raise ValueError(f"{where}: missing \"expression\"")
+    pattern_id = entry.get("id", position)
+    if type(pattern_id) is not int or pattern_id < 0:
+        raise ValueError(f"{where}: \"id\" must be a non-negative integer")
+    flags = _strings(entry, "flags", where)
+    for flag in flags:
+        if flag not in FLAGS:
+            raise ValueError(f"{where}: unknown flag {flag!r} (known: {', '.join(FLAGS)})")
+    return PatternSpec(pattern_id, expression, flags, _strings(entry, "tags", where))
+
+
+def _strings(entry: dict, key: str, where: str) -> Tuple[str, ...]:
+    """A list of strings (or a single string) from the entry"""
+    values = entry.get(key, [])
+    if isinstance(values, str):
+        values = [values]
+    if not isinstance(values, (list, tuple)) or not all(isinstance(value, str) for value in values):
+        raise ValueError(f"{where}: \"{key}\" must be a list of strings")
+    return tuple(values)
+
+
+def load_pattern_file(filename: str) -> Tuple[List[str], Optional[List[int]], Optional[List[Tuple[str, ...]]]]:
+    """
+    Reads the patterns of a regex file for compiling, in either format.
+
+    Returns:
+        (expressions, ids, flags): ids are None for a plain file without
+        stable ids (positions are used), flags are None for a plain file
+    """
+    if is_pattern_jsonl(filename):
+        specs = list(read_patterns(filename))
+        return [spec.expression for spec in specs], [spec.id for spec in specs], [spec.flags for spec in specs]
+
+    fr = FileRegex(filename)
+    return fr.elements(), fr.ids(), None
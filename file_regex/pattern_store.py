@@ -0,0 +1,259 @@
+import json
+import os
+import tempfile
+from contextlib import contextmanager
+from typing import Dict, Iterable, List, Tuple
+
+
+class PatternStore:
+    """
+    Pattern file (one pattern per line) with an index and stable ids.
+
+    The lines are kept in memory in an ordered dict from id to pattern and
+    an index from pattern to ids, so membership checks, adds and deletes
+    are O(1). Every line has an id that does not change
+    when other lines are added or deleted; the ids are kept in a sidecar
+    file next to the patterns (`<filename>.ids`, JSON lines: a header with
+    the version and next id, then `[id, text]` for every line of the
+    pattern file, in the same order). If the pattern file was edited by
+    hand, the ids are matched to the lines again by their text, new lines
+    get new ids.
+
+    An add appends the new lines to the pattern file and their ids to the
+    sidecar, so loading rules one at a time costs O(1) I/O per rule.
+    Deletes rewrite both files atomically (which also compacts the
+    sidecar), as does the end of `batch()`, inside which any number of
+    adds and deletes are written once.
+    """
+    VERSION = 2
+    SUFFIX = ".ids"
+
+    def __init__(self, filename: str):
+        """
+        Args:
+            filename: pattern file, created if missing
+        """
+        self.filename = filename
+        self.sidecar = filename + PatternStore.SUFFIX
+        # id -> pattern, in file order
+        self._entries: Dict[int, str] = {}
+        # pattern -> ids of the lines with it
+        self._index: Dict[str, List[int]] = {}
+        self._next_id = 0
+        self._batch = 0
+        self._dirty = False
+        # (size, mtime) of the pattern file when it was read or written
+        self._stat = None
+        # the sidecar has the ids of every line, so adds can be appended to it
+        self._synced = False
+        open(filename, "a", encoding="utf-8").close()
+        self.load()
+
+    @staticmethod
+    def has_ids(filename: str) -> bool:
+        """True if the pattern file has a sidecar with stable ids"""
+        return os.path.exists(filename + PatternStore.SUFFIX)
+
+    def load(self) -> None:
+        """Reads the patterns and their ids"""
+        with open(self.filename, "r", encoding="utf-8") as f:
+            lines = [line.strip() for line in f if line.strip()]
+
+        stat = os.stat(self.filename)
+        self._stat = (stat.st_size, stat.st_mtime_ns)
+        self._next_id, entries, appendable = self._read_sidecar()
+        self._synced = appendable and [text for _, text in entries] == lines
+        if self._synced:
+            ids = [pattern_id for pattern_id, _ in entries]
+        else:
+            # edited by hand (or no sidecar yet): match the old ids by text
+            old: Dict[str, List[int]] = {}
+            for pattern_id, text in reversed(entries):
+                old.setdefault(text, []).append(pattern_id)
+            ids = []
+            for line in lines:
+                free = old.get(line)
+                if free:
+                    ids.append(free.pop())
+                else:
+                    ids.append(self._next_id)
+                    self._next_id += 1
+
+        self._entries = dict(zip(ids, lines))
+        self._index = {}
+        for pattern_id, line in self._entries.items():
+            self._index.setdefault(line, []).append(pattern_id)
+
+    def _read_sidecar(self) -> Tuple[int, List[Tuple[int, str]], bool]:
+        """
+        Reads the sidecar; entries that cannot be read are skipped.
+
+        Returns:
+            next id, the (id, text) entries, True if new entries can be appended to it
+        """
+        try:
+            with open(self.sidecar, "r", encoding="utf-8") as f:
+                header = json.loads(f.readline())
+                if not isinstance(header, dict):
+                    raise ValueError("no header")
+                version = header.get("version")
+                if version == 1 and "lines" in header:
+                    # single JSON object, written before adds were appended
+                    raw = header["lines"]
+                elif version == PatternStore.VERSION:
+                    raw = []
+                    for line in f:
+                        try:
+                            raw.append(json.loads(line))
+                        except ValueError:
+                            # e.g. an append that was cut short, matched again by text
+                            continue
+                else:
+                    print(f"Unsupported pattern id file: '{self.sidecar}', assigning new ones")
+                    return 0, [], False
+                entries = [(entry[0], entry[1]) for entry in raw
+                           if isinstance(entry, list) and len(entry) == 2
+                           and type(entry[0]) is int and isinstance(entry[1], str)]
+                next_id = header.get("next_id")
+                if type(next_id) is not int:
+                    raise ValueError("no next id")
+        except FileNotFoundError:
+            return 0, [], False
+        except (OSError, ValueError) as e:
+            print(f"Cannot read pattern ids: '{self.sidecar}': {e}, assigning new ones")
+            return 0, [], False
+        if entries:
+            next_id = max(next_id, max(pattern_id for pattern_id, _ in entries) + 1)
+        return next_id, entries, version == PatternStore.VERSION and len(entries) == len(raw)
+
+    def refresh(self) -> None:
+        """Reads the file again if another process changed it (and nothing is waiting to be written)"""
+        if self._dirty:
+            return
+        try:
+            stat = os.stat(self.filename)
+        except OSError:
+            return
+        if (stat.st_size, stat.st_mtime_ns) != self._stat:
+            self.load()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def __contains__(self, pattern: str) -> bool:
+        return pattern in self._index
+
+    def patterns(self) -> List[str]:
+        """Patterns in file order"""
+        return list(self._entries.values())
+
+    def ids(self) -> List[int]:
+        """Stable id of every pattern, in file order"""
+        return list(self._entries)
+
+    def items(self) -> List[Tuple[int, str]]:
+        return list(self._entries.items())
+
+    def add(self, patterns: Iterable[str]) -> List[int]:
+        """
+        Appends the patterns that are not in the store yet.
+
+        Returns:
+            ids of the added patterns
+        """
+        self.refresh()
+        added = []
+        for pattern in patterns:
+            pattern = pattern.strip()
+            if not pattern or pattern in self._index:
+                continue
+            self._entries[self._next_id] = pattern
+            self._index[pattern] = [self._next_id]
+            added.append(self._next_id)
+            self._next_id += 1
+        if not added:
+            return added
+        if self._batch or self._dirty or not self._synced:
+            self._changed()
+        else:
+            self._append(added)
+        return added
+
+    def delete(self, patterns: Iterable[str]) -> int:
+        """Removes every line equal to one of the patterns; returns the number of removed lines"""
+        self.refresh()
+        count = 0
+        for pattern in patterns:
+            for pattern_id in self._index.pop(pattern.strip(), ()):
+                del self._entries[pattern_id]
+                count += 1
+        if count:
+            self._changed()
+        return count
+
+    @contextmanager
+    def batch(self):
+        """Collects the changes made inside the block and writes them once"""
+        self._batch += 1
+        try:
+            yield self
+        finally:
+            self._batch -= 1
+            if not self._batch and self._dirty:
+                self.save()
+
+    def _changed(self) -> None:
+        self._dirty = True
+        if not self._batch:
+            self.save()
+
+    def _append(self, ids: List[int]) -> None:
+        """Appends the lines with these (new) ids to the pattern file and their ids to the sidecar"""
+        text = "".join(self._entries[pattern_id] + "\n" for pattern_id in ids)
+        with open(self.filename, "rb") as f:
+            if f.seek(0, os.SEEK_END):
+                f.seek(-1, os.SEEK_END)
+                if f.read(1) != b"\n":
+                    # last line edited by hand without a newline
+                    text = "\n" + text
+        with open(self.filename, "a", encoding="utf-8") as f:
+            f.write(text)
+        with open(self.sidecar, "a", encoding="utf-8") as f:
+            f.write("".join(_entry_line(pattern_id, self._entries[pattern_id]) for pattern_id in ids))
+        stat = os.stat(self.filename)
+        self._stat = (stat.st_size, stat.st_mtime_ns)
+
+    def save(self) -> None:
+        """Atomically rewrites the pattern file, then its sidecar (compacted)"""
+        _write_atomic(self.filename, "".join(line + "\n" for line in self._entries.values()))
+        stat = os.stat(self.filename)
+        self._stat = (stat.st_size, stat.st_mtime_ns)
+        header = json.dumps({"version": PatternStore.VERSION, "next_id": self._next_id}) + "\n"
+        _write_atomic(self.sidecar, header + "".join(_entry_line(pattern_id, line)
+                                                     for pattern_id, line in self._entries.items()))
+        self._dirty = False
+        self._synced = True
+
+
+def _entry_line(pattern_id: int, text: str) -> str:
+    return json.dumps([pattern_id, text]) + "\n"
+
+
+def _write_atomic(path: str, text: str) -> None:
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp = tempfile.mkstemp(dir=directory, suffix=".tmp")
+    try:
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            f.write(text)
+        try:
+            # keep the permissions of the file being replaced (mkstemp creates it 0600)
+            os.chmod(tmp, os.stat(path).st_mode & 0o7777)
+        except FileNotFoundError:
+            pass
+        os.replace(tmp, path)
+    except BaseException:
+        try:
+            os.remove(tmp)
+        except OSError:
+            pass
+        raise
@@ -1,62 +1,428 @@
 import os
-from typing import List, Dict
-from engines.base_engine import RegexEngine  
-from engines.hs_engine import HyperscanEngine 
-from engines.python_engine import PythonEngine
+from array import array
+from typing import List, Iterable, TextIO
+from engines import create_engine
+from engines.base_engine import RegexEngine
 from file_reader import FileReader
-from pathlib import Path
+from file_regex.pattern_file import load_pattern_file
+from match_sink import ChunkRing, MatchRecord, MatchSink
 
 
 class FileScanner:
     """Class for scanning files using various regex engines"""
     
-    def __init__(self, engine: RegexEngine = None):
+    RING_SIZE = 1 << 20
+    SMALL_FILE_SIZE = 64 * 1024
+    BATCH_BYTES = 16 << 20
+    BLOCK_MAX_SIZE = 64 << 20
+    # first bytes of a build artifact (HyperscanEngine.DB_MAGIC), not
+    # imported from there so other engines do not load hyperscan
+    DB_MAGIC = b"HSDBPACK"
+
+    def __init__(self, engine: RegexEngine = None, out: TextIO = None, sink_class=MatchSink,
+                 max_matches: int = None):
         """
         Args:
             engine: Implementacja RegexEngine (domyślnie HyperscanEngine)
+            out: Text stream for results (default: sys.stdout)
+            sink_class: MatchSink (sub)class collecting and writing the
+                matches of each file, a subclass can change the output format
+                (e.g. FilesWithMatchesSink, CountSink)
+            max_matches: stop scanning a file after this many matches; the
+                rest of the file is not read (not for scan_file_incremental)
         """
-        self.engine = engine or HyperscanEngine()
-        #self.engine = engine or PythonEngine()  #for comparison
+        self.engine = engine or create_engine("hyperscan")
+        self.out = out
+        self.sink_class = sink_class
+        self.max_matches = max_matches
+        # MatchRecord given to the sinks, set by scan_file_indexed
+        self.record = None
+        # stream pool of scan_file_incremental, created on first use
+        self._pool = None
+        self._database_id = None
+
+    def compile_patterns(self, patterns: List[str], ids: List[int] = None, flags=None, modes=None) -> None:
+        """Compiles patterns as bytes (ids default to their positions, flags are per-pattern flag names)
 
-    def compile_patterns(self, patterns: List[str]) -> None:
-        """Compiles patterns as bytes"""
+        Args:
+            modes: Hyperscan databases to compile now (see modes_for), the
+                engine default if None; ignored by other engines
+        """
         pattern_bytes = [pattern.encode('utf-8') for pattern in patterns]
-        self.engine.compile_patterns(pattern_bytes)
-    
-    def _match_callback(self, pattern_id: int, start: int, end: int, flags: int, filename: str):
-        """Callback triggered when a match is found
+        kwargs = {}
+        if flags is not None:
+            kwargs["flags"] = flags
+        if modes is not None and hasattr(self.engine, "DB_MODES"):
+            kwargs["modes"] = modes
+        self.engine.compile_patterns(pattern_bytes, ids, **kwargs)
+        self._pool = None
+
+    def load_patterns(self, config: str, modes=None) -> None:
+        """Loads a compiled database, or compiles the regexes of a text file
+
+        Args:
+            config: compiled Hyperscan database (created by build), a text
+                file with regexes (one per line) or a structured pattern
+                file (file_regex.pattern_file)
+            modes: see compile_patterns, only used for a pattern file
+
+        Raises:
+            ValueError: config is a build artifact that cannot be loaded
+                (e.g. no stream database, or an engine without load_db),
+                an invalid pattern file or patterns the engine cannot compile
         """
+        self._pool = None
+        with open(config, "rb") as f:
+            artifact = f.read(len(FileScanner.DB_MAGIC)) == FileScanner.DB_MAGIC
+        if artifact:
+            if not hasattr(self.engine, "load_db"):
+                raise ValueError(f"Cannot load database '{config}': {type(self.engine).__name__} "
+                                 f"cannot load compiled databases")
+            try:
+                self.engine.load_db(config)
+            except Exception as e:
+                raise ValueError(f"Cannot load database '{config}': {e}") from None
+            return
+        try:
+            # a single serialized stream database, as written before build artifacts
+            self.engine.load_db(config)
+            return
+        except Exception:
+            pass
+        try:
+            patterns = load_pattern_file(config)
+        except ValueError as e:
+            raise ValueError(f"Invalid pattern file: {e}") from None
+        try:
+            self.compile_patterns(*patterns, modes=modes)
+        except Exception as e:
+            raise ValueError(f"Cannot compile the patterns of '{config}': {e}") from None
 
-        with open(filename, "r") as f:
-            f.seek(start)
-            match = f.read(end - start)
+    @staticmethod
+    def modes_for(target: str, full_file: bool = False, use_mmap: bool = False) -> tuple:
+        """Hyperscan database a scan of `target` needs first
 
-        print(f"Regex with ID: {pattern_id}, filename: '{filename}', from: {start} end: {end}, match: '{match}'")
+        A file scanned as one block (see scan_file) and a directory (mostly
+        small files, see scan_small_files) need the block database, a big
+        file and standard input ("-") the stream one. Compiling only that
+        one at load time halves the compile time of a cold start; the other
+        mode is compiled if a scan needs it after all.
+        """
+        if target == "-":
+            return ("stream",)
+        if os.path.isdir(target):
+            return ("block",)
+        try:
+            size = os.path.getsize(target)
+        except OSError:
+            return ("stream",)
+        if FileScanner._as_block(size, FileReader.chunk_size_for(size), full_file, use_mmap):
+            return ("block",)
+        return ("stream",)
 
-    def scan_file(self, filename: str, chunk_size: int = 4096,full_file: bool = False) -> None:
-        """Scans file in streaming mode (STREAM mode)
+    @staticmethod
+    def _as_block(size: int, chunk_size: int, full_file: bool, use_mmap: bool) -> bool:
+        """True if scan_file scans a file of this size as one block"""
+        return 0 <= size <= chunk_size or (full_file and (use_mmap or 0 <= size <= FileScanner.BLOCK_MAX_SIZE))
+    
+    def scan_file(self, filename: str, chunk_size: int = None,full_file: bool = False,
+                  use_mmap: bool = False) -> bool:
+        """Scans file as one block (BLOCK mode) or in streaming mode (STREAM mode)
+
+        Files that fit in a single chunk, and with full_file files up to
+        BLOCK_MAX_SIZE, are scanned as one block by engine.scan_buffer
+        (Hyperscan block database). Bigger files are streamed in chunks.
         
         Args:
             filename: file path
-            chunk_size: Chunk size in bytes for scanning file (default 4096)
+            chunk_size: Chunk size in bytes for scanning file
+                (default: FileReader.chunk_size_for the file size)
             full_file: If True, read entire file as single chunk (default False)
+            use_mmap: If True, read the file through a read-only memory map.
+                Chunks are memoryview slices and with full_file the whole
+                mapping is handed to engine.scan_buffer without a copy
+                (also above BLOCK_MAX_SIZE).
+
+        Returns:
+            False if an error occurred (it is printed), True otherwise
         """
+        try:
+            size = os.path.getsize(filename)
+        except OSError:
+            size = -1
+        if chunk_size is None:
+            chunk_size = FileReader.chunk_size_for(size) if size >= 0 else FileReader.CHUNK_SIZE
+
+        if FileScanner._as_block(size, chunk_size, full_file, use_mmap):
+            try:
+                if use_mmap:
+                    with FileReader.mapped(filename) as view:
+                        return self._scan_block(filename, view)
+                else:
+                    FileReader.validate(filename)
+                    with open(filename, "rb") as f:
+                        return self._scan_block(filename, f.read())
+            except Exception as e:
+                print(f"An error occurred while trying to scan file: '{filename}': {e}")
+            return False
+
+        ring = ChunkRing(FileScanner.RING_SIZE, copy=not use_mmap)
+        sink = self.sink_class(filename, out=self.out, ring=ring, with_start=self.engine.reports_start,
+                               record=self.record, max_matches=self.max_matches)
 
         def callback(pattern_id, start, end, flags, context):
-            self._match_callback(pattern_id, start, end, flags, filename)
+            return sink.add(pattern_id, start, end)
 
         try:
-            self.engine.scan_stream(FileReader.chunks(filename, chunk_size=chunk_size,full_file=full_file), callback, context=filename)
+            if use_mmap:
+                chunks = FileReader.mmap_chunks(filename, chunk_size=chunk_size)
+            else:
+                chunks = FileReader.chunks(filename, chunk_size=chunk_size)
+            self.engine.scan_stream(ring.track(chunks), callback, context=filename)
             
         except Exception as e:
             print(f"An error occurred while trying to scan file: '{filename}': {e}")
+            return False
+        finally:
+            sink.close()
+        return True
+
+    def scan_file_incremental(self, filename: str, checkpoints, chunk_size: int = None) -> None:
+        """Scans only the bytes appended to a file since the last run
+
+        The scan continues from the checkpoint of the file (CheckpointStore):
+        its compressed Hyperscan stream state is expanded and fed the new
+        bytes, so matches spanning the old end of the file are found and
+        offsets are global. A rotated, truncated or replaced file, or one
+        checkpointed with other patterns, is scanned from the start. The
+        stream is never ended, so matches anchored at the end of data ($)
+        are not reported. The checkpoint is updated after the matches are
+        written; the caller saves the store.
+
+        Args:
+            filename: file path
+            checkpoints: CheckpointStore with the positions of earlier runs
+            chunk_size: Chunk size in bytes (default: FileReader.chunk_size_for
+                the size of the new part)
+        """
+        from checkpoint import Checkpoint
+
+        if not hasattr(self.engine, "stream_pool"):
+            print(f"Incremental scanning needs an engine with stream states (hyperscan): '{filename}'")
+            return
+
+        try:
+            if self._pool is None:
+                self._pool = self.engine.stream_pool(self._pool_match, max_live=1)
+                self._database_id = self.engine.database_id()
+            FileReader.validate(filename)
+            with open(filename, "rb") as f:
+                stat = os.fstat(f.fileno())
+                checkpoint = checkpoints.get(filename)
+                if checkpoint is None or not checkpoint.matches(stat, f, self._database_id):
+                    checkpoint = None
+                offset = checkpoint.offset if checkpoint else 0
+                if checkpoint and offset == stat.st_size:
+                    return
+
+                ring = ChunkRing(FileScanner.RING_SIZE)
+                ring.end = offset
+                sink = self.sink_class(filename, out=self.out, ring=ring, with_start=self.engine.reports_start)
+                stream = self._pool.open(context=sink, state=checkpoint.state if checkpoint else None)
+                try:
+                    if chunk_size is None:
+                        chunk_size = FileReader.chunk_size_for(stat.st_size - offset)
+                    f.seek(offset)
+                    while offset < stat.st_size:
+                        chunk = f.read(min(chunk_size, stat.st_size - offset))
+                        if not chunk:
+                            break
+                        ring.append(chunk)
+                        stream.feed(chunk)
+                        offset += len(chunk)
+                    state = stream.state()
+                finally:
+                    stream.close(report_end=False)
+                    sink.close()
+
+                checkpoints.put(filename, Checkpoint.create(stat, f, offset, self._database_id, state))
+        except Exception as e:
+            print(f"An error occurred while trying to scan file: '{filename}': {e}")
+
+    def scan_file_indexed(self, filename: str, index, full_file: bool = False, use_mmap: bool = False) -> None:
+        """Scans a file unless the ScanIndex says it did not change, then replays its matches
+
+        Args:
+            filename: file path
+            index: ScanIndex with the files of earlier runs
+            full_file, use_mmap: see scan_file
+        """
+        try:
+            stat = os.stat(filename)
+        except OSError as e:
+            print(f"An error occurred while trying to scan file: '{filename}': {e}")
+            return
+
+        record = index.lookup(filename, stat)
+        if record is not None:
+            self.replay(filename, record)
+            return
+
+        self.record = MatchRecord()
+        try:
+            ok = self.scan_file(filename, full_file=full_file, use_mmap=use_mmap)
+        finally:
+            record, self.record = self.record, None
+        if ok:
+            index.store(filename, stat, record)
+
+    def replay(self, filename: str, record: MatchRecord) -> None:
+        """Writes recorded matches of an unchanged file, their text is read from the file"""
+        sink = self.sink_class(filename, out=self.out, with_start=self.engine.reports_start,
+                               max_matches=self.max_matches)
+        for pattern_id, start, end in zip(record.ids, record.starts, record.ends):
+            if sink.add(pattern_id, start, end):
+                break
+        sink.close()
+
+    @staticmethod
+    def _pool_match(pattern_id, start, end, flags, sink):
+        sink.add(pattern_id, start, end)
+
+    def scan_fileobj(self, f, name: str, chunk_size: int = None) -> None:
+        """Scans an open binary stream that cannot be mapped or read again (pipe, socket, stdin)
+
+        Args:
+            f: binary stream with readinto (e.g. sys.stdin.buffer)
+            name: name shown in the results
+            chunk_size: initial chunk size, tuned from the measured throughput
+        """
+        self.scan_chunks(FileReader.buffered_chunks(f, chunk_size=chunk_size, adaptive=True), name)
+
+    def scan_chunks(self, chunks: Iterable[bytes], name: str) -> None:
+        """Scans a stream given as chunks of bytes that cannot be read again
+
+        Chunks that are buffers (e.g. the reused readinto buffers of
+        FileReader.buffered_chunks) are copied to bytes once; the ring and
+        the engine share that copy (Hyperscan streams only scan bytes).
+
+        Args:
+            chunks: consecutive parts of the stream
+            name: name shown in the results
+        """
+        chunks = (chunk if type(chunk) is bytes else bytes(chunk) for chunk in chunks)
+        ring = ChunkRing(FileScanner.RING_SIZE)
+        sink = self.sink_class(name, out=self.out, ring=ring, seekable=False,
+                               with_start=self.engine.reports_start, max_matches=self.max_matches)
+
+        def callback(pattern_id, start, end, flags, context):
+            return sink.add(pattern_id, start, end)
+
+        try:
+            self.engine.scan_stream(ring.track(chunks), callback, context=name)
+        except Exception as e:
+            print(f"An error occurred while trying to scan: '{name}': {e}")
+        finally:
+            sink.close()
+
+    def scan_small_files(self, filenames: List[str]) -> None:
+        """Scans many small files without opening an engine stream per file
+
+        The files are read back to back into one arena (a single bytearray)
+        and an offset table records where each of them starts. Every file is
+        then scanned as one block with engine.scan_buffer on a bytes copy of
+        its slice of the arena, so it goes to the same block database as the
+        other small files (a memoryview would need a vectored one).
+
+        Args:
+            filenames: paths of the files to scan
+        """
+        sizes = []
+        for name in filenames:
+            try:
+                sizes.append(os.path.getsize(name))
+            except OSError as e:
+                print(f"[scan_tree] Error with file {name}: {e}")
+                sizes.append(-1)
+
+        arena = memoryview(bytearray(sum(size for size in sizes if size > 0)))
+        names = []
+        offsets = array("Q")
+        lengths = array("Q")
+        pos = 0
+        for name, size in zip(filenames, sizes):
+            if size < 0:
+                continue
+            try:
+                with open(name, "rb", buffering=0) as f:
+                    length = f.readinto(arena[pos:pos + size]) or 0
+            except PermissionError:
+                print(f"[scan_tree] No permissions for the file: {name}")
+                continue
+            except OSError as e:
+                print(f"[scan_tree] Error with file {name}: {e}")
+                continue
+            names.append(name)
+            offsets.append(pos)
+            lengths.append(length)
+            pos += size
+
+        for name, start, length in zip(names, offsets, lengths):
+            self._scan_block(name, arena[start:start + length].tobytes())
+
+    def _scan_block(self, filename: str, block) -> bool:
+        """Scans the whole content of a file given as one buffer, False on error"""
+        ring = ChunkRing(copy=False)
+        ring.append(block)
+        sink = self.sink_class(filename, out=self.out, ring=ring, with_start=self.engine.reports_start,
+                               record=self.record, max_matches=self.max_matches)
+
+        def callback(pattern_id, start, end, flags, context):
+            return sink.add(pattern_id, start, end)
+
+        try:
+            self.engine.scan_buffer(block, callback, context=filename)
+        except Exception as e:
+            print(f"An error occurred while trying to scan file: '{filename}': {e}")
+            return False
+        finally:
+            sink.close()
+        return True
+
+    def scan_tree(self, root, follow_symlinks=False, full_file=False, use_mmap=False,
+                  small_file_size: int = None, checkpoints=None, index=None) -> None:
+        """Recursively scans all files under a directory
+
+        Files up to small_file_size bytes are collected and scanned in
+        batches of about BATCH_BYTES by scan_small_files, bigger ones are
+        streamed by scan_file.
+
+        Args:
+            root: directory to scan
+            follow_symlinks: whether to follow symbolic links during traversal
+            full_file: read each big file as a single chunk
+            use_mmap: read big files through a memory map
+            small_file_size: size threshold of the batched path
+                (default: SMALL_FILE_SIZE, 0 disables it)
+            checkpoints: CheckpointStore, every file is scanned by
+                scan_file_incremental (only its new bytes)
+            index: ScanIndex, every file is scanned by scan_file_indexed
+                (unchanged files are skipped and their matches replayed)
+        """
+        from pathlib import Path
 
-    def scan_tree(self, root, follow_symlinks=False, full_file=False) -> None:
         root = Path(root)
         if not root.exists():
             print(f"[scan_tree] Directory {root} does not exist")
             return
 
+        if checkpoints is not None or index is not None:
+            small_file_size = 0
+        elif small_file_size is None:
+            small_file_size = FileScanner.SMALL_FILE_SIZE
+        batch = []
+        batch_bytes = 0
+
         for dirpath, dirnames, filenames in os.walk(root, followlinks=follow_symlinks):
             dirpath = Path(dirpath)
 
@@ -64,8 +430,29 @@ class FileScanner:
                 path = dirpath / name
 
                 try:
-                    self.scan_file(str(path), full_file=full_file)
+                    size = path.stat().st_size if small_file_size else -1
+                except OSError:
+                    size = -1
+                if 0 <= size <= small_file_size:
+                    batch.append(str(path))
+                    batch_bytes += size
+                    if batch_bytes >= FileScanner.BATCH_BYTES:
+                        self.scan_small_files(batch)
+                        batch = []
+                        batch_bytes = 0
+                    continue
+
+                try:
+                    if checkpoints is not None:
+                        self.scan_file_incremental(str(path), checkpoints)
+                    elif index is not None:
+                        self.scan_file_indexed(str(path), index, full_file=full_file, use_mmap=use_mmap)
+                    else:
+                        self.scan_file(str(path), full_file=full_file, use_mmap=use_mmap)
                 except PermissionError:
                     print(f"[scan_tree] No permissions for the file: {path}")
                 except Exception as e:
                     print(f"[scan_tree] Error with file {path}: {e}")
+
+        if batch:
+            self.scan_small_files(batch)
@@ -1,50 +1,298 @@
+import heapq
+import io
 import os
+import queue
 import sys
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from multiprocessing import Pool
 from pathlib import Path
+from typing import List, Tuple
 
 from engines.base_engine import RegexEngine
-from file_regex.file_regex import FileRegex
+from file_reader import FileReader
 from file_scanner import FileScanner
+from match_sink import MatchRecord, MatchSink
 
+# FileScanner of the current worker process, set up once by init_worker
+_scanner = None
 
-def init_worker():
+
+def init_worker(patterns_path: str, engine: RegexEngine, sink_class=MatchSink, max_matches: int = None):
+    """
+    Pool initializer: pins the worker to a CPU and loads the patterns once,
+    so every file handed to this worker reuses the same database and scratch.
+    patterns_path comes from worker_patterns, sink_class and max_matches are
+    those of FileScanner.
+    """
     pid = os.getpid()
     cpu_count = os.cpu_count()
     cpu = pid % cpu_count
     os.sched_setaffinity(pid, {cpu})
 
+    global _scanner
+    _scanner = FileScanner(engine, sink_class=sink_class, max_matches=max_matches)
+    _scanner.load_patterns(patterns_path)
+
+
+@contextmanager
+def worker_patterns(engine: RegexEngine, patterns_path: str):
+    """
+    Yields the path the Pool workers load their patterns from, once
+    `engine` loaded patterns_path in this process (so invalid patterns fail
+    here, a failing Pool initializer would be restarted forever).
+
+    Patterns compiled here by an engine that writes build artifacts
+    (HyperscanEngine.save_db) are saved to a temporary artifact, removed
+    when the block ends, so every worker only deserializes the database and
+    allocates its scratch instead of compiling it again. Otherwise the
+    workers load patterns_path themselves: an artifact is only
+    deserialized, a pattern file is compiled again (cheap for the python
+    engine, from the cache filled here for the layered one).
+    """
+    if not (getattr(engine, "patterns", None) and hasattr(engine, "save_db")):
+        yield patterns_path
+        return
+    fd, path = tempfile.mkstemp(prefix="patterns-", suffix=".db")
+    os.close(fd)
+    try:
+        engine.save_db(path, modes=("stream",))
+        yield path
+    finally:
+        os.remove(path)
+
+
+def scan_worker(filename: str) -> str:
+    """
+    Scans a single file with the scanner loaded by init_worker and returns
+    its output, so results of different workers are never interleaved.
+    """
+    out = io.StringIO()
+    _scanner.out = out
+    _scanner.scan_file(str(filename))
+    return out.getvalue()
+
+
+def scan_indexed_worker(task):
+    """
+    Scans one file of an indexed tree scan, or replays its recorded matches.
+
+    Args:
+        task: (filename, stat, record) where record are the matches from the
+            index if the file did not change, otherwise None
+
+    Returns:
+        (filename, stat, output, record of the new scan or None)
+    """
+    filename, stat, record = task
+    out = io.StringIO()
+    _scanner.out = out
+    if record is not None:
+        _scanner.replay(filename, record)
+        return filename, stat, out.getvalue(), None
+
+    _scanner.record = MatchRecord()
+    try:
+        ok = _scanner.scan_file(str(filename))
+    finally:
+        record, _scanner.record = _scanner.record, None
+    return filename, stat, out.getvalue(), record if ok and stat is not None else None
+
+
+def indexed_tasks(files, index):
+    """Tasks of scan_indexed_worker: every file with its stat and the recorded matches if it is unchanged"""
+    for filename in files:
+        try:
+            stat = os.stat(filename)
+        except OSError:
+            yield filename, None, None
+            continue
+        yield filename, stat, index.lookup(filename, stat)
+
+
+def split_ranges(size: int, parts: int, min_size: int = 0) -> List[Tuple[int, int]]:
+    """Splits [0, size) into at most `parts` consecutive ranges of at least `min_size` bytes"""
+    if min_size:
+        parts = min(parts, max(1, size // min_size))
+    parts = max(1, parts)
+    step = -(-size // parts)
+    return [(start, min(start + step, size)) for start in range(0, size, step)] or [(0, 0)]
+
+
+def scan_range(engine: RegexEngine, filename: str, start: int, stop: int, overlap: int,
+               **scan_kwargs) -> List[Tuple[int, int, int]]:
+    """
+    Scans bytes [start, stop) of a file and returns (pattern_id, start, end)
+    of the matches that end inside the range.
+
+    The stream starts `overlap` bytes earlier and ends `overlap` bytes later,
+    so with overlap >= the maximum match width every match ending in the range
+    is found with its full context (word boundaries, anchors). Each match is
+    owned by the range its end offset falls into, so ranges never report the
+    same match twice.
+    """
+    lo = max(0, start - overlap)
+    matches = []
+
+    def callback(pattern_id, match_start, match_end, flags, context):
+        # a start past the SOM horizon stays an out of range offset
+        if match_start <= match_end:
+            match_start += lo
+        match_end += lo
+        if start < match_end <= stop:
+            matches.append((pattern_id, match_start, match_end))
+
+    engine.scan_stream(FileReader.range_chunks(filename, lo, stop + overlap), callback, **scan_kwargs)
+    return matches
+
+
+def scan_range_worker(filename: str, start: int, stop: int, overlap: int) -> List[Tuple[int, int, int]]:
+    """scan_range with the scanner loaded by init_worker"""
+    return scan_range(_scanner.engine, filename, start, stop, overlap)
+
+
+def _walk_into(root: Path, follow_symlinks: bool, paths: queue.Queue):
+    """Walker thread: puts (size, path) of every file under root into the queue"""
+    try:
+        for dirpath, dirnames, filenames in os.walk(root, followlinks=follow_symlinks):
+            for name in filenames:
+                path = os.path.join(dirpath, name)
+                try:
+                    size = os.stat(path).st_size
+                except OSError:
+                    size = 0
+                paths.put((size, path))
+    finally:
+        paths.put(None)
+
+
+def schedule_files(root: Path, follow_symlinks: bool, slots: threading.Semaphore,
+                   window: int = 1024, queue_size: int = 4096):
+    """
+    Yields the files under root, largest first among the ones known so far.
+
+    Paths are produced by a walker thread into a bounded queue. A path is
+    yielded only after taking one of `slots`, so the pool pulls tasks as
+    workers get free and large files found later still jump the queue.
+
+    Args:
+        root: Directory to walk
+        follow_symlinks: Whether to follow symbolic links during traversal
+        slots: Semaphore limiting the number of tasks in flight
+        window: Maximum number of pending paths ordered by size
+        queue_size: Capacity of the walker queue
+    """
+    paths = queue.Queue(maxsize=queue_size)
+    walker = threading.Thread(target=_walk_into, args=(root, follow_symlinks, paths), daemon=True)
+    walker.start()
+
+    pending = []
+    done = False
+    while True:
+        slots.acquire()
+        # take what the walker has found so far, wait only if nothing is pending
+        while not done and len(pending) < window:
+            try:
+                item = paths.get(block=not pending)
+            except queue.Empty:
+                break
+            if item is None:
+                done = True
+            else:
+                heapq.heappush(pending, (-item[0], item[1]))
+
+        if not pending:
+            slots.release()
+            return
+        yield heapq.heappop(pending)[1]
+
 
 class FileScannerPool:
     """
     Class designed to use FileScanner with multiprocessing
     """
+    MIN_SPLIT_SIZE = 16 << 20
+
     @staticmethod
-    def scan_file(patterns_path: str, engine: RegexEngine, filename: str):
+    def scan_file(patterns_path: str, engine: RegexEngine, filename: str, sink_class=MatchSink,
+                  max_matches: int = None):
         """
-        Creates FileScanner and scans single file,
-        (worker function for multiprocessing)
+        Creates FileScanner and scans single file
 
         Args:
             patterns_path (str): path to compiled Hyperscan database or
                 a text file with regexes (one per line)
             engine (RegexEngine): RegexEngine instance to be used in scanning
             filename (str): Path to the file that should be scanned
+            sink_class, max_matches: output format and match limit, see FileScanner
         """
-        scanner = FileScanner(engine)
-        try:
-            scanner.engine.load_db(patterns_path)
-        except Exception:
-            sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+        scanner = FileScanner(engine, sink_class=sink_class, max_matches=max_matches)
+        scanner.load_patterns(patterns_path, modes=FileScanner.modes_for(filename))
+        scanner.scan_file(filename)
 
-            fr = FileRegex(patterns_path)
-            patterns = fr.elements()
-            scanner.compile_patterns(patterns)
+    @staticmethod
+    def scan_file_split(patterns_path: str, engine: RegexEngine, filename: str, parts: int = None,
+                        threads: bool = False, out=None, sink_class=MatchSink, max_matches: int = None):
+        """
+        Scans a single big file as `parts` byte ranges in parallel.
 
-        scanner.scan_file(filename)
+        Args:
+            patterns_path (str): path to compiled Hyperscan database or
+                a text file with regexes (one per line)
+            engine (RegexEngine): RegexEngine instance to be used in scanning
+            filename (str): Path to the file that should be scanned
+            parts (int): Number of ranges (default: os.cpu_count())
+            threads (bool): Scan ranges in threads sharing one database, each
+                with its own scratch (Hyperscan releases the GIL while
+                scanning). Only used with engines that have new_scratch
+                (HyperscanEngine), otherwise processes are used.
+            out: Text stream for results (default: sys.stdout)
+            sink_class, max_matches: output format and match limit, see
+                FileScanner; the ranges are scanned to their end, only the
+                output is limited
+
+        Notes:
+            Ranges overlap by the maximum match width of the pattern set. If
+            it is unbounded or unknown (e.g. a database loaded without its
+            patterns), or the file is smaller than MIN_SPLIT_SIZE, the file
+            is scanned sequentially.
+        """
+        scanner = FileScanner(engine, out=out, sink_class=sink_class, max_matches=max_matches)
+        scanner.load_patterns(patterns_path)
+
+        overlap = scanner.engine.max_match_width()
+        size = os.path.getsize(filename)
+        ranges = split_ranges(size, parts or os.cpu_count(), FileScannerPool.MIN_SPLIT_SIZE)
+        if overlap is None or len(ranges) < 2:
+            scanner.scan_file(filename)
+            return
+
+        args = [(filename, start, stop, overlap) for start, stop in ranges]
+        if threads and hasattr(scanner.engine, "new_scratch"):
+            engine = scanner.engine
+
+            def scan_part(part):
+                return scan_range(engine, *part, scratch=engine.new_scratch())
+
+            with ThreadPoolExecutor(len(args)) as executor:
+                results = list(executor.map(scan_part, args))
+        else:
+            with worker_patterns(scanner.engine, patterns_path) as path, \
+                    Pool(len(args), initializer=init_worker, initargs=(path, engine)) as pool:
+                results = pool.starmap(scan_range_worker, args)
+
+        sink = sink_class(filename, out=out, with_start=scanner.engine.reports_start, max_matches=max_matches)
+        for matches in results:
+            for pattern_id, start, end in matches:
+                sink.add(pattern_id, start, end)
+        sink.close()
 
     @staticmethod
-    def scan_tree(patterns_path: str, engine: RegexEngine, dirname: str, follow_symlinks=False):
+    def scan_tree(patterns_path: str, engine: RegexEngine, dirname: str, follow_symlinks=False,
+                  chunksize: int = 1, processes: int = None, out=None, index=None, sink_class=MatchSink,
+                  max_matches: int = None):
         """
         Recursively scans all files in a directory tree using multiprocessing.
 
@@ -54,29 +302,52 @@ class FileScannerPool:
             engine (RegexEngine): RegexEngine instance passed to each worker.
             dirname (str): Root directory to scan recursively.
             follow_symlinks (bool): Whether to follow symbolic links during traversal.
+            chunksize (int): Number of files sent to a worker at once.
+            processes (int): Number of worker processes (default: os.cpu_count()).
+            out: Text stream for results (default: sys.stdout).
+            index (ScanIndex): Skip files that did not change since they were
+                stored in the index; the workers replay their matches. Files
+                are looked up while they are scheduled and stored by this
+                process when their result arrives.
+            sink_class, max_matches: output format and match limit of every
+                file, see FileScanner
+
+        Raises:
+            ValueError: the patterns cannot be loaded (see FileScanner.load_patterns)
 
         Notes:
-            Each file is scanned in a separate worker process using
-            FileScannerPool.scan_file via multiprocessing.Pool.starmap().
+            The patterns are loaded (compiled) once in this process, the
+            workers get them through worker_patterns.
+            Files are streamed from a walker thread (schedule_files) into
+            Pool.imap_unordered, largest first, so there is no barrier per
+            directory and a huge file does not stall the other workers.
         """
         root = Path(dirname)
         if not root.exists():
             print(f"[scan_tree] Directory {root} does not exist")
             return
 
-        # for dirpath, dirnames, filenames in os.walk(root, followlinks=follow_symlinks):
-        #     dirpath = Path(dirpath)
-        #     filenames = [dirpath / name for name in filenames]
-        #     args = [(patterns_path, engine, filename) for filename in filenames]
-        #
-        #     with Pool() as pool:
-        #         pool.starmap(FileScannerPool.scan_file, args)
-
-        with Pool(initializer=init_worker) as pool:
-            for dirpath, dirnames, filenames in os.walk(root,
-                                                        followlinks=follow_symlinks):
-                dirpath = Path(dirpath)
-                filenames = [dirpath / name for name in filenames]
-                args = [(patterns_path, engine, filename) for filename in
-                        filenames]
-                pool.starmap(FileScannerPool.scan_file, args)
\ No newline at end of file
+        out = out if out is not None else sys.stdout
+        processes = processes or os.cpu_count()
+        slots = threading.Semaphore(2 * processes * chunksize)
+
+        # the workers scan with the stream database, the artifact needs it anyway
+        FileScanner(engine).load_patterns(patterns_path, modes=("stream",))
+        with worker_patterns(engine, patterns_path) as path, \
+                Pool(processes, initializer=init_worker, initargs=(path, engine, sink_class, max_matches)) as pool:
+            files = schedule_files(root, follow_symlinks, slots)
+            if index is None:
+                for result in pool.imap_unordered(scan_worker, files, chunksize=chunksize):
+                    slots.release()
+                    if result:
+                        out.write(result)
+                return
+
+            tasks = indexed_tasks(files, index)
+            for filename, stat, result, record in pool.imap_unordered(scan_indexed_worker, tasks,
+                                                                      chunksize=chunksize):
+                slots.release()
+                if result:
+                    out.write(result)
+                if record is not None:
+                    index.store(filename, stat, record)
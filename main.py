@@ -1,18 +1,51 @@
 import argparse
 import os
 import sys
-from file_scanner import FileScanner
-from file_regex.file_regex import FileRegex
-from engines.python_engine import PythonEngine
-from engines.hs_engine import HyperscanEngine
-from file_scanner_pool import FileScannerPool
+from engines import ENGINES, create_engine
 
+# Modules below are imported only by the commands that need them, so a
+# short scan does not pay for loading hyperscan, multiprocessing etc.
 
-def match_to_string(pattern_id, start, end, filename):
-    with open(filename, "r") as f:
-        f.seek(start)
-        match = f.read(end - start)
-    return f"Regex with ID: {pattern_id}, filename: '{filename}', from: {start} end: {end}, match: '{match}'"
+
+def engine_options(args) -> dict:
+    """Constructor arguments of the selected engine taken from the CLI options"""
+    if args.engine in ("hyperscan", "layered"):
+        return {"use_cache": not args.no_cache, "som": args.som}
+    if args.engine == "python":
+        return {"shards": getattr(args, "shards", 0)}
+    return {}
+
+
+def database_modes(value: str) -> list:
+    """--modes of build: known database modes, the stream one always included (run needs it)"""
+    from engines.hs_engine import HyperscanEngine
+    modes = [mode.strip() for mode in value.split(",") if mode.strip()]
+    unknown = [mode for mode in modes if mode not in HyperscanEngine.DB_MODES]
+    if unknown:
+        raise argparse.ArgumentTypeError(f"unknown database mode: {', '.join(unknown)} "
+                                         f"(choose from {', '.join(HyperscanEngine.DB_MODES)})")
+    if "stream" not in modes:
+        modes.insert(0, "stream")
+    return list(dict.fromkeys(modes))
+
+
+def sink_options(args) -> dict:
+    """FileScanner output format and match limit of --files-with-matches, --count and --max-matches"""
+    from match_sink import CountSink, FilesWithMatchesSink, MatchSink
+    sink_class = MatchSink
+    if args.files_with_matches:
+        sink_class = FilesWithMatchesSink
+    elif args.count:
+        sink_class = CountSink
+    return {"sink_class": sink_class, "max_matches": args.max_matches}
+
+
+def open_index(args, engine):
+    """ScanIndex of --index for the patterns in args.config, or None"""
+    if not args.index:
+        return None
+    from scan_index import ScanIndex, patterns_id
+    return ScanIndex(args.index, patterns_id(args.config, engine), use_hash=args.index_hash)
 
 
 def main():
@@ -24,7 +57,7 @@ def main():
 
     build.add_argument(
         "source",
-        help="text file with regexes (one regex per line)"
+        help="text file with regexes (one regex per line) or a structured pattern file (JSON lines)"
     )
 
     build.add_argument(
@@ -33,6 +66,60 @@ def main():
         help="output file (default hs.db)"
     )
 
+    build.add_argument(
+        "--modes",
+        type=database_modes,
+        default="stream,block",
+        help="comma separated database modes stored in the output: stream, "
+             "block, vectored; stream is always stored (default: stream,block)"
+    )
+
+    build.add_argument(
+        "--som",
+        choices=["none", "small", "large"],
+        default="large",
+        help="start-of-match tracking: large (exact start offsets), small "
+             "(start offsets within 64 KiB of the match end, cheaper) or "
+             "none (end offsets only, fastest compile and smallest "
+             "database) (default: large)"
+    )
+
+    build.add_argument(
+        "--no-cache",
+        action="store_true",
+        help="always compile, do not use the compiled database cache"
+    )
+
+    build.add_argument(
+        "--shards",
+        type=int,
+        default=0,
+        metavar="N",
+        help="split the patterns into N shards of similar estimated "
+             "complexity, compiled in parallel processes into one sharded "
+             "database; every shard is scanned over the same data"
+    )
+
+    build.add_argument(
+        "--bucket-size",
+        type=int,
+        default=None,
+        metavar="N",
+        help="shard by pattern id ranges of N ids instead; with stable ids "
+             "(a pattern file edited through PatternStore) a rebuild "
+             "compiles only the ranges with edited patterns, the others come "
+             "from the cache"
+    )
+
+    build.add_argument(
+        "--jobs",
+        type=int,
+        default=None,
+        metavar="N",
+        help="with --shards, compile at most N shards at once (default: "
+             "number of CPUs), fewer jobs need less memory"
+    )
+
     # run
     run = subparsers.add_parser("run")
     
@@ -45,15 +132,24 @@ def main():
 
     run.add_argument(
         "target",
-        help="file or directory to scan"
+        help="file or directory to scan, '-' reads standard input"
     )
 
     # add cmd 
     run.add_argument(
         "--engine",
-        choices=["hyperscan", "python"],
         default="hyperscan",
-        help="regex engine to use (default: hyperscan)"
+        help=f"regex engine to use: {', '.join(ENGINES)} or one added by an "
+             f"installed package (default: hyperscan)"
+    )
+
+    run.add_argument(
+        "--shards",
+        type=int,
+        default=0,
+        metavar="N",
+        help="with --engine python, split the patterns into N shards scanned "
+             "by N worker processes (default: off)"
     )
 
     # add Pool
@@ -63,57 +159,319 @@ def main():
         help="enable verbose output"
     )
 
+    run.add_argument(
+        "--chunksize",
+        type=int,
+        default=1,
+        help="number of files sent to a pool worker at once (default: 1)"
+    )
+
+    run.add_argument(
+        "--split",
+        type=int,
+        default=0,
+        metavar="PARTS",
+        help="scan a single big file as PARTS byte ranges in parallel (default: off)"
+    )
+
+    run.add_argument(
+        "--threads",
+        action="store_true",
+        help="with --split, scan the ranges in threads instead of processes"
+    )
+
+    run.add_argument(
+        "--small-file-size",
+        type=int,
+        default=None,
+        metavar="BYTES",
+        help="when scanning a directory, files up to BYTES are read into one "
+             "buffer and scanned in batches (default: 65536, 0 disables)"
+    )
+
+    run.add_argument(
+        "--som",
+        choices=["none", "small", "large"],
+        default="large",
+        help="start-of-match tracking when compiling a regex file, a "
+             "database built with build keeps its own (default: large)"
+    )
+
+    run.add_argument(
+        "--no-cache",
+        action="store_true",
+        help="always compile, do not use the compiled database cache"
+    )
+
     run.add_argument(
     "--full-block",
     action="store_true",
     help="read each file as single block instead of chunks "
 )
 
+    run.add_argument(
+        "--index",
+        default=None,
+        metavar="FILE",
+        help="SQLite index of scanned files: when scanning a directory, files "
+             "unchanged since the last run with the same FILE and patterns "
+             "are not scanned, their matches are replayed"
+    )
+
+    run.add_argument(
+        "--index-hash",
+        action="store_true",
+        help="with --index, also compare file content hashes, so files that "
+             "were only touched are skipped too"
+    )
+
+    run.add_argument(
+        "--checkpoint",
+        default=None,
+        metavar="FILE",
+        help="scan only what was appended to the files since the last run "
+             "with the same FILE, which keeps per file offsets and stream "
+             "states (hyperscan only)"
+    )
+
+    output = run.add_mutually_exclusive_group()
+
+    output.add_argument(
+        "-l", "--files-with-matches",
+        action="store_true",
+        help="print only the names of files with a match; the scan of a "
+             "file stops at its first match"
+    )
+
+    output.add_argument(
+        "-c", "--count",
+        action="store_true",
+        help="print the number of matches of every pattern per file "
+             "instead of the matches"
+    )
+
+    run.add_argument(
+        "--max-matches",
+        type=int,
+        default=None,
+        metavar="N",
+        help="stop scanning a file after N matches, the rest of it is not read"
+    )
+
+    run.add_argument(
+        "--mmap",
+        action="store_true",
+        help="read files through a memory map (no copy per chunk, with "
+             "--full-block the whole mapping is scanned as one block)"
+    )
+
+    # serve
+    serve = subparsers.add_parser("serve")
+
+    serve.add_argument(
+        "databases",
+        nargs="+",
+        metavar="[NAME=]CONFIG",
+        help="compiled databases or text files with regexes to keep loaded, "
+             "NAME defaults to the file name without extension; with "
+             "--engine layered, changes of a text file are applied without "
+             "a full recompile"
+    )
+
+    serve.add_argument(
+        "--listen",
+        default="127.0.0.1:7878",
+        metavar="ADDRESS",
+        help="HOST:PORT to listen on, or a Unix socket path "
+             "(default: 127.0.0.1:7878); only loopback hosts without "
+             "--allow-remote"
+    )
+
+    serve.add_argument(
+        "--allow-remote",
+        action="store_true",
+        help="allow a --listen host reachable from other machines; clients "
+             "are not authenticated and can scan any file the server can read"
+    )
+
+    serve.add_argument(
+        "--engine",
+        default="hyperscan",
+        help=f"regex engine to use: {', '.join(ENGINES)} or one added by an "
+             f"installed package (default: hyperscan)"
+    )
+
+    serve.add_argument(
+        "--som",
+        choices=["none", "small", "large"],
+        default="large",
+        help="start-of-match tracking when compiling a regex file "
+             "(default: large)"
+    )
+
+    serve.add_argument(
+        "--no-cache",
+        action="store_true",
+        help="always compile, do not use the compiled database cache"
+    )
+
+    # client
+    client = subparsers.add_parser("client")
+
+    client.add_argument(
+        "target",
+        help="file or directory to scan (as seen by the server), '-' sends "
+             "standard input"
+    )
+
+    client.add_argument(
+        "--connect",
+        default="127.0.0.1:7878",
+        metavar="ADDRESS",
+        help="HOST:PORT or Unix socket path of the server (default: 127.0.0.1:7878)"
+    )
+
+    client.add_argument(
+        "--db",
+        default=None,
+        metavar="NAME",
+        help="database to scan with (default: the first one of the server)"
+    )
+
     args = parser.parse_args()
 
     if args.command == "run":
-        #engie
-        if args.engine == "python":
-            engine = PythonEngine()
-        else:
-            engine = HyperscanEngine()
+        try:
+            engine = create_engine(args.engine, **engine_options(args))
+        except ValueError as e:
+            parser.error(str(e))
 
-        if args.pool:
-            if os.path.isfile(args.target):
-                FileScannerPool.scan_file(args.config, engine, args.target)
+        if args.checkpoint and (args.split or args.pool or args.target == "-"):
+            parser.error("--checkpoint cannot be used with --split, --pool or standard input")
+        if args.index and args.checkpoint:
+            parser.error("--index cannot be used with --checkpoint")
+        if args.checkpoint and not hasattr(engine, "stream_pool"):
+            parser.error(f"--checkpoint needs an engine with stream states, not '{args.engine}'")
+        if args.max_matches is not None and args.max_matches < 1:
+            parser.error("--max-matches must be at least 1")
+        limited = args.files_with_matches or args.count or args.max_matches is not None
+        if limited and (args.index or args.checkpoint):
+            parser.error("--files-with-matches, --count and --max-matches cannot be used with --index "
+                         "or --checkpoint")
 
-            elif os.path.isdir(args.target):
-                FileScannerPool.scan_tree(args.config, engine, args.target)
-            else:
-                print(f"cannot access '{args.target}': No such file or directory")
-        else:
-            scanner = FileScanner(engine=engine)
+        split = args.split and os.path.isfile(args.target)
+        if split or args.pool:
+            from file_scanner_pool import FileScannerPool
+            try:
+                if split:
+                    FileScannerPool.scan_file_split(args.config, engine, args.target,
+                                                    parts=args.split, threads=args.threads, **sink_options(args))
+
+                elif os.path.isfile(args.target):
+                    FileScannerPool.scan_file(args.config, engine, args.target, **sink_options(args))
 
+                elif os.path.isdir(args.target):
+                    index = open_index(args, engine)
+                    try:
+                        FileScannerPool.scan_tree(args.config, engine, args.target, chunksize=args.chunksize,
+                                                  index=index, **sink_options(args))
+                    finally:
+                        if index is not None:
+                            index.close()
+                else:
+                    print(f"cannot access '{args.target}': No such file or directory")
+            except ValueError as e:
+                # patterns that cannot be loaded, see FileScanner.load_patterns
+                print(e)
+                sys.exit(1)
+        else:
+            from file_scanner import FileScanner
+            scanner = FileScanner(engine=engine, **sink_options(args))
+            # compile only the database the scan starts with (checkpoints resume streams)
+            modes = ("stream",) if args.checkpoint else FileScanner.modes_for(args.target, args.full_block,
+                                                                                args.mmap)
             try:
-                scanner.engine.load_db(args.config)
-            except Exception:
-                sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+                scanner.load_patterns(args.config, modes=modes)
+            except ValueError as e:
+                print(e)
+                sys.exit(1)
+            checkpoints = None
+            if args.checkpoint:
+                from checkpoint import CheckpointStore
+                checkpoints = CheckpointStore(args.checkpoint)
+
+            if checkpoints is not None and os.path.isfile(args.target):
+                scanner.scan_file_incremental(args.target, checkpoints)
 
-                fr = FileRegex(args.config)
-                patterns = fr.elements()
-                scanner.compile_patterns(patterns)
-            
-            if os.path.isfile(args.target):
-                scanner.scan_file(args.target, full_file=args.full_block)
+            elif args.target == "-":
+                scanner.scan_fileobj(sys.stdin.buffer, "<stdin>")
+
+            elif os.path.isfile(args.target):
+                scanner.scan_file(args.target, full_file=args.full_block, use_mmap=args.mmap)
 
             elif os.path.isdir(args.target):
-                scanner.scan_tree(args.target, full_file=args.full_block)
+                index = open_index(args, engine)
+                try:
+                    scanner.scan_tree(args.target, full_file=args.full_block, use_mmap=args.mmap,
+                                      small_file_size=args.small_file_size, checkpoints=checkpoints,
+                                      index=index)
+                finally:
+                    if index is not None:
+                        index.close()
             else:
                 print(f"cannot access '{args.target}': No such file or directory")
+
+            if checkpoints is not None:
+                checkpoints.save()
     
     elif args.command == "build":
-        fr = FileRegex(args.source)
-        patterns = fr.elements()
+        from file_regex.pattern_file import load_pattern_file
+        from file_scanner import FileScanner
+        try:
+            patterns, ids, flags = load_pattern_file(args.source)
+        except ValueError as e:
+            print(f"Invalid pattern file: {e}")
+            return
+
+        modes = args.modes
+        scanner = FileScanner(create_engine("hyperscan", use_cache=not args.no_cache, som=args.som))
+        if args.shards > 1 or args.bucket_size:
+            scanner.engine.compile_shards([pattern.encode("utf-8") for pattern in patterns], ids,
+                                          shards=args.shards, processes=args.jobs, modes=modes,
+                                          bucket_size=args.bucket_size, flags=flags)
+        else:
+            scanner.compile_patterns(patterns, ids, flags, modes=modes)
+
+        scanner.engine.save_db(args.output, modes=modes)
 
-        scanner = FileScanner()
-        scanner.compile_patterns(patterns)
+    elif args.command == "serve":
+        from scan_server import ScanServer, check_address, parse_address, parse_database
+        address = parse_address(args.listen)
+        databases = dict(parse_database(db) for db in args.databases)
+        try:
+            check_address(address, args.allow_remote)
+            server = ScanServer(databases, args.engine, **engine_options(args))
+        except ValueError as e:
+            parser.error(str(e))
+        try:
+            server.serve_forever(address, allow_remote=args.allow_remote)
+        except OSError as e:
+            print(f"Cannot listen on '{args.listen}': {e}")
+            sys.exit(1)
 
-        scanner.engine.save_db(args.output)
+    elif args.command == "client":
+        from scan_server import ScanClient, parse_address
+        try:
+            with ScanClient(parse_address(args.connect)) as client:
+                if args.target == "-":
+                    ok = client.scan_fileobj(sys.stdin.buffer, "<stdin>", db=args.db)
+                else:
+                    ok = client.scan_path(args.target, db=args.db)
+        except OSError as e:
+            print(f"Cannot connect to '{args.connect}': {e}")
+            sys.exit(1)
+        if not ok:
+            sys.exit(1)
 
 
 if __name__ == "__main__":
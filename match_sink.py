@@ -0,0 +1,300 @@
+import os
+import sys
+import zlib
+from array import array
+from collections import deque
+from typing import Iterable, Optional, TextIO
+
+
+def format_match(pattern_id: int, start: int, end: int, filename: str, match: str) -> str:
+    """Formats a single match as a line of scanner output"""
+    return f"Regex with ID: {pattern_id}, filename: '{filename}', from: {start} end: {end}, match: '{match}'"
+
+
+def format_end_match(pattern_id: int, end: int, filename: str) -> str:
+    """Formats a match whose start offset is not known"""
+    return f"Regex with ID: {pattern_id}, filename: '{filename}', end: {end}"
+
+
+def format_count(pattern_id: int, count: int, filename: str) -> str:
+    """Formats the number of matches of a pattern in a file"""
+    return f"Regex with ID: {pattern_id}, filename: '{filename}', count: {count}"
+
+
+def _read_at(f, start: int, length: int) -> bytes:
+    """Reads `length` bytes at absolute offset `start` of an open binary file"""
+    if hasattr(os, "pread"):
+        return os.pread(f.fileno(), length, start)
+    f.seek(start)
+    return f.read(length)
+
+
+class ChunkRing:
+    """
+    Bounded ring of the most recent chunks of a stream.
+
+    Matches reported by a streaming engine usually end in the chunk that is
+    being scanned, so their text can be sliced from memory instead of being
+    read back from the file.
+    """
+
+    def __init__(self, capacity: int = 1 << 20, copy: bool = True):
+        """
+        Args:
+            capacity: Number of bytes to keep. The newest chunk is always
+                kept, even if it is bigger than the capacity.
+            copy: Copy chunks that are not bytes. Can be disabled for
+                chunks that never change (e.g. slices of a mapped file).
+        """
+        self.capacity = capacity
+        self.copy = copy
+        self.end = 0
+        self._chunks = deque()
+        self._size = 0
+
+    def append(self, chunk) -> None:
+        """Adds a chunk at the end of the stream, dropping the oldest ones"""
+        if self.copy and not isinstance(chunk, bytes):
+            chunk = bytes(chunk)
+        self._chunks.append((self.end, chunk))
+        self.end += len(chunk)
+        self._size += len(chunk)
+
+        while len(self._chunks) > 1 and self._size - len(self._chunks[0][1]) >= self.capacity:
+            _, old = self._chunks.popleft()
+            self._size -= len(old)
+
+    def track(self, chunks: Iterable[bytes]) -> Iterable[bytes]:
+        """Passes chunks through unchanged, remembering each one on the way"""
+        for chunk in chunks:
+            self.append(chunk)
+            yield chunk
+
+    def get(self, start: int, end: int) -> Optional[bytes]:
+        """Returns bytes [start, end) of the stream, or None if they were dropped"""
+        if not self._chunks or start < self._chunks[0][0] or end > self.end:
+            return None
+
+        parts = []
+        for offset, chunk in self._chunks:
+            if offset + len(chunk) <= start:
+                continue
+            if offset >= end:
+                break
+            parts.append(chunk[max(start - offset, 0):end - offset])
+        return b"".join(parts)
+
+
+class MatchRecord:
+    """(pattern_id, start, end) of all matches of a file, e.g. to replay them later without a scan"""
+
+    def __init__(self):
+        self.ids = array("I")
+        self.starts = array("Q")
+        self.ends = array("Q")
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def extend(self, ids: array, starts: array, ends: array) -> None:
+        self.ids.extend(ids)
+        self.starts.extend(starts)
+        self.ends.extend(ends)
+
+    def to_bytes(self) -> bytes:
+        """Compressed form: count followed by the three arrays (little-endian)"""
+        parts = [len(self.ids).to_bytes(8, "little")]
+        for values in (self.ids, self.starts, self.ends):
+            if sys.byteorder != "little":
+                values = array(values.typecode, values)
+                values.byteswap()
+            parts.append(values.tobytes())
+        return zlib.compress(b"".join(parts))
+
+    @classmethod
+    def from_bytes(cls, data: bytes) -> "MatchRecord":
+        data = zlib.decompress(data)
+        count = int.from_bytes(data[:8], "little")
+        record = cls()
+        pos = 8
+        for values in (record.ids, record.starts, record.ends):
+            size = count * values.itemsize
+            values.frombytes(data[pos:pos + size])
+            if sys.byteorder != "little":
+                values.byteswap()
+            pos += size
+        return record
+
+
+class MatchSink:
+    """
+    Collects the matches of one file and writes them out in batches.
+
+    The match callback only appends (pattern_id, start, end) to compact
+    arrays. Match text is taken from a ChunkRing when possible, the rest is
+    read in one pass over the file sorted by offset, and the formatted lines
+    are written with a few large writes instead of one print per match.
+
+    With `max_matches`, add returns True once that many matches were
+    recorded; scanners return it from the engine callback, which stops the
+    scan (the rest of the file is not read). Later matches are dropped.
+    """
+    BATCH_SIZE = 65536
+    WRITE_SIZE = 1 << 20
+
+    def __init__(self, filename: str, out: TextIO = None, ring: ChunkRing = None, seekable: bool = True,
+                 with_start: bool = True, record: MatchRecord = None, max_matches: int = None):
+        """
+        Args:
+            filename: Scanned file, used for the output and to read match text
+            out: Text stream for results (default: sys.stdout)
+            ring: Optional ring with the recently scanned chunks
+            seekable: False for sources that cannot be read again (pipes,
+                sockets), then only the text found in the ring is shown
+            with_start: False if the engine reports only end offsets, then
+                matches are written without start offset and text
+            record: Optional MatchRecord that also gets every match
+            max_matches: Optional number of matches after which the scan
+                of the file can stop
+        """
+        self.filename = filename
+        self.out = out if out is not None else sys.stdout
+        self.ring = ring if with_start else None
+        self.seekable = seekable
+        self.with_start = with_start
+        self.record = record
+        self.max_matches = max_matches
+        self.count = 0
+        self._ids = array("I")
+        self._starts = array("Q")
+        self._ends = array("Q")
+        self._texts = {}
+
+    @property
+    def done(self) -> bool:
+        """True if no more matches are needed"""
+        return self.max_matches is not None and self.count >= self.max_matches
+
+    def add(self, pattern_id: int, start: int, end: int) -> bool:
+        """Records a single match, returns True if the scan can stop"""
+        if self.done:
+            return True
+        if self.ring is not None and start <= end:
+            text = self.ring.get(start, end)
+            if text is not None:
+                self._texts[len(self._ids)] = text
+
+        self._ids.append(pattern_id)
+        self._starts.append(start)
+        self._ends.append(end)
+        self.count += 1
+
+        if len(self._ids) >= MatchSink.BATCH_SIZE:
+            self.flush()
+        return self.done
+
+    def _known_start(self, i: int) -> bool:
+        # start past the SOM horizon is reported as a huge offset
+        return self.with_start and self._starts[i] <= self._ends[i]
+
+    def _resolve(self) -> None:
+        """Reads the text of all matches that were not found in the ring"""
+        missing = [i for i in range(len(self._ids)) if i not in self._texts and self._known_start(i)]
+        if not missing or not self.seekable:
+            return
+
+        missing.sort(key=self._starts.__getitem__)
+        with open(self.filename, "rb") as f:
+            for i in missing:
+                start = self._starts[i]
+                self._texts[i] = _read_at(f, start, self._ends[i] - start)
+
+    def format(self, i: int) -> str:
+        """Output line of the i-th buffered match, can be overridden for other formats"""
+        if self._known_start(i):
+            match = self._texts.get(i, b"").decode("utf-8", errors="replace")
+            return format_match(self._ids[i], self._starts[i], self._ends[i], self.filename, match)
+        return format_end_match(self._ids[i], self._ends[i], self.filename)
+
+    def flush(self) -> None:
+        """Formats and writes all buffered matches"""
+        if not self._ids:
+            return
+
+        if self.record is not None:
+            self.record.extend(self._ids, self._starts, self._ends)
+        try:
+            self._resolve()
+        except OSError as e:
+            print(f"Cannot read matches from file: '{self.filename}': {e}")
+
+        lines = []
+        size = 0
+        for i in range(len(self._ids)):
+            line = self.format(i)
+            lines.append(line)
+            size += len(line) + 1
+            if size >= MatchSink.WRITE_SIZE:
+                self.out.write("\n".join(lines) + "\n")
+                lines = []
+                size = 0
+        if lines:
+            self.out.write("\n".join(lines) + "\n")
+
+        self._ids = array("I")
+        self._starts = array("Q")
+        self._ends = array("Q")
+        self._texts = {}
+
+    def close(self) -> None:
+        """Writes what is left in the buffer"""
+        self.flush()
+
+
+class FilesWithMatchesSink(MatchSink):
+    """MatchSink writing only the name of a file with at least one match (stops at the first one)"""
+
+    def __init__(self, filename: str, out: TextIO = None, **kwargs):
+        kwargs.update(ring=None, max_matches=1)
+        super().__init__(filename, out=out, **kwargs)
+
+    def flush(self) -> None:
+        if self._ids and self.record is not None:
+            self.record.extend(self._ids, self._starts, self._ends)
+        self._ids = array("I")
+        self._starts = array("Q")
+        self._ends = array("Q")
+
+    def close(self) -> None:
+        self.flush()
+        if self.count:
+            self.out.write(self.filename + "\n")
+
+
+class CountSink(MatchSink):
+    """
+    MatchSink writing the number of matches of every pattern in a file
+    instead of the matches, no match text is read. With max_matches the
+    counts stop at that many matches in total.
+    """
+
+    def __init__(self, filename: str, out: TextIO = None, **kwargs):
+        kwargs.update(ring=None)
+        super().__init__(filename, out=out, **kwargs)
+        self._counts = {}
+
+    def flush(self) -> None:
+        if self._ids and self.record is not None:
+            self.record.extend(self._ids, self._starts, self._ends)
+        counts = self._counts
+        for pattern_id in self._ids:
+            counts[pattern_id] = counts.get(pattern_id, 0) + 1
+        self._ids = array("I")
+        self._starts = array("Q")
+        self._ends = array("Q")
+
+    def close(self) -> None:
+        self.flush()
+        if self._counts:
+            self.out.write("".join(format_count(pattern_id, count, self.filename) + "\n"
+                                   for pattern_id, count in sorted(self._counts.items())))
@@ -0,0 +1,118 @@
+import hashlib
+import os
+import sqlite3
+import threading
+from typing import Optional
+
+from match_sink import MatchRecord
+
+
+def patterns_id(config: str, engine) -> str:
+    """
+    Identifies the patterns files are scanned with: a hash of the database
+    or regex file, the engine class and its start-of-match level.
+    """
+    h = hashlib.sha256()
+    with open(config, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            h.update(block)
+    h.update(f"|{type(engine).__name__}|{getattr(engine, 'som', '')}".encode())
+    return h.hexdigest()
+
+
+def content_hash(filename: str) -> str:
+    h = hashlib.blake2b(digest_size=16)
+    with open(filename, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+class ScanIndex:
+    """
+    SQLite index of scanned files, so tree rescans skip unchanged files.
+
+    Keyed by absolute path, it keeps the mtime, size, optional content hash
+    and patterns id (patterns_id) of the last scan, with its matches as a
+    compressed MatchRecord. A file whose mtime and size (or, with
+    use_hash, size and content) are unchanged and that was scanned with the
+    same patterns is not scanned again: its matches are replayed and only
+    their text is read from the file.
+
+    Lookups and stores can come from different threads (FileScannerPool
+    looks files up while it schedules them).
+    """
+    # stores committed in one transaction
+    COMMIT_EVERY = 1000
+
+    def __init__(self, path: str, patterns: str, use_hash: bool = False):
+        """
+        Args:
+            path: SQLite database file, created if missing
+            patterns: patterns id of this run (patterns_id)
+            use_hash: also store a hash of every scanned file; a file with
+                a new mtime but the same size and content is then skipped
+        """
+        self.patterns = patterns
+        self.use_hash = use_hash
+        self._lock = threading.Lock()
+        self._pending = 0
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS files ("
+            " path TEXT PRIMARY KEY, mtime_ns INTEGER, size INTEGER, hash TEXT,"
+            " patterns TEXT, matches BLOB)"
+        )
+
+    def lookup(self, filename: str, stat: os.stat_result) -> Optional[MatchRecord]:
+        """Recorded matches of an unchanged file, None if it has to be scanned"""
+        path = os.path.abspath(filename)
+        with self._lock:
+            row = self._db.execute(
+                "SELECT mtime_ns, size, hash, patterns, matches FROM files WHERE path = ?", (path,)
+            ).fetchone()
+        if row is None:
+            return None
+
+        mtime_ns, size, digest, patterns, matches = row
+        if patterns != self.patterns or size != stat.st_size:
+            return None
+        if mtime_ns != stat.st_mtime_ns:
+            # touched or rewritten with the same size
+            if not (self.use_hash and digest) or content_hash(filename) != digest:
+                return None
+            with self._lock:
+                self._db.execute("UPDATE files SET mtime_ns = ? WHERE path = ?", (stat.st_mtime_ns, path))
+                self._written()
+        return MatchRecord.from_bytes(matches)
+
+    def store(self, filename: str, stat: os.stat_result, record: MatchRecord) -> None:
+        """Saves the matches of a file scanned with its content at `stat`"""
+        digest = content_hash(filename) if self.use_hash else None
+        with self._lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO files (path, mtime_ns, size, hash, patterns, matches)"
+                " VALUES (?, ?, ?, ?, ?, ?)",
+                (os.path.abspath(filename), stat.st_mtime_ns, stat.st_size, digest, self.patterns,
+                 record.to_bytes()),
+            )
+            self._written()
+
+    def _written(self) -> None:
+        self._pending += 1
+        if self._pending >= ScanIndex.COMMIT_EVERY:
+            self._db.commit()
+            self._pending = 0
+
+    def close(self) -> None:
+        with self._lock:
+            self._db.commit()
+            self._db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -0,0 +1,398 @@
+"""
+Scan daemon: databases are loaded once and files or raw payloads are
+scanned on request, without paying for interpreter start, database
+loading and scratch allocation on every scan.
+
+Protocol (JSON lines over a Unix socket or a local TCP connection), any
+number of requests per connection:
+
+    {"op": "list"}
+        -> {"databases": ["name", ...]}
+    {"op": "scan", "path": "/abs/path", "db": "name"}
+        -> one line per match, then {"done": true, "matches": N}
+    {"op": "scan", "payload": true, "name": "<stdin>", "db": "name"}
+        followed by frames: 4-byte little-endian length + bytes, a frame of
+        length 0 ends the payload
+        -> one line per match, then {"done": true, "matches": N}
+
+A match line is {"id", "filename", "end"} plus "from" and "match" when the
+engine reports start offsets. "db" is optional (default: the first
+database). Errors are answered with {"error": "..."}.
+
+There is no authentication and a client can scan any file the server can
+read, so TCP addresses other than loopback are refused unless remote
+clients are allowed explicitly (check_address).
+"""
+import ipaddress
+import json
+import os
+import socket
+import socketserver
+import sys
+import threading
+from typing import BinaryIO, Dict, Iterator, List, Tuple, Union
+
+from engines import create_engine
+from file_regex.pattern_file import load_pattern_file
+from file_scanner import FileScanner
+from match_sink import MatchSink, format_end_match, format_match
+
+Address = Union[str, Tuple[str, int]]
+
+DEFAULT_ADDRESS = "127.0.0.1:7878"
+
+
+def parse_address(text: str) -> Address:
+    """"host:port" is a TCP address, anything else a Unix socket path"""
+    host, sep, port = text.rpartition(":")
+    if sep and port.isdigit() and "/" not in text and os.sep not in text:
+        return host or "127.0.0.1", int(port)
+    return text
+
+
+def is_loopback(host: str) -> bool:
+    """True if every address the host name resolves to is a loopback address"""
+    if not host:
+        # binds all interfaces
+        return False
+    try:
+        infos = socket.getaddrinfo(host, None)
+    except (socket.gaierror, UnicodeError):
+        return False
+    return bool(infos) and all(ipaddress.ip_address(info[4][0].split("%")[0]).is_loopback for info in infos)
+
+
+def check_address(address: Address, allow_remote: bool = False) -> None:
+    """
+    Raises ValueError for a TCP address reachable from other hosts, unless
+    allow_remote: clients are not authenticated and can scan any file the
+    server can read.
+    """
+    if isinstance(address, tuple) and not allow_remote and not is_loopback(address[0]):
+        raise ValueError(f"refusing to listen on '{format_address(address)}': the server has no "
+                         f"authentication and scans any path a client names; use a loopback address, "
+                         f"a Unix socket or --allow-remote")
+
+
+def parse_database(text: str) -> Tuple[str, str]:
+    """"name=path", or a path named after its file name without extension"""
+    name, sep, path = text.partition("=")
+    if sep and name:
+        return name, path
+    return os.path.splitext(os.path.basename(text))[0], text
+
+
+def read_frames(rfile: BinaryIO) -> Iterator[bytes]:
+    """Yields the frames of a payload until the empty frame"""
+    while True:
+        header = rfile.read(4)
+        if len(header) < 4:
+            raise ConnectionError("Connection closed inside a payload")
+        size = int.from_bytes(header, "little")
+        if size == 0:
+            return
+        data = rfile.read(size)
+        if len(data) < size:
+            raise ConnectionError("Connection closed inside a payload")
+        yield data
+
+
+def write_frames(wfile: BinaryIO, chunks) -> None:
+    """Sends chunks as payload frames, ended by the empty frame"""
+    for chunk in chunks:
+        if chunk:
+            wfile.write(len(chunk).to_bytes(4, "little"))
+            wfile.write(chunk)
+    wfile.write(b"\0\0\0\0")
+
+
+class JsonMatchSink(MatchSink):
+    """MatchSink writing one JSON object per match"""
+
+    def format(self, i: int) -> str:
+        record = {"id": self._ids[i], "filename": self.filename, "end": self._ends[i]}
+        if self._known_start(i):
+            record["from"] = self._starts[i]
+            record["match"] = self._texts.get(i, b"").decode("utf-8", errors="replace")
+        return json.dumps(record)
+
+
+class _SocketOut:
+    """Text stream over the connection, counting the written lines"""
+
+    def __init__(self, wfile: BinaryIO):
+        self.wfile = wfile
+        self.lines = 0
+
+    def write(self, text: str) -> None:
+        self.lines += text.count("\n")
+        self.wfile.write(text.encode("utf-8"))
+
+
+class _Handler(socketserver.StreamRequestHandler):
+    """Serves the requests of one connection, in its own thread"""
+
+    def handle(self):
+        for line in self.rfile:
+            if not line.strip():
+                continue
+            try:
+                request = json.loads(line)
+            except ValueError:
+                self._reply({"error": "Invalid request"})
+                return
+            if not isinstance(request, dict):
+                self._reply({"error": "Invalid request"})
+                return
+            try:
+                self._reply(self.server.scan_server.handle_request(request, self.rfile, self.wfile))
+            except OSError:
+                return
+
+    def _reply(self, record: dict) -> None:
+        self.wfile.write(json.dumps(record).encode("utf-8") + b"\n")
+
+
+class _TCPServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+if hasattr(socketserver, "ThreadingUnixStreamServer"):
+    class _UnixServer(socketserver.ThreadingUnixStreamServer):
+        daemon_threads = True
+else:  # Windows
+    _UnixServer = None
+
+
+class ScanServer:
+    """
+    Keeps compiled databases in memory and scans for clients.
+
+    Every connection is served by its own thread. A HyperscanEngine is
+    created with thread_scratch, so the threads share the databases and
+    each one scans with its own scratch space.
+
+    With the layered engine (LayeredHyperscanEngine), a text file database
+    is checked for changes before every scan: edited patterns are synced
+    (new ones compiled into a small delta layer, deleted ones hidden), so
+    rules added or removed with FileRegex apply without a full recompile
+    or a restart.
+    """
+
+    def __init__(self, databases: Dict[str, str], engine: str = "hyperscan", **engine_options):
+        """
+        Args:
+            databases: name -> compiled database (created by build) or a
+                text file with regexes (one per line). The first one is
+                used by requests without "db".
+            engine: name of the regex engine (see engines.ENGINES)
+            engine_options: constructor arguments of the engine
+        """
+        if not databases:
+            raise ValueError("No database to serve")
+        if engine in ("hyperscan", "layered"):
+            engine_options["thread_scratch"] = True
+
+        self.scanners: Dict[str, FileScanner] = {}
+        # name -> [path, mtime] of the text files synced on change
+        self._sources: Dict[str, list] = {}
+        self._sync_lock = threading.Lock()
+        for name, path in databases.items():
+            scanner = FileScanner(create_engine(engine, **engine_options))
+            scanner.load_patterns(path)
+            self.scanners[name] = scanner
+            if getattr(scanner.engine, "changeable", False):
+                self._sources[name] = [path, os.stat(path).st_mtime_ns]
+        self.default = next(iter(databases))
+
+    def _sync(self, name: str) -> None:
+        """Applies the changes of a text file database to its layered engine"""
+        source = self._sources.get(name)
+        if source is None:
+            return
+        path, mtime = source
+        try:
+            if os.stat(path).st_mtime_ns == mtime:
+                return
+        except OSError:
+            return
+        with self._sync_lock:
+            try:
+                current = os.stat(path).st_mtime_ns
+                if current == source[1]:
+                    return
+                source[1] = current
+                patterns, ids, flags = load_pattern_file(path)
+                self.scanners[name].engine.sync_patterns([pattern.encode("utf-8") for pattern in patterns],
+                                                         ids, flags)
+            except Exception as e:
+                print(f"Cannot update database '{name}' from '{path}': {e}")
+
+    def handle_request(self, request: dict, rfile: BinaryIO, wfile: BinaryIO) -> dict:
+        """Serves one request, writing its matches to wfile, and returns the final reply"""
+        op = request.get("op", "scan")
+        if op == "list":
+            return {"databases": list(self.scanners)}
+
+        frames = read_frames(rfile) if request.get("payload") else None
+        try:
+            if op != "scan":
+                return {"error": f"Unknown operation: {op}"}
+            name = request.get("db") or self.default
+            if name not in self.scanners:
+                return {"error": f"Unknown database: {name}"}
+            self._sync(name)
+
+            out = _SocketOut(wfile)
+            scanner = FileScanner(self.scanners[name].engine, out=out, sink_class=JsonMatchSink)
+            if frames is not None:
+                scanner.scan_chunks(frames, str(request.get("name", "<payload>")))
+            else:
+                path = request.get("path")
+                if not isinstance(path, str):
+                    return {"error": "Request needs a path or a payload"}
+                if os.path.isfile(path):
+                    scanner.scan_file(path)
+                elif os.path.isdir(path):
+                    scanner.scan_tree(path)
+                else:
+                    return {"error": f"cannot access '{path}': No such file or directory"}
+            return {"done": True, "matches": out.lines}
+        finally:
+            # keep the connection in sync if the payload was not read to the end
+            if frames is not None:
+                for _ in frames:
+                    pass
+
+    def serve_forever(self, address: Address, allow_remote: bool = False) -> None:
+        """
+        Listens on a TCP address (host, port) or a Unix socket path until interrupted.
+
+        Args:
+            allow_remote: listen on a TCP address that is not loopback (see check_address)
+
+        Raises:
+            ValueError: for a non-loopback TCP address without allow_remote
+        """
+        check_address(address, allow_remote)
+        if isinstance(address, tuple) and not is_loopback(address[0]):
+            print(f"Warning: listening on {format_address(address)} without authentication, "
+                  f"any client that can connect can scan the files of this host")
+        if isinstance(address, tuple):
+            server = _TCPServer(address, _Handler)
+        else:
+            if _UnixServer is None:
+                raise OSError("Unix sockets are not supported on this platform, use host:port")
+            _remove_stale_socket(address)
+            server = _UnixServer(address, _Handler)
+        server.scan_server = self
+
+        print(f"Serving {', '.join(self.scanners)} on {format_address(address)}")
+        sys.stdout.flush()
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+            if not isinstance(address, tuple):
+                _remove_stale_socket(address)
+
+
+def format_address(address: Address) -> str:
+    if isinstance(address, tuple):
+        return f"{address[0]}:{address[1]}"
+    return address
+
+
+def _remove_stale_socket(path: str) -> None:
+    """Removes a Unix socket left by a server that is not running any more"""
+    if not os.path.exists(path):
+        return
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as s:
+        try:
+            s.connect(path)
+        except OSError:
+            os.remove(path)
+            return
+    raise OSError(f"Address already in use: {path}")
+
+
+class ScanClient:
+    """Sends scan requests to a ScanServer and prints the results like `main.py run`"""
+
+    def __init__(self, address: Address):
+        family = socket.AF_INET if isinstance(address, tuple) else socket.AF_UNIX
+        self.sock = socket.socket(family, socket.SOCK_STREAM)
+        self.sock.connect(address)
+        self.rfile = self.sock.makefile("rb")
+        self.wfile = self.sock.makefile("wb")
+
+    def close(self) -> None:
+        self.rfile.close()
+        self.wfile.close()
+        self.sock.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def databases(self) -> List[str]:
+        self._send({"op": "list"})
+        return json.loads(self.rfile.readline())["databases"]
+
+    def scan_path(self, path: str, db: str = None, out=None) -> bool:
+        """Scans a file or directory seen by the server; returns False on error"""
+        self._send({"op": "scan", "path": os.path.abspath(path), "db": db})
+        return self._receive(out)
+
+    def scan_fileobj(self, f: BinaryIO, name: str, db: str = None, out=None,
+                     chunk_size: int = 1 << 20) -> bool:
+        """Sends the content of a binary stream (e.g. stdin) to be scanned; returns False on error"""
+        self._send({"op": "scan", "payload": True, "name": name, "db": db}, flush=False)
+        error = []
+
+        def send():
+            try:
+                write_frames(self.wfile, iter(lambda: f.read(chunk_size), b""))
+                self.wfile.flush()
+            except OSError as e:
+                error.append(e)
+
+        # matches are read while sending, so neither side blocks on a full socket buffer
+        sender = threading.Thread(target=send, daemon=True)
+        sender.start()
+        ok = self._receive(out)
+        sender.join()
+        if error:
+            print(f"Cannot send the payload: {error[0]}")
+            return False
+        return ok
+
+    def _send(self, request: dict, flush: bool = True) -> None:
+        self.wfile.write(json.dumps(request).encode("utf-8") + b"\n")
+        if flush:
+            self.wfile.flush()
+
+    def _receive(self, out) -> bool:
+        """Prints match lines until the final reply"""
+        out = out if out is not None else sys.stdout
+        for line in self.rfile:
+            record = json.loads(line)
+            if "id" in record:
+                if "from" in record:
+                    text = format_match(record["id"], record["from"], record["end"],
+                                        record["filename"], record["match"])
+                else:
+                    text = format_end_match(record["id"], record["end"], record["filename"])
+                out.write(text + "\n")
+            elif "error" in record:
+                print(record["error"])
+                return False
+            else:
+                return True
+        print("Connection closed by the server")
+        return False
@@ -10,8 +10,7 @@ from typing import Any, Callable, Dict, Iterable, List, Optional, Sequence, Tupl
 
 import psutil
 
-from engines.python_engine import PythonEngine
-from engines.hs_engine import HyperscanEngine
+from engines import get_engine_class
 from file_reader import FileReader
 
 class TextGenerator:
@@ -129,9 +128,11 @@ def benchmark_stream_precompiled(
     patterns: List[bytes],
     make_chunks: Callable[[], Iterable[bytes]],
     repeats: int = 5,
+    engine_kwargs: Optional[Dict[str, Any]] = None,
 ) -> Dict[str, Any]:
     proc = _get_proc()
-    engine = engine_cls()
+    engine_kwargs = engine_kwargs or {}
+    engine = engine_cls(**engine_kwargs)
 
     cpu_before = proc.cpu_times()
     mem_before = proc.memory_info().rss
@@ -147,6 +148,8 @@ def benchmark_stream_precompiled(
     compile_cpu_user = cpu_after.user - cpu_before.user
     compile_cpu_sys = cpu_after.system - cpu_before.system
     compile_mem_delta = mem_after - mem_before
+    db = getattr(engine, "db", None)
+    db_size = db.size() if hasattr(db, "size") else None
 
     scan_times: List[float] = []
     cpu_before_scan = proc.cpu_times()
@@ -170,6 +173,7 @@ def benchmark_stream_precompiled(
     return {
         "engine": engine_cls.__name__,
         "mode": "stream_precompiled",
+        "som": engine_kwargs.get("som"),
         "repeats": repeats,
         "compile": {
             "wall_time": compile_time_wall,
@@ -177,6 +181,7 @@ def benchmark_stream_precompiled(
             "cpu_sys": compile_cpu_sys,
             "mem_delta": compile_mem_delta,
             "mem_after": mem_after,
+            "db_size": db_size,
         },
         "scan": {
             "times_wall": scan_times,
@@ -215,12 +220,32 @@ class Scenario:
     chunk_size: int = 4096      # used for "stream" mode
 
 
-def _engine_classes(engine_arg: str) -> Sequence[Type]:
-    if engine_arg == "python":
-        return (PythonEngine,)
-    if engine_arg == "hyperscan":
-        return (HyperscanEngine,)
-    return (PythonEngine, HyperscanEngine)
+def _engine_names(engine_arg: str) -> Sequence[str]:
+    if engine_arg == "both":
+        return ("python", "hyperscan")
+    return (engine_arg,)
+
+
+def _engine_variants(engine_arg: str, som_levels: Sequence[str]) -> List[Tuple[Type, Dict[str, Any]]]:
+    """
+    Engine classes with their constructor arguments. HyperscanEngine is run
+    once per start-of-match level and never uses the database cache, so the
+    measured compile time is a real compile.
+    """
+    variants: List[Tuple[Type, Dict[str, Any]]] = []
+    for name in _engine_names(engine_arg):
+        engine_cls = get_engine_class(name)
+        if name == "hyperscan":
+            variants.extend((engine_cls, {"use_cache": False, "som": som}) for som in som_levels)
+        else:
+            variants.append((engine_cls, {}))
+    return variants
+
+
+def _som_levels(som_arg: str) -> Tuple[str, ...]:
+    if som_arg == "all":
+        return tuple(get_engine_class("hyperscan").SOM_LEVELS)
+    return (som_arg,)
 
 
 _SIMPLE_WORD = re.compile(r"^[A-Za-z0-9_]+$")
@@ -311,9 +336,10 @@ def run_scenarios(
     engine_arg: str,
     repeats: int,
     verbose: bool = True,
+    som_levels: Sequence[str] = ("large",),
 ) -> List[Dict[str, Any]]:
     results: List[Dict[str, Any]] = []
-    engines = _engine_classes(engine_arg)
+    engines = _engine_variants(engine_arg, som_levels)
 
     for s in scenarios:
         if verbose:
@@ -321,11 +347,13 @@ def run_scenarios(
 
         make_chunks = _make_chunks_for_scenario(s, gen_obj)
 
-        for engine_cls in engines:
+        for engine_cls, engine_kwargs in engines:
             if verbose:
-                print(f"  -> Engine: {engine_cls.__name__}")
+                som = f" (som={engine_kwargs['som']})" if "som" in engine_kwargs else ""
+                print(f"  -> Engine: {engine_cls.__name__}{som}")
 
-            res = benchmark_stream_precompiled(engine_cls, patterns, make_chunks, repeats=repeats)
+            res = benchmark_stream_precompiled(engine_cls, patterns, make_chunks, repeats=repeats,
+                                               engine_kwargs=engine_kwargs)
             res["scenario"] = s.name
             res["source"] = s.source
             res["chunk_mode"] = s.chunk_mode
@@ -336,9 +364,12 @@ def run_scenarios(
             results.append(res)
 
             if verbose:
+                db_size = res["compile"]["db_size"]
                 print(
                     f"     compile: {res['compile']['wall_time']:.6f}s, "
-                    f"avg scan: {res['scan']['avg_time_wall']:.6f}s"
+                    f"compile mem: {res['compile']['mem_delta']} B, "
+                    + (f"db size: {db_size} B, " if db_size is not None else "")
+                    + f"avg scan: {res['scan']['avg_time_wall']:.6f}s"
                 )
 
     return results
@@ -444,6 +475,8 @@ def build_parser() -> argparse.ArgumentParser:
     p.add_argument("--seed", type=int, default=1, help="Random seed.")
     p.add_argument("--repeats", type=int, default=5, help="How many scans per scenario.")
     p.add_argument("--engine", choices=["python", "hyperscan", "both"], default="both", help="Which engine(s) to run.")
+    p.add_argument("--som", choices=["none", "small", "large", "all"], default="large",
+                   help="Hyperscan start-of-match level(s) to run, 'all' compares their cost.")
     p.add_argument("--quiet", action="store_true", help="Less console output.")
     p.add_argument("--config", help="Path to JSON config with multiple tests.")
 
@@ -491,6 +524,7 @@ def main():
         seed = int(cfg.get("seed", args.seed))
         repeats = int(cfg.get("repeats", args.repeats))
         engine_arg = cfg.get("engine", args.engine)
+        som_levels = _som_levels(cfg.get("som", args.som))
 
         pp_cfg = cfg.get("pattern_words", {})
         pattern_params = PatternParams(
@@ -516,6 +550,7 @@ def main():
             engine_arg=engine_arg,
             repeats=repeats,
             verbose=verbose,
+            som_levels=som_levels,
         )
 
     elif args.generated or args.file_path:
@@ -555,6 +590,7 @@ def main():
             engine_arg=args.engine,
             repeats=args.repeats,
             verbose=verbose,
+            som_levels=_som_levels(args.som),
         )
 
     else:
@@ -566,6 +602,7 @@ def main():
             engine_arg=args.engine,
             repeats=args.repeats,
             verbose=verbose,
+            som_levels=_som_levels(args.som),
         )
 
     with open(args.output, "w", encoding="utf-8") as f:
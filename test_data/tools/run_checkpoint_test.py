@@ -0,0 +1,108 @@
+import os
+import re
+import subprocess
+import sys
+import tempfile
+from pathlib import Path
+
+"""
+What this script does:
+- Runs `main.py run --checkpoint FILE` twice over a directory, mutating it in between
+- Covers: appended data (with a match spanning the old end of a file), an unchanged
+  file, a truncated file, a rotated file (new inode), a file replaced in place and
+  a change of the pattern set (other database id)
+- Compares every second run with what a plain `main.py run` reports for the same bytes
+- Exits with 1 on any difference
+"""
+
+ROOT = Path(__file__).resolve().parents[2]
+
+PATTERNS = ["ERROR", r"PAT\d{3}.{10}END", r"\bword\b"]
+END_RE = re.compile(r"end: (\d+)")
+
+
+def run(*args) -> list:
+    res = subprocess.run([sys.executable, "main.py", "run", *map(str, args)], cwd=ROOT,
+                         stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
+    return sorted(line for line in res.stdout.splitlines() if line.strip())
+
+
+def after(lines: list, offset: int) -> list:
+    """Matches ending past `offset`, what a scan resumed there reports"""
+    return [line for line in lines if int(END_RE.search(line).group(1)) > offset]
+
+
+def check(name: str, got: list, expected: list) -> bool:
+    if got == expected:
+        print(f"+ PASS: {name} ({len(got)} matches)")
+        return True
+    print(f"x FAIL: {name}")
+    for line in sorted(set(got) ^ set(expected))[:10]:
+        print(f"    {'unexpected' if line in got else 'missing'}: {line}")
+    return False
+
+
+def write(path: Path, text: str, mode: str = "w") -> None:
+    with open(path, mode, encoding="utf-8") as f:
+        f.write(text)
+
+
+def main():
+    ok = True
+    with tempfile.TemporaryDirectory() as tmp:
+        tmp = Path(tmp)
+        patterns = tmp / "patterns.txt"
+        write(patterns, "\n".join(PATTERNS) + "\n")
+        store = tmp / "checkpoints.json"
+        tree = tmp / "tree"
+        tree.mkdir()
+        grow, same, cut, rotate, replace = (tree / f"{name}.log" for name in
+                                            ("grow", "same", "cut", "rotate", "replace"))
+
+        write(grow, "ERROR one\n" * 50 + "word PAT123-----")
+        write(same, "ERROR same word\n" * 20)
+        write(cut, "ERROR cut\n" * 200)
+        write(rotate, "ERROR old word\n" * 30)
+        write(replace, "ERROR aaaa word\n" * 40)
+
+        first = run(patterns, tree, "--checkpoint", store)
+        ok &= check("first run scans everything", first, run(patterns, tree))
+
+        # mutations
+        old_size = grow.stat().st_size
+        write(grow, "-----END ERROR two\nword\n" * 3, "a")
+        write(cut, "ERROR after truncation word\n")
+        # same first bytes and bigger: only the new inode tells it apart
+        os.rename(rotate, tree / "rotate.log.1")
+        write(rotate, (tree / "rotate.log.1").read_text(encoding="utf-8") + "ERROR new file\n")
+        size = replace.stat().st_size
+        write(replace, ("word ERROR bbbb\n" * 60)[:size + 32])
+
+        second = run(patterns, tree, "--checkpoint", store)
+        ok &= check("append: only new matches, spanning the old end",
+                    [line for line in second if "grow.log" in line], after(run(patterns, grow), old_size))
+        ok &= check("unchanged file reports nothing", [line for line in second if "same.log" in line], [])
+        ok &= check("truncated file is scanned from the start",
+                    [line for line in second if "cut.log" in line], run(patterns, cut))
+        ok &= check("rotated file (new inode) is scanned from the start",
+                    [line for line in second if "rotate.log'" in line], run(patterns, rotate))
+        ok &= check("rotated away file is new, scanned from the start",
+                    [line for line in second if "rotate.log.1" in line], run(patterns, tree / "rotate.log.1"))
+        ok &= check("file replaced in place is scanned from the start",
+                    [line for line in second if "replace.log" in line], run(patterns, replace))
+        if not any("PAT123-----" in line for line in second):
+            print("x FAIL: no match spans the old end of grow.log")
+            ok = False
+
+        ok &= check("third run without changes reports nothing", run(patterns, tree, "--checkpoint", store), [])
+
+        # another pattern set has another database id: everything from the start
+        write(patterns, "\n".join(PATTERNS + ["bbbb"]) + "\n")
+        ok &= check("new pattern set rescans everything", run(patterns, tree, "--checkpoint", store),
+                    run(patterns, tree))
+
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,110 @@
+import os
+import re
+import subprocess
+import sys
+import tempfile
+from pathlib import Path
+
+"""
+What this script does:
+- Runs `main.py run --index FILE` several times over a directory, mutating it in between
+- Covers: unchanged files (replayed, not scanned), edited files, touched files with
+  --index-hash, a change of the pattern set, and the same with --pool
+- Compares every run with a plain `main.py run` of the same tree
+- Exits with 1 on any difference
+"""
+
+ROOT = Path(__file__).resolve().parents[2]
+
+PATTERNS = ["ERROR", r"\bword\b", r"id=\d+"]
+MATCH_RE = re.compile(r", match: '.*'$")
+
+
+def run(*args) -> list:
+    res = subprocess.run([sys.executable, "main.py", "run", *map(str, args)], cwd=ROOT,
+                         stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
+    return sorted(line for line in res.stdout.splitlines() if line.strip())
+
+
+def offsets(lines: list) -> list:
+    """Matches without their text"""
+    return sorted(MATCH_RE.sub("", line) for line in lines)
+
+
+def check(name: str, got: list, expected: list) -> bool:
+    if got == expected and expected:
+        print(f"+ PASS: {name} ({len(got)} matches)")
+        return True
+    print(f"x FAIL: {name}")
+    for line in sorted(set(got) ^ set(expected))[:10]:
+        print(f"    {'unexpected' if line in got else 'missing'}: {line}")
+    return False
+
+
+def write(path: Path, text: str) -> None:
+    path.write_text(text, encoding="utf-8")
+
+
+def make_tree(tree: Path) -> None:
+    (tree / "sub").mkdir(parents=True)
+    for i in range(6):
+        write(tree / f"f{i}.log", f"ERROR id={i} word\n" * (20 + i) + "plain text\n" * i)
+    write(tree / "sub" / "deep.log", "word ERROR id=77\n" * 5)
+    write(tree / "sub" / "none.txt", "nothing to see\n")
+
+
+def run_mode(tmp: Path, extra: list) -> bool:
+    name = " ".join(extra) or "sequential"
+    ok = True
+    patterns = tmp / "patterns.txt"
+    write(patterns, "\n".join(PATTERNS) + "\n")
+    tree = tmp / "tree"
+    make_tree(tree)
+    index = tmp / "index.db"
+
+    def indexed(*more):
+        return run(patterns, tree, *extra, "--index", index, *more)
+
+    ok &= check(f"[{name}] first run scans everything", indexed(), run(patterns, tree))
+    ok &= check(f"[{name}] unchanged tree is replayed", indexed(), run(patterns, tree))
+
+    # same size and mtime: the index trusts it, so the old offsets are replayed
+    f0 = tree / "f0.log"
+    stat = f0.stat()
+    before = run(patterns, f0)
+    write(f0, f0.read_text(encoding="utf-8").replace("ERROR", "xxxxx"))
+    os.utime(f0, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+    ok &= check(f"[{name}] unchanged mtime and size are not scanned again",
+                offsets(line for line in indexed() if "f0.log" in line), offsets(before))
+
+    # edited (size changed) file is scanned again
+    write(tree / "f1.log", "ERROR edited id=1\n")
+    write(f0, "ERROR id=0 word\n" * 3)
+    ok &= check(f"[{name}] edited files are scanned again", indexed(), run(patterns, tree))
+
+    # touched with the same content: still right with and without --index-hash
+    indexed("--index-hash")
+    for path in tree.glob("*.log"):
+        os.utime(path)
+    ok &= check(f"[{name}] touched files with --index-hash", indexed("--index-hash"), run(patterns, tree))
+    # same size, new content, new mtime: the hash differs, it is scanned
+    f2 = tree / "f2.log"
+    write(f2, f2.read_text(encoding="utf-8").replace("word", "WORD"))
+    ok &= check(f"[{name}] rewritten file with --index-hash", indexed("--index-hash"), run(patterns, tree))
+
+    # another pattern set invalidates every entry
+    write(patterns, "\n".join(PATTERNS + ["text"]) + "\n")
+    ok &= check(f"[{name}] new pattern set rescans everything", indexed(), run(patterns, tree))
+    return ok
+
+
+def main():
+    ok = True
+    for extra in ([], ["--pool"]):
+        with tempfile.TemporaryDirectory() as tmp:
+            ok &= run_mode(Path(tmp), extra)
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,337 @@
+import gc
+import random
+import sys
+import threading
+import weakref
+from pathlib import Path
+
+"""
+What this script does:
+- Changes the patterns of a LayeredHyperscanEngine (compile, add, remove, sync, merge)
+  and compares scan, scan_buffer and scan_stream (with and without a scratch from
+  new_scratch) with a HyperscanEngine compiled from the live patterns
+- Checks that a scratch taken before an add or a merge still finds the matches of
+  every layer, and that a sharded scan given too few scratches raises
+- Adds, removes and merges in the middle of a scan: the running scan keeps the
+  layers it started with, the next one sees the change
+- Scans from several threads while another one adds, removes, syncs and merges
+  (background merges): every result is the one of a pattern set that was live
+  during the scan, so removed (tombstoned) ids never show up
+- Checks that a merge frees the per-thread scratches of the replaced layers and
+  that the layers themselves are not kept alive
+- Exits with 1 on any difference
+"""
+
+ROOT = Path(__file__).resolve().parents[2]
+sys.path.insert(0, str(ROOT))
+
+from engines.hs_engine import HyperscanEngine
+from engines.hs_layered import LayeredHyperscanEngine
+
+WORDS = [f"w{i:02d}x".encode() for i in range(60)]
+CHUNK = 1000
+
+
+def make_data(seed: int = 7, words: int = 6000) -> bytes:
+    rnd = random.Random(seed)
+    return b" ".join(rnd.choice(WORDS) for _ in range(words))
+
+
+DATA = make_data()
+
+
+def pattern(i: int) -> bytes:
+    """Pattern with external id i: a word, every 7th one a two-word regex"""
+    if i % 7 == 3:
+        return rb"w%02dx w[0-5]\dx" % (i % 60)
+    return WORDS[i % 60]
+
+
+def chunks(data: bytes = DATA):
+    for pos in range(0, len(data), CHUNK):
+        yield data[pos:pos + CHUNK]
+
+
+def check(name: str, got, expected) -> bool:
+    if got == expected:
+        print(f"+ PASS: {name}")
+        return True
+    print(f"x FAIL: {name}")
+    if isinstance(got, list) and isinstance(expected, list):
+        print(f"    unexpected: {sorted(set(got) - set(expected))[:5]}")
+        print(f"    missing:    {sorted(set(expected) - set(got))[:5]}")
+    else:
+        print(f"    got:      {got}")
+        print(f"    expected: {expected}")
+    return False
+
+
+def collect(scan) -> list:
+    """Sorted (id, start, end) reported by scan(callback)"""
+    found = []
+
+    def callback(pattern_id, start, end, flags, context):
+        found.append((pattern_id, start, end))
+
+    scan(callback)
+    return sorted(found)
+
+
+_references = {}
+
+
+def reference(live: dict) -> list:
+    """Matches of a HyperscanEngine compiled from the live patterns (external id -> pattern)"""
+    key = tuple(sorted(live.items()))
+    if key not in _references:
+        engine = HyperscanEngine(use_cache=False)
+        if live:
+            ids = sorted(live)
+            engine.compile_patterns([live[i] for i in ids], ids)
+            _references[key] = collect(lambda cb: engine.scan(DATA, cb))
+        else:
+            _references[key] = []
+    return _references[key]
+
+
+def scans(engine: LayeredHyperscanEngine, scratch=None) -> dict:
+    """Results of every scan method"""
+    return {
+        "scan": collect(lambda cb: engine.scan(DATA, cb)),
+        "scan_buffer": collect(lambda cb: engine.scan_buffer(memoryview(DATA), cb)),
+        "scan_stream": collect(lambda cb: engine.scan_stream(chunks(), cb)),
+        "scan_stream with a scratch": collect(lambda cb: engine.scan_stream(chunks(), cb, scratch=scratch)),
+    }
+
+
+def check_all(name: str, engine: LayeredHyperscanEngine, live: dict, scratch=None) -> bool:
+    ok = True
+    want = reference(live)
+    for method, got in scans(engine, scratch or engine.new_scratch()).items():
+        ok &= check(f"{name}: {method}", got, want)
+    return ok
+
+
+def new_engine(**kwargs) -> LayeredHyperscanEngine:
+    kwargs.setdefault("use_cache", False)
+    kwargs.setdefault("background_merge", False)
+    kwargs.setdefault("merge_threshold", 1 << 20)
+    return LayeredHyperscanEngine(**kwargs)
+
+
+def test_changes() -> bool:
+    ok = True
+    engine = new_engine()
+    live = {i: pattern(i) for i in range(20)}
+    engine.compile_patterns([live[i] for i in range(20)], list(range(20)))
+    ok &= check_all("compile_patterns", engine, live)
+
+    engine.add_patterns([pattern(i) for i in (20, 21, 22)], [20, 21, 22])
+    live.update({i: pattern(i) for i in (20, 21, 22)})
+    ok &= check_all("add_patterns", engine, live)
+
+    engine.remove_patterns([3, 5, 21])
+    for i in (3, 5, 21):
+        del live[i]
+    ok &= check_all("remove_patterns", engine, live)
+
+    # sync: drop 0 and 1, renumber the rest (external ids change), add 30 and 31
+    items = [(eid, live[eid]) for eid in sorted(live) if eid > 1] + [(30, pattern(30)), (31, pattern(31))]
+    live = {100 + n: text for n, (_, text) in enumerate(items)}
+    engine.sync_patterns(list(live.values()), list(live))
+    ok &= check_all("sync_patterns", engine, live)
+
+    layers = len(engine._layers)
+    engine.merge(wait=True)
+    ok &= check("merge folds the layers into one base", (layers > 1, len(engine._layers)), (True, 1))
+    ok &= check_all("merge", engine, live)
+    return ok
+
+
+def test_stale_scratch() -> bool:
+    ok = True
+    engine = new_engine()
+    live = {i: pattern(i) for i in range(10)}
+    engine.compile_patterns(list(live.values()), list(live))
+    scratch = engine.new_scratch()
+
+    engine.add_patterns([pattern(40), pattern(41)], [40, 41])
+    live.update({40: pattern(40), 41: pattern(41)})
+    ok &= check("scratch taken before add_patterns finds the new layer",
+                collect(lambda cb: engine.scan_stream(chunks(), cb, scratch=scratch)), reference(live))
+
+    engine.remove_patterns([40])
+    del live[40]
+    engine.merge(wait=True)
+    ok &= check("scratch taken before a merge",
+                collect(lambda cb: engine.scan_stream(chunks(), cb, scratch=scratch)), reference(live))
+    ok &= check("scratch keeps only the current layers", len(scratch._scratches), len(engine._layers))
+
+    # a sharded scan with one scratch less than shards must not skip a shard
+    engine.add_patterns([pattern(42)], [42])
+    view = engine._state.view
+    try:
+        view.scan_stream(chunks(), lambda *args: None, scratch=[view.shards[0].db.scratch.clone()])
+        ok &= check("too few scratches for the shards raise", "scanned", "ValueError")
+    except ValueError:
+        ok &= check("too few scratches for the shards raise", "ValueError", "ValueError")
+    return ok
+
+
+def test_change_during_scan() -> bool:
+    ok = True
+    engine = new_engine()
+    live = {i: pattern(i) for i in range(10)}
+    engine.compile_patterns(list(live.values()), list(live))
+    before = dict(live)
+    removed = 4
+
+    def changing_chunks():
+        for n, chunk in enumerate(chunks()):
+            if n == 1:
+                engine.add_patterns([pattern(50)], [50])
+                engine.remove_patterns([removed])
+                engine.merge(wait=True)
+            yield chunk
+
+    scratch = engine.new_scratch()
+    ok &= check("scan running during add, remove and merge keeps its layers",
+                collect(lambda cb: engine.scan_stream(changing_chunks(), cb, scratch=scratch)), reference(before))
+    live[50] = pattern(50)
+    del live[removed]
+    ok &= check_all("scan after the change", engine, live, scratch)
+    ok &= check(f"tombstoned id {removed} is not reported after the change",
+                [m for m in collect(lambda cb: engine.scan_stream(chunks(), cb)) if m[0] == removed], [])
+    return ok
+
+
+class CountingEngine(LayeredHyperscanEngine):
+    merges = 0
+
+    def _merge(self):
+        CountingEngine.merges += 1
+        super()._merge()
+
+
+def test_concurrent() -> bool:
+    engine = CountingEngine(use_cache=False, thread_scratch=True, merge_threshold=6, background_merge=True)
+    live = {i: pattern(i) for i in range(12)}
+    engine.compile_patterns(list(live.values()), list(live))
+    versions = [dict(live)]
+    # external ids removed by version n (never given out again)
+    removed_by = [set()]
+    stop = threading.Event()
+    results = []
+    errors = []
+
+    def scanner(n: int):
+        scratch = engine.new_scratch()
+        methods = [
+            lambda cb: engine.scan(DATA, cb),
+            lambda cb: engine.scan_buffer(memoryview(DATA), cb),
+            lambda cb: engine.scan_stream(chunks(), cb),
+            lambda cb: engine.scan_stream(chunks(), cb, scratch=scratch),
+        ]
+        i = n
+        try:
+            while not stop.is_set():
+                first = len(versions) - 1
+                got = collect(methods[i % len(methods)])
+                last = len(versions) - 1
+                results.append((first, last, i % len(methods), got))
+                i += 1
+        except Exception as e:
+            errors.append(repr(e))
+
+    threads = [threading.Thread(target=scanner, args=(n,)) for n in range(3)]
+    for thread in threads:
+        thread.start()
+
+    rnd = random.Random(3)
+    next_id = 100
+    for step in range(24):
+        kind = step % 3
+        if kind == 0:
+            ids = [next_id, next_id + 1]
+            next_id += 2
+            engine.add_patterns([pattern(i) for i in ids], ids)
+            live.update({i: pattern(i) for i in ids})
+        elif kind == 1:
+            gone = rnd.sample(sorted(live), 2)
+            engine.remove_patterns(gone)
+            for i in gone:
+                del live[i]
+        else:
+            keep = sorted(live)[1:]
+            ids = keep + [next_id]
+            next_id += 1
+            new_live = {i: live[i] for i in keep}
+            new_live[ids[-1]] = pattern(ids[-1])
+            engine.sync_patterns([new_live[i] for i in ids], ids)
+            live = new_live
+        versions.append(dict(live))
+        removed_by.append(removed_by[-1] | (set(versions[-2]) - set(live)))
+    stop.set()
+    for thread in threads:
+        thread.join()
+    engine.merge(wait=True)
+
+    ok = check("no scan failed while the layers changed", errors, [])
+    ok &= check("background merges ran during the scans", CountingEngine.merges > 1, True)
+    names = ["scan", "scan_buffer", "scan_stream", "scan_stream with a scratch"]
+    wrong = []
+    tombstoned = 0
+    for first, last, method, got in results:
+        # the state published by a change is visible just before its version is recorded
+        candidates = [reference(versions[v]) for v in range(first, min(last + 1, len(versions) - 1) + 1)]
+        if got not in candidates:
+            wrong.append((names[method], first, last))
+        tombstoned += sum(1 for m in got if m[0] in removed_by[first])
+    ok &= check(f"every concurrent scan matches a live pattern set ({len(results)} scans)", wrong, [])
+    ok &= check("tombstoned ids never show up in concurrent scans", tombstoned, 0)
+    ok &= check_all("after the concurrent changes", engine, live)
+    return ok
+
+
+def test_scratch_release() -> bool:
+    engine = new_engine(thread_scratch=True)
+    live = {i: pattern(i) for i in range(10)}
+    engine.compile_patterns(list(live.values()), list(live))
+    engine.add_patterns([pattern(60)], [60])
+
+    # per-thread scratches of this thread and of another one
+    engine.scan_stream(chunks(), lambda *args: None)
+    thread = threading.Thread(target=lambda: engine.scan(DATA, lambda *args: None))
+    thread.start()
+    thread.join()
+    old = list(engine._layers)
+    ok = check("scans cloned per-thread scratches", all(getattr(layer._local, "scratches", None) for layer in old),
+               True)
+    scratch = engine.new_scratch()
+
+    engine.merge(wait=True)
+    ok &= check("merge frees the per-thread scratches of the replaced layers",
+                [getattr(layer._local, "scratches", None) for layer in old], [None] * len(old))
+    refs = [weakref.ref(layer) for layer in old]
+    del old
+    gc.collect()
+    ok &= check("replaced layers are not kept alive", [ref() is None for ref in refs], [True] * len(refs))
+    ok &= check("LayerScratch drops the scratches of replaced layers", len(scratch._scratches), 0)
+    live[60] = pattern(60)
+    ok &= check_all("after the merge", engine, live, scratch)
+    ok &= check("LayerScratch has one scratch per current layer", len(scratch._scratches), len(engine._layers))
+    return ok
+
+
+def main():
+    ok = True
+    ok &= test_changes()
+    ok &= test_stale_scratch()
+    ok &= test_change_during_scan()
+    ok &= test_concurrent()
+    ok &= test_scratch_release()
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+    main()
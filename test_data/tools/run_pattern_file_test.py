@@ -0,0 +1,242 @@
+import json
+import subprocess
+import sys
+import tempfile
+from pathlib import Path
+
+"""
+What this script does:
+- Reads the structured pattern file test_data/inputs/pf_patterns.jsonl and checks its
+  ids (explicit and by position), flags and tags
+- Checks that the flags reach HyperscanEngine.compile_patterns (and its flag bits) and
+  that every flag changes what is matched in test_data/inputs/pf_input.txt
+- Checks that a pattern with a comma (PAT.{1000,1000}END) is kept whole in both formats
+- Compares the matches with test_data/expected/pf_patterns.expected.json
+- Checks that every invalid file (test_data/inputs/pf_bad_*.jsonl and friends) is a
+  ValueError naming the problem, and that `main.py build` reports it without a traceback
+- Checks that `build --modes` rejects unknown modes and always stores the stream
+  database, and that `main.py run` reports an artifact it cannot load (no stream
+  database, python engine) instead of reading it as a pattern file
+- Checks that patterns that do not compile (test_data/inputs/pf_bad_backref.txt) or an
+  invalid pattern file are reported once by `main.py run` with --pool and --split,
+  instead of restarting the Pool workers forever
+- Exits with 1 on any difference
+"""
+
+ROOT = Path(__file__).resolve().parents[2]
+sys.path.insert(0, str(ROOT))
+
+import hyperscan
+from engines.hs_engine import HyperscanEngine
+from file_regex.pattern_file import PatternSpec, load_pattern_file, read_patterns
+from file_scanner import FileScanner
+
+INPUTS = ROOT / "test_data" / "inputs"
+PATTERNS = INPUTS / "pf_patterns.jsonl"
+PLAIN = INPUTS / "pf_patterns.txt"
+TARGET = INPUTS / "pf_input.txt"
+EXPECTED = ROOT / "test_data" / "expected" / "pf_patterns.expected.json"
+
+# invalid file -> part of the error message
+INVALID = {
+    "pf_bad_flags_number.jsonl": ':1: "flags" must be a list of strings',
+    "pf_bad_flags_dict.jsonl": ':1: "flags" must be a list of strings',
+    "pf_bad_tags.jsonl": ':1: "tags" must be a list of strings',
+    "pf_unknown_flag.jsonl": ":1: unknown flag 'nocase'",
+    "pf_missing_expression.jsonl": ':1: missing "expression"',
+    "pf_duplicate_id.jsonl": ":2: duplicate id 3",
+    "pf_bad_version.jsonl": ":1: unsupported pattern file 'nokia-patterns' version 2",
+    "pf_bad_json.jsonl": ":2: invalid JSON",
+}
+
+
+class RecordingEngine(HyperscanEngine):
+    """HyperscanEngine that remembers the arguments of compile_patterns"""
+
+    def __init__(self):
+        super().__init__(use_cache=False)
+        self.calls = []
+
+    def compile_patterns(self, patterns, ids=None, flags=None):
+        self.calls.append((patterns, ids, flags))
+        super().compile_patterns(patterns, ids, flags)
+
+
+def check(name: str, got, expected) -> bool:
+    if got == expected:
+        print(f"+ PASS: {name}")
+        return True
+    print(f"x FAIL: {name}")
+    print(f"    got:      {got}")
+    print(f"    expected: {expected}")
+    return False
+
+
+def matches(engine: HyperscanEngine) -> list:
+    """(id, start or None if unknown, end) of every match in TARGET"""
+    found = []
+
+    def on_match(pattern_id, start, end, flags, context):
+        found.append([pattern_id, None if start == HyperscanEngine.START_UNKNOWN else start, end])
+
+    engine.scan(TARGET.read_bytes(), on_match)
+    return sorted(found, key=lambda m: (m[2], m[0]))
+
+
+def compiled(patterns: list, flags=None) -> HyperscanEngine:
+    engine = HyperscanEngine(use_cache=False)
+    engine.compile_patterns([pattern.encode("utf-8") for pattern in patterns], list(range(len(patterns))), flags)
+    return engine
+
+
+def test_specs(expected: dict) -> bool:
+    specs = list(read_patterns(str(PATTERNS)))
+    return check("ids, flags and tags of pf_patterns.jsonl", specs,
+                 [PatternSpec(spec["id"], spec["expression"], tuple(spec["flags"]), tuple(spec["tags"]))
+                  for spec in expected["specs"]])
+
+
+def test_compile(expected: dict) -> bool:
+    ok = True
+    engine = RecordingEngine()
+    FileScanner(engine).load_patterns(str(PATTERNS))
+    specs = expected["specs"]
+    ok &= check("compile_patterns gets the expressions, ids and flags", engine.calls, [(
+        [spec["expression"].encode("utf-8") for spec in specs],
+        [spec["id"] for spec in specs],
+        [tuple(spec["flags"]) for spec in specs],
+    )])
+    for spec, bits in zip(specs, engine.flags):
+        for name in spec["flags"]:
+            ok &= check(f"id {spec['id']}: {name} flag bit is set", bool(bits & HyperscanEngine.FLAG_BITS[name]), True)
+    ok &= check("matches of pf_patterns.jsonl", matches(engine), expected["matches"])
+    return ok
+
+
+def test_flag_effects() -> bool:
+    """Every flag changes the result, so it was not dropped on the way"""
+    ok = True
+    count = lambda engine: len(matches(engine))
+    ok &= check("caseless: match only with the flag",
+                (count(compiled(["error: .*timeout"])), count(compiled(["error: .*timeout"], [("caseless",)]))),
+                (0, 1))
+    ok &= check("dotall: '.' matches a newline only with the flag",
+                (count(compiled(["BEGIN.END"])), count(compiled(["BEGIN.END"], [("dotall",)]))), (1, 2))
+    ok &= check("singlematch: one match instead of three",
+                (count(compiled(["ping"])), count(compiled(["ping"], [("singlematch",)]))), (3, 1))
+    try:
+        compiled([r"(a)b\1b"])
+        ok &= check("prefilter: a back-reference compiles only with the flag", "compiled", "error")
+    except Exception:
+        ok &= check("prefilter: a back-reference compiles only with the flag",
+                    count(compiled([r"(a)b\1b"], [("prefilter",)])), 1)
+    return ok
+
+
+def test_plain_comma() -> bool:
+    expressions, ids, flags = load_pattern_file(str(PLAIN))
+    ok = check("plain file keeps the comma of a bounded repeat", (expressions[0], flags),
+               ("PAT.{1000,1000}END", None))
+    found = matches(compiled(expressions))
+    ok &= check("plain file: PAT.{1000,1000}END matches 1000 characters", [m for m in found if m[0] == 0],
+                [[0, 6, 1012]])
+    return ok
+
+
+def test_invalid() -> bool:
+    ok = True
+    with tempfile.TemporaryDirectory() as tmp:
+        for name, message in INVALID.items():
+            path = INPUTS / name
+            try:
+                list(read_patterns(str(path)))
+                ok &= check(f"{name} is rejected", "accepted", message)
+                continue
+            except ValueError as e:
+                ok &= check(f"{name} is rejected", message in str(e), True)
+            res = subprocess.run([sys.executable, "main.py", "build", str(path), "-o", str(Path(tmp) / "out.db")],
+                                 cwd=ROOT, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
+            ok &= check(f"{name}: build reports it without a traceback",
+                        ("Invalid pattern file:" in res.stdout and message in res.stdout,
+                         "Traceback" in res.stdout, (Path(tmp) / "out.db").exists()),
+                        (True, False, False))
+    return ok
+
+
+def run_main(*args, timeout=None) -> subprocess.CompletedProcess:
+    return subprocess.run([sys.executable, "main.py", *args], cwd=ROOT, stdout=subprocess.PIPE,
+                          stderr=subprocess.STDOUT, text=True, timeout=timeout)
+
+
+def test_build_modes() -> bool:
+    ok = True
+    with tempfile.TemporaryDirectory() as tmp:
+        db = str(Path(tmp) / "out.db")
+        res = run_main("build", str(PLAIN), "-o", db, "--modes", "block,bogus")
+        ok &= check("build --modes block,bogus is rejected by the CLI",
+                    ("unknown database mode: bogus" in res.stdout, "Traceback" in res.stdout, Path(db).exists()),
+                    (True, False, False))
+
+        run_main("build", str(PATTERNS), "-o", db, "--modes", "block")
+        data = Path(db).read_bytes()
+        size = int.from_bytes(data[8:12], "little")
+        header = json.loads(data[12:12 + size])
+        ok &= check("build --modes block stores the stream database too",
+                    [entry["mode"] for entry in header["databases"]], ["stream", "block"])
+        res = run_main("run", db, str(TARGET), "-c")
+        ok &= check("run scans with the --modes block artifact", (res.returncode, "Traceback" in res.stdout,
+                                                                  "count:" in res.stdout), (0, False, True))
+
+        # an artifact without the stream database (as --modes block wrote before)
+        engine = HyperscanEngine(use_cache=False)
+        engine.compile_patterns([b"ping"], modes=("block",))
+        blob = hyperscan.dumpb(engine.block_db)
+        header = json.dumps({"version": HyperscanEngine.DB_VERSION,
+                             "databases": [{"mode": "block", "size": len(blob)}]}).encode("utf-8")
+        Path(db).write_bytes(HyperscanEngine.DB_MAGIC + len(header).to_bytes(4, "little") + header + blob)
+        for extra in ([], ["--engine", "python"]):
+            res = run_main("run", db, str(TARGET), *extra)
+            ok &= check(f"run {' '.join(extra) or '(hyperscan)'} reports an artifact without a stream database",
+                        (res.returncode, res.stdout.startswith("Cannot load database"), "Traceback" in res.stdout),
+                        (1, True, False))
+    return ok
+
+
+def test_run_errors() -> bool:
+    ok = True
+    runs = [
+        (INPUTS / "pf_bad_backref.txt", "hyperscan", "Cannot compile the patterns of"),
+        (INPUTS / "pf_bad_json.jsonl", "hyperscan", "Invalid pattern file:"),
+        (INPUTS / "pf_bad_json.jsonl", "python", "Invalid pattern file:"),
+    ]
+    for config, engine, message in runs:
+        for options in ([], ["--pool"], ["--split", "2"], ["--split", "2", "--threads"]):
+            target = INPUTS if "--pool" in options else TARGET
+            name = f"run {config.name} --engine {engine} {' '.join(options)}".rstrip()
+            try:
+                res = run_main("run", str(config), str(target), "--engine", engine, *options, timeout=60)
+            except subprocess.TimeoutExpired:
+                ok &= check(f"{name} reports the error", "timeout", "error")
+                continue
+            ok &= check(f"{name} reports the error",
+                        (res.returncode, res.stdout.startswith(message), "Traceback" in res.stdout),
+                        (1, True, False))
+    return ok
+
+
+def main():
+    with open(EXPECTED, "r", encoding="utf-8") as f:
+        expected = json.load(f)
+    ok = True
+    ok &= test_specs(expected)
+    ok &= test_compile(expected)
+    ok &= test_flag_effects()
+    ok &= test_plain_comma()
+    ok &= test_invalid()
+    ok &= test_build_modes()
+    ok &= test_run_errors()
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+    main()
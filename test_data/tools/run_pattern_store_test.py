@@ -0,0 +1,230 @@
+import os
+import sys
+import tempfile
+from pathlib import Path
+
+"""
+What this script does:
+- Edits pattern files through PatternStore / FileRegex in a temporary directory
+- Checks that ids stay the same across adds, deletes and reloads
+- Checks that a missing, corrupt or cut short `.ids` sidecar is rebuilt
+- Checks that a single add only appends (no file replaced) and that batch() and
+  delete replace each file once, atomically
+- Runs the same edits through the original FileRegex and checks exist()/elements()
+- Exits with 1 on any difference
+"""
+
+ROOT = Path(__file__).resolve().parents[2]
+sys.path.insert(0, str(ROOT))
+
+from file_regex import pattern_store
+from file_regex.file_regex import FileRegex
+from file_regex.pattern_store import PatternStore
+
+
+class BaselineFileRegex:
+    """FileRegex before PatternStore, as the reference for exist()/elements()"""
+
+    def __init__(self, filename):
+        self.plik = filename
+        open(self.plik, "a", encoding="utf-8").close()
+
+    def add_element(self, text):
+        if not self.exist(text):
+            with open(self.plik, "a", encoding="utf-8") as f:
+                f.write(text.strip() + "\n")
+
+    def delete_element(self, text):
+        with open(self.plik, "r", encoding="utf-8") as f:
+            lines = f.readlines()
+        with open(self.plik, "w", encoding="utf-8") as f:
+            for line in lines:
+                if line.strip() != text.strip():
+                    f.write(line)
+
+    def exist(self, text):
+        with open(self.plik, "r", encoding="utf-8") as f:
+            for line in f:
+                if line.strip() == text:
+                    return True
+        return False
+
+    def elements(self):
+        patterns = []
+        with open(self.plik, "r", encoding="utf-8") as f:
+            for line in f:
+                text = line.strip()
+                if text:
+                    patterns.append(text.split(",", 1)[0].strip())
+        return patterns
+
+
+class ReplaceCounter:
+    """Counts os.replace calls (atomic rewrites) per target file"""
+
+    def __init__(self):
+        self.calls = []
+        self._replace = os.replace
+
+    def __enter__(self):
+        def replace(src, dst, *args, **kwargs):
+            self.calls.append(os.path.basename(dst))
+            return self._replace(src, dst, *args, **kwargs)
+        pattern_store.os.replace = replace
+        return self
+
+    def __exit__(self, *exc):
+        pattern_store.os.replace = self._replace
+
+
+def check(name: str, got, expected) -> bool:
+    if got == expected:
+        print(f"+ PASS: {name}")
+        return True
+    print(f"x FAIL: {name}")
+    print(f"    got:      {got}")
+    print(f"    expected: {expected}")
+    return False
+
+
+def inodes(path: Path) -> tuple:
+    return os.stat(path).st_ino, os.stat(str(path) + PatternStore.SUFFIX).st_ino
+
+
+def test_stable_ids(tmp: Path) -> bool:
+    ok = True
+    path = tmp / "ids.txt"
+    store = PatternStore(str(path))
+    store.add(["a", "b", "c", "d"])
+    store.delete(["b"])
+    store.add(["e"])
+    expected = [(0, "a"), (2, "c"), (3, "d"), (4, "e")]
+    ok &= check("ids after add/delete", store.items(), expected)
+    ok &= check("ids after reload", PatternStore(str(path)).items(), expected)
+    ok &= check("FileRegex.ids() after reload", FileRegex(str(path)).ids(), [0, 2, 3, 4])
+
+    # a deleted id is not given out again, also after a reload
+    store.delete(["e"])
+    ok &= check("deleted id is not reused", PatternStore(str(path)).add(["f"]), [5])
+
+    # hand edit: lines keep their ids by text, new lines get new ids
+    path.write_text("d\nhand\na\nc\nf\n", encoding="utf-8")
+    ok &= check("ids after a hand edit", PatternStore(str(path)).items(),
+                [(3, "d"), (6, "hand"), (0, "a"), (2, "c"), (5, "f")])
+    return ok
+
+
+def test_rebuilt_sidecar(tmp: Path) -> bool:
+    ok = True
+    path = tmp / "rebuild.txt"
+    sidecar = Path(str(path) + PatternStore.SUFFIX)
+    path.write_text("x\ny\nz\n", encoding="utf-8")
+
+    # missing: ids from the line order, the sidecar is written by the first change
+    ok &= check("no sidecar before an edit", sidecar.exists(), False)
+    PatternStore(str(path)).add(["w"])
+    ok &= check("missing sidecar is rebuilt", PatternStore(str(path)).items(),
+                [(0, "x"), (1, "y"), (2, "z"), (3, "w")])
+
+    # corrupt: a message, new ids, and a readable sidecar after the next change
+    sidecar.write_text("{not json", encoding="utf-8")
+    store = PatternStore(str(path))
+    ok &= check("corrupt sidecar gives new ids", store.ids(), [0, 1, 2, 3])
+    store.add(["v"])
+    ok &= check("corrupt sidecar is rebuilt", PatternStore(str(path)).items(),
+                [(0, "x"), (1, "y"), (2, "z"), (3, "w"), (4, "v")])
+
+    # an append cut short in the sidecar: the other lines keep their ids
+    with open(sidecar, "a", encoding="utf-8") as f:
+        f.write('[5, "u')
+    with open(path, "a", encoding="utf-8") as f:
+        f.write("u\n")
+    store = PatternStore(str(path))
+    ok &= check("cut short sidecar keeps the other ids", store.items(),
+                [(0, "x"), (1, "y"), (2, "z"), (3, "w"), (4, "v"), (5, "u")])
+    store.add(["t"])
+    ok &= check("cut short sidecar is compacted", PatternStore(str(path)).items(),
+                [(0, "x"), (1, "y"), (2, "z"), (3, "w"), (4, "v"), (5, "u"), (6, "t")])
+    return ok
+
+
+def test_writes(tmp: Path) -> bool:
+    ok = True
+    path = tmp / "writes.txt"
+    store = PatternStore(str(path))
+    store.add(["first"])
+    before = inodes(path)
+    with ReplaceCounter() as counter:
+        for i in range(200):
+            store.add([f"p{i}"])
+    ok &= check("single adds replace no file", counter.calls, [])
+    ok &= check("single adds append in place (same inodes)", inodes(path), before)
+    ok &= check("appended lines", path.read_text(encoding="utf-8").splitlines(),
+                ["first"] + [f"p{i}" for i in range(200)])
+
+    with ReplaceCounter() as counter:
+        with store.batch():
+            store.add([f"q{i}" for i in range(500)])
+            for i in range(0, 200, 2):
+                store.delete([f"p{i}"])
+            store.add(["last"])
+    ok &= check("batch() is one atomic rewrite of each file", sorted(counter.calls),
+                sorted([path.name, path.name + PatternStore.SUFFIX]))
+    ok &= check("batch() result after reload", PatternStore(str(path)).patterns(),
+                ["first"] + [f"p{i}" for i in range(1, 200, 2)] + [f"q{i}" for i in range(500)] + ["last"])
+
+    with ReplaceCounter() as counter:
+        store.delete(["last"])
+    ok &= check("delete is one atomic rewrite of each file", len(counter.calls), 2)
+
+    # last line edited by hand without a newline: the add starts a new line
+    with open(path, "a", encoding="utf-8") as f:
+        f.write("hand")
+    FileRegex(str(path)).add_element("after")
+    ok &= check("add after a line without a newline", path.read_text(encoding="utf-8").splitlines()[-2:],
+                ["hand", "after"])
+    return ok
+
+
+def test_baseline(tmp: Path) -> bool:
+    initial = "a\n\nb, comment\na\n  spaced  \n"
+    old_path, new_path = tmp / "old.txt", tmp / "new.txt"
+    old_path.write_text(initial, encoding="utf-8")
+    new_path.write_text(initial, encoding="utf-8")
+    old, new, other = BaselineFileRegex(str(old_path)), FileRegex(str(new_path)), FileRegex(str(new_path))
+    probes = ["a", " a", "b", "b, comment", "spaced", "  spaced  ", "c", "c, note", "d", "missing"]
+    edits = [
+        ("add_element", "c, note"),
+        ("add_element", "a"),
+        ("add_element", " d "),
+        ("delete_element", "b, comment"),
+        ("delete_element", " a "),
+        ("add_element", "a"),
+        ("delete_element", "missing"),
+    ]
+
+    def state(regex):
+        return regex.elements(), [regex.exist(probe) for probe in probes]
+
+    ok = check("exist()/elements() as before, initial file", state(new), state(old))
+    for i, (method, text) in enumerate(edits):
+        getattr(old, method)(text)
+        # every other edit through a second instance, as another process would
+        getattr(other if i % 2 else new, method)(text)
+        ok &= check(f"exist()/elements() as before, after {method}({text!r})", state(new), state(old))
+    return ok
+
+
+def main():
+    ok = True
+    with tempfile.TemporaryDirectory() as tmp:
+        tmp = Path(tmp)
+        ok &= test_stable_ids(tmp)
+        ok &= test_rebuilt_sidecar(tmp)
+        ok &= test_writes(tmp)
+        ok &= test_baseline(tmp)
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,175 @@
+import contextlib
+import io
+import os
+import subprocess
+import sys
+from pathlib import Path
+
+"""
+What this script does:
+- Scans test_data/inputs/sink_input.txt and the directory test_data/inputs/sink_tree
+  with --files-with-matches (-l), --count (-c) and --max-matches
+- Covers the plain paths (scan_file streamed, as one block and memory mapped,
+  scan_fileobj, scan_small_files, scan_tree), the pool (FileScannerPool.scan_file
+  and `main.py run --pool`) and the split path (threads and processes)
+- Compares every output with test_data/expected/sink_*.expected.txt
+- Checks that the scan stops early: after -l or --max-matches N the sink gets no
+  match past the first (N) on the sequential paths
+- Exits with 1 on any difference
+"""
+
+ROOT = Path(__file__).resolve().parents[2]
+sys.path.insert(0, str(ROOT))
+
+from engines import create_engine
+from file_scanner import FileScanner
+from file_scanner_pool import FileScannerPool
+from match_sink import CountSink, FilesWithMatchesSink, MatchSink
+
+PATTERNS = "test_data/inputs/sink_patterns.txt"
+TARGET = "test_data/inputs/sink_input.txt"
+TREE = "test_data/inputs/sink_tree"
+EXPECTED = ROOT / "test_data" / "expected"
+MAX = 5
+
+# name -> (sink class, max_matches, CLI options)
+MODES = {
+    "l": (FilesWithMatchesSink, None, ["-l"]),
+    "c": (CountSink, None, ["-c"]),
+    "max": (MatchSink, MAX, ["--max-matches", str(MAX)]),
+    "c_max": (CountSink, MAX, ["-c", "--max-matches", str(MAX)]),
+}
+
+
+def counting(sink_class):
+    """sink_class that counts the calls of add, to see whether the scan went on after it returned True"""
+
+    class CountingSink(sink_class):
+        calls = 0
+
+        def add(self, pattern_id, start, end):
+            CountingSink.calls += 1
+            return super().add(pattern_id, start, end)
+
+    return CountingSink
+
+
+def expected(name: str) -> list:
+    with open(EXPECTED / f"sink_{name}.expected.txt", "r", encoding="utf-8") as f:
+        return sorted(f.read().splitlines())
+
+
+def check(name: str, got: list, expected: list) -> bool:
+    if got == expected and expected:
+        print(f"+ PASS: {name} ({len(got)} lines)")
+        return True
+    print(f"x FAIL: {name}")
+    for line in sorted(set(got) ^ set(expected))[:10]:
+        print(f"    {'unexpected' if line in got else 'missing'}: {line}")
+    if not expected:
+        print("    no expected lines")
+    return False
+
+
+def lines(text: str) -> list:
+    return sorted(line for line in text.splitlines() if line.strip())
+
+
+def scanner(engine_name: str, sink_class, max_matches) -> FileScanner:
+    scanner = FileScanner(create_engine(engine_name), out=io.StringIO(), sink_class=sink_class,
+                          max_matches=max_matches)
+    scanner.load_patterns(PATTERNS)
+    return scanner
+
+
+def sequential_runs():
+    """(path name, function scanning TARGET with a FileScanner) of the plain paths"""
+    def stdin(s):
+        with open(TARGET, "rb") as f:
+            s.scan_fileobj(f, TARGET, chunk_size=1024)
+
+    return [
+        ("scan_file streamed", lambda s: s.scan_file(TARGET, chunk_size=1024)),
+        ("scan_file block", lambda s: s.scan_file(TARGET, full_file=True)),
+        ("scan_file mmap streamed", lambda s: s.scan_file(TARGET, chunk_size=1024, use_mmap=True)),
+        ("scan_fileobj", stdin),
+        ("scan_small_files", lambda s: s.scan_small_files([TARGET])),
+    ]
+
+
+def limit(sink_class, max_matches):
+    """Number of add calls a scan that stops early makes, None if it does not stop"""
+    if issubclass(sink_class, FilesWithMatchesSink):
+        return 1
+    return max_matches
+
+
+def test_file(name: str) -> bool:
+    ok = True
+    sink_class, max_matches, options = MODES[name]
+    want = expected(f"input_{name}")
+    stop = limit(sink_class, max_matches)
+    for engine_name in ("hyperscan", "python"):
+        for path, run in sequential_runs():
+            sink = counting(sink_class)
+            s = scanner(engine_name, sink, max_matches)
+            run(s)
+            ok &= check(f"{' '.join(options)} {path} ({engine_name})", lines(s.out.getvalue()), want)
+            if stop is not None and sink.calls != stop:
+                print(f"x FAIL: {' '.join(options)} {path} ({engine_name}): the scan went on, "
+                      f"{sink.calls} matches given to the sink instead of {stop}")
+                ok = False
+
+    # pool: one file in this process
+    out = io.StringIO()
+    with contextlib.redirect_stdout(out):
+        FileScannerPool.scan_file(PATTERNS, create_engine("hyperscan"), TARGET, sink_class=sink_class,
+                                  max_matches=max_matches)
+    ok &= check(f"{' '.join(options)} FileScannerPool.scan_file", lines(out.getvalue()), want)
+
+    # split: the ranges are scanned to their end, only the output is limited
+    for threads in (True, False):
+        out = io.StringIO()
+        FileScannerPool.scan_file_split(PATTERNS, create_engine("hyperscan"), TARGET, parts=3, threads=threads,
+                                        out=out, sink_class=sink_class, max_matches=max_matches)
+        ok &= check(f"{' '.join(options)} --split 3 ({'threads' if threads else 'processes'})",
+                    lines(out.getvalue()), want)
+
+    # CLI
+    for extra in ([], ["--pool"], ["--full-block"]):
+        ok &= check(f"main.py run {' '.join(options + extra)}", run_main(TARGET, *options, *extra), want)
+    return ok
+
+
+def test_tree(name: str) -> bool:
+    ok = True
+    sink_class, max_matches, options = MODES[name]
+    want = expected(f"tree_{name}")
+    for small_file_size in (None, 0):
+        s = scanner("hyperscan", sink_class, max_matches)
+        s.scan_tree(TREE, small_file_size=small_file_size)
+        path = "scan_tree (scan_small_files)" if small_file_size is None else "scan_tree (one file at a time)"
+        ok &= check(f"{' '.join(options)} {path}", lines(s.out.getvalue()), want)
+    for extra in ([], ["--pool"]):
+        ok &= check(f"main.py run {' '.join(options + extra)} (tree)", run_main(TREE, *options, *extra), want)
+    return ok
+
+
+def run_main(target: str, *options) -> list:
+    res = subprocess.run([sys.executable, "main.py", "run", PATTERNS, target, *options], cwd=ROOT,
+                         stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
+    return lines(res.stdout)
+
+
+def main():
+    os.chdir(ROOT)
+    FileScannerPool.MIN_SPLIT_SIZE = 4096
+    ok = True
+    for name in MODES:
+        ok &= test_file(name)
+        ok &= test_tree(name)
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+    main()
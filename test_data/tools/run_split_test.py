@@ -0,0 +1,108 @@
+import io
+import random
+import sys
+import tempfile
+from collections import Counter
+from pathlib import Path
+
+"""
+What this script does:
+- Lowers FileScannerPool.MIN_SPLIT_SIZE so a small generated file reaches the split path
+- Places matches across the boundaries of the ranges from split_ranges
+- Checks that every match is owned by exactly one range (scan_range)
+- Checks that `--split N` output (threads and processes) equals the sequential scan_file output
+- Exits with 1 on any difference
+"""
+
+ROOT = Path(__file__).resolve().parents[2]
+sys.path.insert(0, str(ROOT))
+
+from engines import create_engine
+from file_scanner import FileScanner
+from file_scanner_pool import FileScannerPool, scan_range, split_ranges
+
+PATTERNS = [r"PAT\d{3}.{20}END", r"\bword\b", "abcabc", r"x{5,9}"]
+SIZE = 64 * 1024
+PARTS = 4
+
+
+def make_input(path: Path) -> None:
+    random.seed(5)
+    data = bytearray(random.choice(b"qrstuv \n") for _ in range(SIZE))
+    pieces = [b"PAT123" + b"-" * 20 + b"END", b" word ", b"abcabc", b"xxxxxxx"]
+    # one piece straddling every range boundary
+    for k, (start, _) in enumerate(split_ranges(SIZE, PARTS)[1:]):
+        piece = pieces[k % len(pieces)]
+        pos = start - len(piece) // 2
+        data[pos:pos + len(piece)] = piece
+    for pos in range(500, SIZE - 100, 997):
+        piece = pieces[pos % len(pieces)]
+        data[pos:pos + len(piece)] = piece
+    path.write_bytes(bytes(data))
+
+
+def sequential(config: str, engine_name: str, target: str) -> list:
+    out = io.StringIO()
+    scanner = FileScanner(create_engine(engine_name), out=out)
+    scanner.load_patterns(config)
+    scanner.scan_file(target)
+    return sorted(out.getvalue().splitlines())
+
+
+def split(config: str, engine_name: str, target: str, threads: bool) -> list:
+    out = io.StringIO()
+    FileScannerPool.scan_file_split(config, create_engine(engine_name), target, parts=PARTS, threads=threads,
+                                    out=out)
+    return sorted(out.getvalue().splitlines())
+
+
+def check_ownership(config: str, target: str) -> bool:
+    """Matches of all ranges together equal the matches of the whole file, none twice"""
+    scanner = FileScanner(create_engine("hyperscan"))
+    scanner.load_patterns(config)
+    engine = scanner.engine
+    overlap = engine.max_match_width()
+
+    whole = []
+    engine.scan_stream([Path(target).read_bytes()], lambda i, s, e, f, c: whole.append((i, s, e)))
+    ranges = split_ranges(SIZE, PARTS)
+    parts = Counter()
+    straddling = 0
+    for start, stop in ranges:
+        for pattern_id, match_start, match_end in scan_range(engine, target, start, stop, overlap):
+            parts[(pattern_id, match_start, match_end)] += 1
+            straddling += match_start < start
+    ok = parts == Counter(whole) and max(parts.values()) == 1
+    print(f"{'+ PASS' if ok else 'x FAIL'}: ownership ({len(whole)} matches, {straddling} straddling a boundary)")
+    if not straddling:
+        print("x FAIL: no match straddles a range boundary")
+        ok = False
+    return ok
+
+
+def main():
+    FileScannerPool.MIN_SPLIT_SIZE = 4096
+    ok = True
+    with tempfile.TemporaryDirectory() as tmp:
+        config = Path(tmp) / "patterns.txt"
+        config.write_text("\n".join(PATTERNS) + "\n", encoding="utf-8")
+        target = Path(tmp) / "input.txt"
+        make_input(target)
+
+        ok &= check_ownership(str(config), str(target))
+        for engine_name, threads in (("hyperscan", True), ("hyperscan", False), ("python", False)):
+            expected = sequential(str(config), engine_name, str(target))
+            got = split(str(config), engine_name, str(target), threads)
+            mode = "threads" if threads else "processes"
+            if got == expected and expected:
+                print(f"+ PASS: --split {PARTS} --engine {engine_name} ({mode}): {len(got)} matches")
+            else:
+                print(f"x FAIL: --split {PARTS} --engine {engine_name} ({mode}): "
+                      f"{len(got)} matches, sequential {len(expected)}")
+                ok = False
+
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,72 @@
+import argparse
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+"""
+What this script does:
+- Measures the cold start of `main.py run` on a tiny file for each engine
+- Subtracts the start of a bare interpreter (`python -c pass`)
+- Checks that `--engine python` does not import hyperscan or multiprocessing
+- Exits with 1 if any engine is over the budget (ms above the bare interpreter)
+"""
+
+ROOT = Path(__file__).resolve().parents[2]
+
+
+def median_ms(cmd, runs):
+    times = []
+    for _ in range(runs):
+        t0 = time.perf_counter()
+        subprocess.run(cmd, cwd=ROOT, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=True)
+        times.append((time.perf_counter() - t0) * 1000)
+    return statistics.median(times)
+
+
+def imported_modules(cmd):
+    res = subprocess.run([sys.executable, "-X", "importtime"] + cmd[1:], cwd=ROOT,
+                         stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True, check=True)
+    return {line.rsplit("|", 1)[-1].strip() for line in res.stderr.splitlines() if "|" in line}
+
+
+def main():
+    p = argparse.ArgumentParser(description="CLI startup time check")
+    p.add_argument("--runs", type=int, default=15, help="runs per command, the median is used")
+    p.add_argument("--budget", type=float, default=80.0, help="allowed ms above `python -c pass`")
+    args = p.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        patterns = Path(tmp) / "patterns.txt"
+        patterns.write_text("abc\n\\bword\\b\n", encoding="utf-8")
+        target = Path(tmp) / "input.txt"
+        target.write_text("abc word\n", encoding="utf-8")
+
+        commands = {
+            engine: [sys.executable, "main.py", "run", "--engine", engine, str(patterns), str(target)]
+            for engine in ("python", "hyperscan")
+        }
+
+        failed = False
+        modules = imported_modules(commands["python"])
+        for heavy in ("hyperscan", "multiprocessing"):
+            if heavy in modules:
+                print(f"- FAIL: --engine python imports {heavy}")
+                failed = True
+
+        base = median_ms([sys.executable, "-c", "pass"], args.runs)
+        print(f"python -c pass: {base:.1f} ms")
+        for engine, cmd in commands.items():
+            ms = median_ms(cmd, args.runs)
+            over = ms - base
+            status = "OK" if over <= args.budget else "FAIL"
+            print(f"{status}: --engine {engine}: {ms:.1f} ms (+{over:.1f} ms, budget {args.budget:.0f} ms)")
+            failed |= over > args.budget
+
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()